@@ -0,0 +1,765 @@
+"""Micro-benchmarks for the container tracking data path.
+
+    python benchmark.py scan --containers 10000 --scans 20000
+    python benchmark.py history --containers 10000 --scans 20000
+    python benchmark.py idle --seconds 5
+    python benchmark.py http --servers dev threads processes
+    python benchmark.py outbox --messages 5000 --inflight 1 20 100
+    python benchmark.py ingest --workers 1 2 4 --mode processes
+    python benchmark.py metrics --scans 20000
+    python benchmark.py suite --sizes 1000 100000 1000000 --json > results.json
+"""
+import argparse
+import collections
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import paho.mqtt.client as mqtt
+
+import database
+import ingest
+import log
+import metrics
+import outbox
+import protocol
+import storage
+
+
+# Seconds the suite waits on a scan's result before calling the run broken
+SUITE_TIMEOUT = 60
+
+
+def seed(path, containers, users):
+    """Create a fresh database at path with the given number of rows.
+    Serials are lowercase, as the legacy on_message path lowercases scans."""
+    database.configure(path)
+    database.create_database()
+    with database.transaction() as conn:
+        conn.executemany("INSERT INTO users (name, badgeID) VALUES (?, ?)",
+                         ((f"user{i}", f"badge{i}") for i in range(users)))
+        conn.executemany("INSERT INTO containers (serial_number) VALUES (?)",
+                         ((f"c{i:07d}",) for i in range(containers)))
+    database.close()
+
+
+def legacy_checkout(path, container_serial, user_badgeID):
+    """The original per-call connect implementation, kept for comparison."""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM containers WHERE serial_number=?", (container_serial,))
+    if not cursor.fetchone():
+        conn.close()
+        return
+    cursor.execute("SELECT * FROM users WHERE badgeID=?", (user_badgeID,))
+    user = cursor.fetchone()
+    if not user:
+        conn.close()
+        return
+    cursor.execute("UPDATE containers SET user_id=? WHERE serial_number=?", (user[0], container_serial))
+    conn.commit()
+    conn.close()
+
+
+def legacy_return(path, container_serial):
+    """The original per-call connect return, kept for comparison."""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM containers WHERE serial_number=?", (container_serial,))
+    if not cursor.fetchone():
+        conn.close()
+        return
+    cursor.execute("UPDATE containers SET user_id=NULL WHERE serial_number=?", (container_serial,))
+    conn.commit()
+    conn.close()
+
+
+def workload(containers, users, scans):
+    """Checkout and return of the same container, alternating, so every
+    scan succeeds and commits a write on any implementation."""
+    rng = random.Random(42)
+    pairs = []
+    for _ in range(scans // 2):
+        serial, badge = f"c{rng.randrange(containers):07d}", f"badge{rng.randrange(users)}"
+        pairs.append(('checkout', serial, badge))
+        pairs.append(('return', serial))
+    return pairs
+
+
+def run_scan(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        scans = workload(args.containers, args.users, args.scans)
+
+        before_path = os.path.join(tmp, 'before.db')
+        seed(before_path, args.containers, args.users)
+        # Seeding goes through the pool, so put the file back in rollback
+        # journal mode to match what the original code ran against
+        conn = sqlite3.connect(before_path)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+
+        start = time.perf_counter()
+        for scan in scans:
+            if scan[0] == 'checkout':
+                legacy_checkout(before_path, scan[1], scan[2])
+            else:
+                legacy_return(before_path, scan[1])
+        before = len(scans) / (time.perf_counter() - start)
+
+        after_path = os.path.join(tmp, 'after.db')
+        seed(after_path, args.containers, args.users)
+        database.configure(after_path)
+        failed = 0
+        start = time.perf_counter()
+        for scan in scans:
+            if scan[0] == 'checkout':
+                status, _ = database.checkout_container(scan[1], scan[2], 'bench')
+            else:
+                status, _ = database.return_container(scan[1], 'bench')
+            failed += status != 'ok'
+        after = len(scans) / (time.perf_counter() - start)
+        cache = database.cache_stats()
+        database.close()
+    if failed:
+        raise RuntimeError(f"{failed} scans did not succeed, so the runs did different work")
+
+    print(f"containers={args.containers} users={args.users} scans={args.scans}")
+    print(f"before (connect per call): {before:10.0f} scans/sec")
+    print(f"after  (pooled, WAL):      {after:10.0f} scans/sec")
+    print(f"speedup: {after / before:.1f}x")
+    for name, stats in cache.items():
+        print(f"{name} cache: {stats['hits']} hits, {stats['misses']} misses, {stats['size']} entries")
+
+
+def apply_scans(scans, batch):
+    """Apply scans committing every `batch` of them, like the ingest pipeline."""
+    for i in range(0, len(scans), batch):
+        with database.transaction():
+            for scan in scans[i:i + batch]:
+                if scan[0] == 'checkout':
+                    database.checkout_container(scan[1], scan[2], 'bench')
+                else:
+                    database.return_container(scan[1], 'bench')
+
+
+def run_history(args):
+    # Every scan succeeds, so each writes an event when history is on
+    scans = workload(args.containers, args.users, args.scans)
+
+    print(f"containers={args.containers} users={args.users} scans={len(scans)}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for batch in (1, args.batch):
+            rates = {}
+            for enabled in (False, True):
+                path = os.path.join(tmp, f'history_{batch}_{enabled}.db')
+                seed(path, args.containers, args.users)
+                database.configure(path)
+                database.HISTORY = enabled
+                start = time.perf_counter()
+                apply_scans(scans, batch)
+                rates[enabled] = len(scans) / (time.perf_counter() - start)
+                database.close()
+            added = (1 / rates[True] - 1 / rates[False]) * 1e6
+            print(f"commit every {batch:3d}: history off {rates[False]:8.0f} scans/sec, "
+                  f"on {rates[True]:8.0f} scans/sec, +{added:.1f} us/scan")
+    database.HISTORY = True
+
+
+def run_idle(args):
+    """CPU used while idle by the old busy-wait main loop vs. waiting on an event."""
+    def busy_wait(state):
+        # What main() used to do: while True: pass
+        while state['running']:
+            pass
+
+    def event_wait(state):
+        state['stop'].wait()
+
+    for name, target in (("busy-wait loop", busy_wait), ("event wait", event_wait)):
+        state = {'running': True, 'stop': threading.Event()}
+        thread = threading.Thread(target=target, args=(state,))
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        thread.start()
+        time.sleep(args.seconds)
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+        state['running'] = False
+        state['stop'].set()
+        thread.join()
+        print(f"{name:15s} {cpu / wall * 100:6.1f}% of one core over {wall:.1f}s")
+
+
+def _wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"dashboard did not start on port {port}")
+
+
+def _load(port, path, clients, seconds):
+    """Hammer one path from `clients` keep-alive connections; return req/s."""
+    deadline = time.monotonic() + seconds
+    counts = [0] * clients
+
+    def client(i):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        while time.monotonic() < deadline:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                raise RuntimeError(f"GET {path} returned {response.status}")
+            counts[i] += 1
+        conn.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def run_http(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'http.db')
+        seed(path, args.containers, args.users)
+        database.configure(path)
+        with database.transaction() as conn:
+            # Give about half the users a container so /users has content
+            conn.execute("UPDATE containers SET user_id = id % ? + 1 WHERE id % 2 = 0", (args.users,))
+        database.close()
+
+        print(f"containers={args.containers} users={args.users} clients={args.clients} workers={args.workers}")
+        for server in args.servers:
+            process = subprocess.Popen(
+                [sys.executable, os.path.join(here, 'main.py'), '--role', 'dashboard', '--server', server,
+                 '--workers', str(args.workers), '--port', str(args.port), '--db', path],
+                cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                _wait_for_port(args.port)
+                for url in args.paths:
+                    rate = _load(args.port, url, args.clients, args.seconds)
+                    print(f"{server:10s} GET {url:10s} {rate:8.1f} req/s")
+            finally:
+                process.terminate()
+                process.wait()
+
+
+class FakeBroker:
+    """Just enough of an MQTT 3.1.1 broker to accept clients and acknowledge
+    their publishes, so the kiosk outbox can be timed without a real one."""
+
+    def __init__(self):
+        self.sock = socket.create_server(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.received = 0
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        stream = conn.makefile('rb')
+        with conn, stream:
+            while True:
+                header = stream.read(1)
+                if not header:
+                    return
+                length, shift = 0, 0
+                while True:
+                    byte = stream.read(1)[0]
+                    length |= (byte & 0x7f) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = stream.read(length)
+                kind = header[0] >> 4
+                if kind == 1:  # CONNECT -> CONNACK
+                    conn.sendall(b'\x20\x02\x00\x00')
+                elif kind == 3:  # PUBLISH, PUBACK if QoS 1
+                    self.received += 1
+                    if header[0] & 0x06:
+                        topic_end = 2 + int.from_bytes(body[:2], 'big')
+                        conn.sendall(b'\x40\x02' + body[topic_end:topic_end + 2])
+                elif kind == 8:  # SUBSCRIBE -> SUBACK granting QoS 0
+                    filters, i = 0, 2
+                    while i < len(body):
+                        i += 2 + int.from_bytes(body[i:i + 2], 'big') + 1
+                        filters += 1
+                    conn.sendall(bytes([0x90, 2 + filters]) + body[:2] + b'\x00' * filters)
+                elif kind == 12:  # PINGREQ -> PINGRESP
+                    conn.sendall(b'\xd0\x00')
+                elif kind == 14:  # DISCONNECT
+                    return
+
+    def close(self):
+        self.sock.close()
+
+
+def run_outbox(args):
+    """Queue scans while 'offline', then time draining them on reconnect."""
+    topic = protocol.command_topic('bench')
+    payloads = [protocol.encode_command('checkout', protocol.new_id(), serial=f"c{i:07d}", badge=f"badge{i % 1000}")
+                for i in range(args.messages)]
+
+    print(f"messages={args.messages}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for inflight in args.inflight:
+            box = outbox.Outbox(os.path.join(tmp, f'outbox_{inflight}.db'))
+            start = time.perf_counter()
+            for payload in payloads:
+                box.add(topic, payload)
+            queued = len(payloads) / (time.perf_counter() - start)
+
+            broker = FakeBroker()
+            client = mqtt.Client(client_id=f"bench-{inflight}", clean_session=False)
+            client.max_inflight_messages_set(inflight)
+            publisher = outbox.OutboxPublisher(client, box)
+            start = time.perf_counter()
+            client.connect('127.0.0.1', broker.port)
+            client.loop_start()
+            publisher.resend_stored()
+            while publisher.inflight() or len(box):
+                time.sleep(0.005)
+            flushed = len(payloads) / (time.perf_counter() - start)
+
+            client.disconnect()
+            client.loop_stop()
+            box.close()
+            broker.close()
+            print(f"inflight {inflight:4d}: queued offline {queued:8.0f} msgs/sec, "
+                  f"flushed on reconnect {flushed:8.0f} msgs/sec")
+
+
+def _start_broker(tmp, port):
+    """Run a throwaway amqtt broker so each run starts without old sessions."""
+    config = os.path.join(tmp, f'broker_{port}.yaml')
+    with open(config, 'w') as f:
+        f.write(f"listeners:\n  default:\n    type: tcp\n    bind: 127.0.0.1:{port}\n")
+    broker = subprocess.Popen(['amqtt', '-c', config], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _wait_for_port(port)
+    return broker
+
+
+def _start_ingest(here, path, port, workers, mode):
+    common = [sys.executable, os.path.join(here, 'main.py'), '--role', 'ingest', '--db', path,
+              '--broker', '127.0.0.1', '--broker-port', str(port)]
+    if mode == 'threads':
+        commands = [common + ['--shards', str(workers)]]
+    else:
+        commands = [common + ['--shard', f'{i}/{workers}'] for i in range(workers)]
+    return [subprocess.Popen(command, cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            for command in commands]
+
+
+class _LoadClient:
+    """Publishes commands as a set of kiosks and counts the results."""
+
+    def __init__(self, port):
+        self.results = 0
+        self.done = threading.Event()
+        self.expected = 0
+        self._lock = threading.Lock()
+        self.client = mqtt.Client()
+        self.client.max_inflight_messages_set(1000)
+        self.client.on_message = self._on_result
+        self.client.connect('127.0.0.1', port)
+        self.client.subscribe(protocol.result_topic('+'), 1)
+        self.client.loop_start()
+
+    def _on_result(self, client, userdata, msg):
+        with self._lock:
+            self.results += 1
+            if self.results >= self.expected:
+                self.done.set()
+
+    def run(self, commands, timeout):
+        """Publish (kiosk, op, fields) commands and wait for every result."""
+        with self._lock:
+            self.results = 0
+            self.expected = len(commands)
+            self.done.clear()
+        start = time.perf_counter()
+        for kiosk, op, fields in commands:
+            self.client.publish(protocol.command_topic(kiosk), protocol.encode_command(op, protocol.new_id(), **fields), qos=1)
+        if not self.done.wait(timeout):
+            raise RuntimeError(f"only {self.results} of {len(commands)} results arrived")
+        return time.perf_counter() - start
+
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+def run_ingest(args):
+    """End-to-end scans/sec through the broker for each ingest worker count."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    rng = random.Random(42)
+    # Checkout then return of the same container from the same kiosk, so
+    # every scan succeeds and each container's scans stay in order
+    commands = []
+    for i in range(args.scans // 2):
+        kiosk = f"bench-{i % args.kiosks}"
+        serial, badge = f"c{rng.randrange(args.containers):07d}", f"badge{rng.randrange(args.users)}"
+        commands.append((kiosk, 'checkout', {'serial': serial, 'badge': badge}))
+        commands.append((kiosk, 'return', {'serial': serial}))
+
+    print(f"containers={args.containers} scans={len(commands)} kiosks={args.kiosks} mode={args.mode}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in args.workers:
+            path = os.path.join(tmp, f'ingest_{workers}.db')
+            seed(path, args.containers, args.users)
+            broker = _start_broker(tmp, args.broker_port)
+            processes = _start_ingest(here, path, args.broker_port, workers, args.mode)
+            load = None
+            try:
+                load = _LoadClient(args.broker_port)
+                # Warm up until every shard answers, which also means all
+                # of them have subscribed
+                warmup = [('bench-warmup', 'return', {'serial': f"c{i:07d}"}) for i in range(min(args.containers, 64))]
+                deadline = time.monotonic() + 30
+                while True:
+                    try:
+                        load.run(warmup, 2)
+                        break
+                    except RuntimeError:
+                        if time.monotonic() > deadline:
+                            raise
+                elapsed = load.run(commands, args.timeout)
+                print(f"{workers:3d} {args.mode:9s} {len(commands) / elapsed:8.0f} scans/sec end to end")
+            finally:
+                if load:
+                    load.close()
+                for process in processes:
+                    process.terminate()
+                for process in processes:
+                    process.wait()
+                broker.terminate()
+                broker.wait()
+
+
+def run_metrics(args):
+    """Cost of leaving instrumentation on: per update, and per scan."""
+    counter = metrics.Counter('bench_total', "", ('type',))
+    histogram = metrics.Histogram('bench_seconds', "", ('operation',))
+    n = 200000
+
+    def per_call(function, *call_args):
+        start = time.perf_counter()
+        for _ in range(n):
+            function(*call_args)
+        return (time.perf_counter() - start) / n * 1e9
+
+    # Subtract the cost of the loop and call itself
+    baseline = per_call(lambda *a: None, 'checkout')
+    inc = per_call(counter.inc, 'checkout') - baseline
+    observe = per_call(histogram.observe, 0.0003, 'checkout_container') - baseline
+    print(f"Counter.inc       {inc:6.0f} ns")
+    print(f"Histogram.observe {observe:6.0f} ns")
+
+    rng = random.Random(42)
+    pairs = [(f"c{rng.randrange(args.containers):07d}", f"badge{rng.randrange(args.users)}")
+             for _ in range(args.scans // 2)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'metrics.db')
+        seed(path, args.containers, args.users)
+        database.configure(path)
+        variants = {
+            'plain': (database.checkout_container, database.return_container),
+            'instrumented': (metrics.operation_seconds.time('checkout_container')(database.checkout_container),
+                             metrics.operation_seconds.time('return_container')(database.return_container)),
+        }
+        elapsed = dict.fromkeys(variants, 0.0)
+        # Alternate in chunks on the same database so drift in the machine
+        # and the file hits both variants equally; checkout+return pairs
+        # leave every container as it was
+        chunk = 1000
+        for i in range(0, len(pairs), chunk):
+            for label, (checkout, return_) in variants.items():
+                start = time.perf_counter()
+                for serial, badge in pairs[i:i + chunk]:
+                    checkout(serial, badge, 'bench')
+                    return_(serial, 'bench')
+                elapsed[label] += time.perf_counter() - start
+        database.close()
+
+    scans = len(pairs) * 2
+    plain = elapsed['plain'] / scans * 1e6
+    wrapped = elapsed['instrumented'] / scans * 1e6
+    # Per scan the service also times the transaction and bumps two counters
+    # (message received, result published); those run in both variants here
+    # or not at all, so add them from the micro numbers
+    total = wrapped - plain + (observe + 2 * inc) / 1000
+    print(f"scans={scans}: plain {plain:.1f} us/scan, operation timing adds {wrapped - plain:+.2f} us")
+    print(f"all instrumentation per scan: about {total:.2f} us ({total / plain * 100:.1f}% of a scan)")
+
+
+def percentile(sorted_samples, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, min(len(sorted_samples) - 1, math.ceil(fraction * len(sorted_samples)) - 1))
+    return sorted_samples[index]
+
+
+def summarize(scenario, size, latencies, elapsed):
+    """One result row: throughput over the whole run and per-op latency."""
+    latencies = sorted(latencies)
+    return {
+        'scenario': scenario,
+        'size': size,
+        'ops': len(latencies),
+        'seconds': round(elapsed, 4),
+        'ops_per_sec': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+    }
+
+
+def timed_calls(calls):
+    """Run each zero-argument callable in turn; (latencies, elapsed)."""
+    latencies = []
+    start = time.perf_counter()
+    for call in calls:
+        before = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - before)
+    return latencies, time.perf_counter() - start
+
+
+def suite_direct(main, pairs):
+    """main.checkout_container/return_container, the console code path."""
+    calls = []
+    for serial, badge in pairs:
+        calls.append(lambda serial=serial, badge=badge: main.checkout_container(serial, badge, 'bench'))
+        calls.append(lambda serial=serial: main.return_container(serial, 'bench'))
+    return timed_calls(calls)
+
+
+def suite_messages(main, messages, window):
+    """Fake MQTT messages through on_message/on_command and the scan
+    pipeline; each op is timed from delivery until its result is reported.
+    At most window ops are outstanding, like kiosks waiting on replies.
+    Every op must succeed, so an error path is never what gets timed."""
+    outstanding = threading.Semaphore(window)
+    started = collections.deque()
+    latencies = []
+    failures = collections.Counter()
+    done = threading.Event()
+
+    def report(command, result):
+        main.report_command(command, result)
+        if result is None or result[0] != 'ok':
+            failures[(command[0], result and result[0])] += 1
+        # One worker applies commands in arrival order
+        latencies.append(time.perf_counter() - started.popleft())
+        outstanding.release()
+        if len(latencies) == len(messages):
+            done.set()
+
+    main.pipeline = ingest.ScanPipeline(main.apply_command, report)
+    main.pipeline.start()
+    try:
+        start = time.perf_counter()
+        for handler, message in messages:
+            if not outstanding.acquire(timeout=SUITE_TIMEOUT):
+                break
+            started.append(time.perf_counter())
+            handler(None, None, message)
+        if not done.wait(SUITE_TIMEOUT):
+            raise RuntimeError(f"only {len(latencies)} of {len(messages)} ops were answered")
+        if failures:
+            raise RuntimeError(f"ops failed: {dict(failures)}")
+        return latencies, time.perf_counter() - start
+    finally:
+        main.pipeline.stop()
+
+
+def suite_http(client, requests):
+    """Dashboard requests through the Flask test client, each given as
+    (method, path, form)."""
+    def call(method, path, form):
+        response = client.open(path, method=method, data=form)
+        response.get_data()
+        if response.status_code >= 400:
+            raise RuntimeError(f"{method} {path} returned {response.status_code}")
+    return timed_calls([lambda request=request: call(*request) for request in requests])
+
+
+def run_suite(args):
+    """Seeds a database per size and reports every scenario at each size."""
+    import dashboard
+    import main
+
+    # Keep the service's logging on, as deployed, but out of the report
+    log.setup(stream=open(os.devnull, 'w'))
+    results = []
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            users = args.users or size
+            path = os.path.join(tmp, f'suite-{size}.db')
+            seed(path, size, users)
+            storage.configure(path)
+            # Data versions restart with each fresh database
+            dashboard.response_cache.clear()
+            app = dashboard.create_app(connect_mqtt=False)
+            client = app.test_client()
+
+            def pairs(count):
+                return [(f"c{rng.randrange(size):07d}", f"badge{rng.randrange(users)}") for _ in range(count)]
+
+            def report(scenario, measured):
+                row = summarize(scenario, size, *measured)
+                results.append(row)
+                if not args.json:
+                    print(f"{size:>8} {scenario:<28} {row['ops']:>7} ops {row['ops_per_sec']:>10.1f}/s "
+                          f"p50 {row['p50_ms']:8.3f} ms  p99 {row['p99_ms']:8.3f} ms")
+
+            report('direct checkout+return', suite_direct(main, pairs(args.scans // 2)))
+
+            legacy = []
+            for serial, badge in pairs(args.scans // 2):
+                legacy.append((main.on_message, types.SimpleNamespace(
+                    topic=main.TOPIC, payload=f"control:checkout:{serial}:{badge}:bench".encode())))
+                legacy.append((main.on_message, types.SimpleNamespace(
+                    topic=main.TOPIC, payload=f"control:return:{serial}:bench".encode())))
+            report('on_message legacy', suite_messages(main, legacy, args.window))
+
+            structured = []
+            topic = protocol.command_topic('bench')
+            for serial, badge in pairs(args.scans // 2):
+                structured.append((main.on_command, types.SimpleNamespace(
+                    topic=topic, payload=protocol.encode_command('checkout', protocol.new_id(), serial=serial, badge=badge))))
+                structured.append((main.on_command, types.SimpleNamespace(
+                    topic=topic, payload=protocol.encode_command('return', protocol.new_id(), serial=serial))))
+            report('on_command structured', suite_messages(main, structured, args.window))
+
+            count = args.requests
+            def get(path):
+                return suite_http(client, [('GET', path, None)] * count)
+
+            report('GET /', get('/'))
+            report('GET /?q=', get(f'/?q=user{rng.randrange(users)}'))
+            # Repeated reads are served from the response cache until data changes
+            report('GET /users', get('/users'))
+            report('GET /users?stream=1', get('/users?stream=1'))
+            # Freshly seeded ids run 1..N, so the rows added next follow on
+            report('POST /add_user', suite_http(client, [
+                ('POST', '/add_user', {'name': f"bench{i}", 'badgeID': f"bench{i}"}) for i in range(count)]))
+            report('POST /delete_user', suite_http(client, [
+                ('POST', f'/delete_user/{users + 1 + i}', None) for i in range(count)]))
+            report('POST /add_container', suite_http(client, [
+                ('POST', '/add_container', {'serial_number': f"B{i:07d}"}) for i in range(count)]))
+            report('POST /delete_container', suite_http(client, [
+                ('POST', f'/delete_container/{size + 1 + i}', None) for i in range(count)]))
+            storage.close()
+
+    if args.json:
+        json.dump({
+            'benchmark': 'suite',
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'results': results,
+        }, sys.stdout, indent=2)
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    scan = commands.add_parser('scan', help="checkout/return throughput, per-call connect vs pooled")
+    scan.add_argument('--containers', type=int, default=10000)
+    scan.add_argument('--users', type=int, default=1000)
+    scan.add_argument('--scans', type=int, default=20000)
+    scan.set_defaults(func=run_scan)
+
+    history = commands.add_parser('history', help="checkout/return throughput with the events table off and on")
+    history.add_argument('--containers', type=int, default=10000)
+    history.add_argument('--users', type=int, default=1000)
+    history.add_argument('--scans', type=int, default=20000)
+    history.add_argument('--batch', type=int, default=ingest.BATCH_SIZE, help="scans per commit for the batched run")
+    history.set_defaults(func=run_history)
+
+    idle = commands.add_parser('idle', help="idle CPU of the old busy-wait main loop vs. the service runner's event wait")
+    idle.add_argument('--seconds', type=float, default=5)
+    idle.set_defaults(func=run_idle)
+
+    load = commands.add_parser('http', help="dashboard requests/sec under each serving mode")
+    load.add_argument('--servers', nargs='+', default=['dev', 'threads'], choices=('dev', 'threads', 'processes'))
+    load.add_argument('--paths', nargs='+', default=['/', '/users'])
+    load.add_argument('--containers', type=int, default=10000)
+    load.add_argument('--users', type=int, default=1000)
+    load.add_argument('--clients', type=int, default=8)
+    load.add_argument('--workers', type=int, default=4)
+    load.add_argument('--seconds', type=float, default=5)
+    load.add_argument('--port', type=int, default=5099)
+    load.set_defaults(func=run_http)
+
+    drain = commands.add_parser('outbox', help="kiosk outbox: offline queueing and QoS 1 flush against a stand-in broker")
+    drain.add_argument('--messages', type=int, default=5000)
+    drain.add_argument('--inflight', type=int, nargs='+', default=[1, 20, 100],
+                       help="max unacknowledged publishes, one run per value")
+    drain.set_defaults(func=run_outbox)
+
+    ingest_load = commands.add_parser('ingest', help="end-to-end scans/sec through a local broker per ingest worker count")
+    ingest_load.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    ingest_load.add_argument('--mode', choices=('threads', 'processes'), default='processes',
+                             help="--shards threads in one process, or --shard I/N processes")
+    ingest_load.add_argument('--containers', type=int, default=10000)
+    ingest_load.add_argument('--users', type=int, default=1000)
+    ingest_load.add_argument('--scans', type=int, default=10000)
+    ingest_load.add_argument('--kiosks', type=int, default=20)
+    ingest_load.add_argument('--broker-port', type=int, default=18830)
+    ingest_load.add_argument('--timeout', type=float, default=120)
+    ingest_load.set_defaults(func=run_ingest)
+
+    overhead = commands.add_parser('metrics', help="overhead of the metrics instrumentation on the scan path")
+    overhead.add_argument('--containers', type=int, default=10000)
+    overhead.add_argument('--users', type=int, default=1000)
+    overhead.add_argument('--scans', type=int, default=20000)
+    overhead.set_defaults(func=run_metrics)
+
+    suite = commands.add_parser('suite', help="scan path and dashboard routes at each database size: "
+                                             "throughput and p50/p99 latency")
+    suite.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                       help="containers to seed, one run per value")
+    suite.add_argument('--users', type=int, help="users to seed (default: same as containers)")
+    suite.add_argument('--scans', type=int, default=10000, help="scans per scan-path scenario")
+    suite.add_argument('--requests', type=int, default=200, help="requests per dashboard route")
+    suite.add_argument('--window', type=int, default=ingest.BATCH_SIZE,
+                       help="scans outstanding at once through on_message/on_command")
+    suite.add_argument('--seed', type=int, default=42, help="random seed for the workload")
+    suite.add_argument('--json', action='store_true', help="print one JSON document instead of a table")
+    suite.set_defaults(func=run_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
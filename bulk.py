@@ -0,0 +1,226 @@
+"""Streaming bulk import and export of users and containers.
+
+    python bulk.py import users users.csv
+    python bulk.py import containers containers.jsonl
+    python bulk.py export containers --format csv > containers.csv
+
+Input is parsed a line at a time and inserted in chunked transactions, so
+files of any size run in constant memory. CSV files need a header row with
+the column names below; JSONL files hold one object per line.
+"""
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+
+import paho.mqtt.publish as mqtt_publish
+
+import directory
+import live
+import storage
+
+
+CHUNK_SIZE = 500
+FORMATS = ('csv', 'jsonl')
+
+# Columns read on import, per table, in the order the storage layer takes them
+FIELDS = {
+    'users': ('name', 'badgeID'),
+    'containers': ('serial_number',),
+}
+
+# Containers are exported with the badge of whoever holds them
+EXPORT_FIELDS = {
+    'users': FIELDS['users'],
+    'containers': ('serial_number', 'badgeID'),
+}
+
+
+def read_records(stream, fmt):
+    """Yield (line number, dict or None, error or None) from a text stream."""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record, None
+        return
+
+    for line_no, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_no, None, f"invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield line_no, None, "expected a JSON object"
+            continue
+        yield line_no, record, None
+
+
+def _validate(records, fields):
+    """Turn records into (line, values) rows, reporting bad ones as errors."""
+    for line_no, record, error in records:
+        if error is None:
+            values = tuple(str(record.get(field) or '').strip() for field in fields)
+            missing = [field for field, value in zip(fields, values) if not value]
+            if missing:
+                error = f"missing {', '.join(missing)}"
+        if error:
+            yield line_no, None, error
+        else:
+            yield line_no, values, None
+
+
+def _keys(table, values):
+    if table == 'users':
+        return [('name', values[0]), ('badgeID', values[1])]
+    return [('serial_number', values[0])]
+
+
+def import_records(table, records, chunk_size=CHUNK_SIZE, on_error=None):
+    """Insert records into table in chunked transactions.
+
+    records is what read_records yields. Rows that are invalid, duplicate
+    an earlier row of the import, or already exist are skipped and passed
+    to on_error(line, message). Returns (inserted, skipped).
+    """
+    fields = FIELDS[table]
+    store = storage.get_store()
+    inserted = skipped = 0
+    rows = _validate(records, fields)
+
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        good = []
+        errors = []
+        for line_no, values, error in chunk:
+            if error:
+                errors.append((line_no, error))
+            else:
+                good.append((line_no, values))
+
+        if good:
+            with store.transaction():
+                taken = store.existing_keys(table, [values for _, values in good])
+                batch = []
+                for line_no, values in good:
+                    clashes = [f"{field} {value!r}" for field, value in _keys(table, values) if (field, value) in taken]
+                    if clashes:
+                        errors.append((line_no, f"{' and '.join(clashes)} already exists"))
+                        continue
+                    taken.update(_keys(table, values))
+                    batch.append(values)
+
+                # Anything skipped on conflict here was added concurrently
+                added = store.insert_rows(table, batch)
+                inserted += added
+                skipped += len(batch) - added
+
+        skipped += len(errors)
+        if on_error:
+            for line_no, error in sorted(errors):
+                on_error(line_no, error)
+
+    return inserted, skipped
+
+
+def import_stream(table, stream, fmt, chunk_size=CHUNK_SIZE):
+    """Import from a text stream and return a summary dict with per-row errors."""
+    errors = []
+    inserted, skipped = import_records(
+        table, read_records(stream, fmt), chunk_size,
+        on_error=lambda line, message: errors.append({'line': line, 'error': message}))
+    return {'inserted': inserted, 'skipped': skipped, 'errors': errors}
+
+
+def export_rows(table, fmt, batch_size=CHUNK_SIZE):
+    """Yield the table as CSV or JSONL text, a batch of rows at a time."""
+    fields = EXPORT_FIELDS[table]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+
+    if writer:
+        writer.writerow(fields)
+
+    for rows in storage.get_store().iter_export(table, batch_size):
+        if writer:
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(fields, row)), separators=(',', ':')))
+                buffer.write('\n')
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def announce_import(table, inserted, broker, port):
+    """Publish an import event for the rows the CLI added, so live screens
+    reload and kiosks are sent a new directory. Nothing else tells them."""
+    event = {'type': 'import', 'table': table, 'inserted': inserted}
+    try:
+        mqtt_publish.single(live.EVENTS_TOPIC, live.encode(event), qos=1, hostname=broker, port=port)
+    except OSError as e:
+        print(f"Could not announce the import on {broker}:{port}: {e}. Kiosks pick it up "
+              f"within {directory.REFRESH_INTERVAL // 60} minutes.", file=sys.stderr)
+
+
+def guess_format(filename, default='csv'):
+    if filename and filename.lower().endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    if filename and filename.lower().endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=storage.DB_URL, help="database file or postgresql:// URL")
+    parser.add_argument('--broker', default=os.environ.get('CONTAINER_TRACKING_BROKER', 'localhost'),
+                        help="MQTT broker to announce imports on")
+    parser.add_argument('--broker-port', type=int, default=int(os.environ.get('CONTAINER_TRACKING_BROKER_PORT', 1883)))
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('import', help="import rows from a CSV or JSONL file ('-' for stdin)")
+    load.add_argument('table', choices=sorted(FIELDS))
+    load.add_argument('file')
+    load.add_argument('--format', choices=FORMATS)
+    load.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+
+    dump = commands.add_parser('export', help="write a table to stdout")
+    dump.add_argument('table', choices=sorted(FIELDS))
+    dump.add_argument('--format', choices=FORMATS, default='csv')
+
+    args = parser.parse_args()
+    store = storage.configure(args.db)
+    store.create_database()
+
+    if args.command == 'export':
+        for chunk in export_rows(args.table, args.format):
+            sys.stdout.write(chunk)
+        return
+
+    fmt = args.format or guess_format(args.file)
+    stream = sys.stdin if args.file == '-' else open(args.file, newline='', encoding='utf-8-sig')
+    with stream:
+        inserted, skipped = import_records(
+            args.table, read_records(stream, fmt), args.chunk_size,
+            on_error=lambda line, message: print(f"line {line}: {message}", file=sys.stderr))
+    print(f"{inserted} {args.table} imported, {skipped} skipped.")
+    if inserted:
+        announce_import(args.table, inserted, args.broker, args.broker_port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Small thread-safe LRU map with hit/miss counters.
+
+    None is used to signal a miss, so it cannot be stored as a value.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+
+class TTLCache:
+    """Thread-safe map whose entries expire ttl seconds after they were
+    last put, bounded to maxsize entries.
+
+    Every entry lives for the same ttl, so insertion order is expiry
+    order: put() drops expired entries from the old end, and the oldest
+    entry is evicted early only when the map is full. Like LRUCache, None
+    signals a miss.
+    """
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        # key -> (expires, value)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                del self._data[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            now = self.clock()
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            while self._data:
+                oldest = next(iter(self._data.values()))
+                if oldest[0] > now:
+                    break
+                self._data.popitem(last=False)
+                self.expired += 1
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
@@ -4,12 +4,24 @@ from kivy.uix.label import Label
 from kivy.uix.button import Button
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.popup import Popup
+from kivy.uix.widget import Widget
 from kivy.clock import Clock
 import paho.mqtt.client as mqtt
 from kivy.uix.textinput import TextInput
 import socket
 import fcntl
 import struct
+import gc
+import logging
+import os
+import threading
+import time
+
+import log
+import protocol
+from directory import Directory
+import scanner
+from outbox import Outbox, OutboxPublisher
 
 
 # MQTT settings for local broker
@@ -17,6 +29,62 @@ BROKER = "localhost"
 PORT = 1883
 TOPIC = "container_tracking"
 
+# Sent with every scan so the server can record which kiosk it came from
+KIOSK_ID = socket.gethostname()
+COMMAND_TOPIC = protocol.command_topic(KIOSK_ID)
+RESULT_TOPIC = protocol.result_topic(KIOSK_ID)
+
+# Seconds to wait for the server's result before telling the user
+REPLY_TIMEOUT = 5
+
+# QoS 1 plus a persistent session: the broker holds results while we are
+# offline and our commands are retried until acknowledged
+QOS = 1
+CLIENT_ID = f"kiosk-{KIOSK_ID}"
+# Commands in flight at once while draining the outbox after a reconnect
+FLUSH_BATCH = 50
+
+# Seconds the success/error popup stays up, and until the screen resets
+FEEDBACK_SECONDS = 1
+RESET_SECONDS = 2
+
+# Set CONTAINER_TRACKING_KIOSK_STATS=1 to show frame times and the number of
+# live widgets, refreshed every STATS_INTERVAL seconds
+SHOW_STATS = os.environ.get('CONTAINER_TRACKING_KIOSK_STATS') == '1'
+STATS_INTERVAL = 2
+
+# Seconds between requests for a fresh directory snapshot while out of sync
+RESYNC_INTERVAL = 5
+
+# Serials listed in the session popup; the count covers the rest
+SESSION_SHOWN = 5
+# Containers named per outcome (checked out, not) under a session's result
+ITEMS_SHOWN = 3
+
+# Scanners to read directly, comma separated (see scanner.py), e.g.
+# /dev/input/event3 or /dev/ttyACM0. Without any, scans are typed into
+# the popups' hidden text inputs by a keyboard-wedge scanner.
+SCANNERS = [path for path in os.environ.get('CONTAINER_TRACKING_SCANNERS', '').split(',') if path]
+
+logger = logging.getLogger(__name__)
+
+def describe_items(items):
+    """Lines saying which of a session's containers were checked out and
+    why the others were not."""
+    def shown(values, separator):
+        more = len(values) - ITEMS_SHOWN
+        return separator.join(values[:ITEMS_SHOWN]) + (f"{separator}and {more} more" if more > 0 else "")
+
+    out = [str(item.get('serial')) for item in items if item.get('status') == 'ok']
+    failed = [str(item.get('msg')) for item in items if item.get('status') != 'ok']
+    lines = []
+    if out:
+        lines.append("Checked out: " + shown(out, ", "))
+    if failed:
+        lines.append("Not checked out: " + shown(failed, "; "))
+    return lines
+
+
 def get_ip_address(ifname: str) -> str:
     """Get the IP address associated with the given network interface (Linux only)."""
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -31,22 +99,97 @@ def get_ip_address(ifname: str) -> str:
 
 class MqttClient:
     def __init__(self, app):
-        self.client = mqtt.Client()
+        self.client = mqtt.Client(client_id=CLIENT_ID, clean_session=False)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
+        self.client.message_callback_add(RESULT_TOPIC, self.on_result)
+        self.client.message_callback_add(protocol.SNAPSHOT_TOPIC, self.on_snapshot)
+        self.client.message_callback_add(protocol.DELTA_TOPIC, self.on_delta)
+        self.client.max_inflight_messages_set(FLUSH_BATCH)
+        self.client.reconnect_delay_set(1, 30)
         self.app = app
-        self.client.connect(BROKER, PORT, 60)
-        self.client.subscribe(TOPIC)
+        # Request id -> op for requests still waiting on a result
+        self.pending = {}
+        # Valid badges and serials, for flagging unknown scans as they are made
+        self.directory = Directory()
+        self.resync_requested = 0
+        self.outbox = Outbox()
+        self.publisher = OutboxPublisher(self.client, self.outbox, QOS)
+        self.publisher.resend_stored()
+        # Retries in the background until the network and broker are up
+        self.client.connect_async(BROKER, PORT, 60)
         self.client.loop_start()
 
+    def on_connect(self, client, userdata, flags, rc):
+        # TOPIC still carries prompts from the server console
+        client.subscribe([(TOPIC, 0), (RESULT_TOPIC, QOS), (protocol.SNAPSHOT_TOPIC, QOS), (protocol.DELTA_TOPIC, QOS)])
+        self.app.post_update('online', True)
+
+    def on_disconnect(self, client, userdata, rc):
+        self.app.post_update('online', False)
+
     def on_message(self, client, userdata, msg):
-        instruction = msg.payload.decode('utf-8')
-        Clock.schedule_once(lambda dt: self.app.display_instruction(instruction))
+        self.app.post_update('instruction', msg.payload.decode('utf-8'))
+
+    def send(self, op, **fields):
+        """Queue a command in the outbox and publish it. Returns False if we
+        are offline; the command is then sent once the connection is back."""
+        request_id = protocol.new_id()
+        online = self.client.is_connected()
+        if online:
+            self.pending[request_id] = op
+            Clock.schedule_once(lambda dt: self.expire(request_id), REPLY_TIMEOUT)
+        self.publisher.publish(COMMAND_TOPIC, protocol.encode_command(op, request_id, **fields))
+        return online
+
+    def on_result(self, client, userdata, msg):
+        try:
+            result = protocol.decode_result(msg.payload)
+        except protocol.ProtocolError as e:
+            logger.warning("Ignoring malformed result: %s", e)
+            return
+        # Drop replies to requests that already timed out
+        if self.pending.pop(result['id'], None) is None:
+            return
+        self.app.post_update('result', result)
+
+    def on_snapshot(self, client, userdata, msg):
+        try:
+            snapshot = protocol.decode_snapshot(msg.payload)
+        except protocol.ProtocolError as e:
+            logger.warning("Ignoring malformed directory snapshot: %s", e)
+            return
+        if not self.directory.apply_snapshot(snapshot):
+            self.request_snapshot()
+
+    def on_delta(self, client, userdata, msg):
+        try:
+            delta = protocol.decode_delta(msg.payload)
+        except protocol.ProtocolError as e:
+            logger.warning("Ignoring malformed directory delta: %s", e)
+            return
+        if not self.directory.apply_delta(delta):
+            self.request_snapshot()
+
+    def request_snapshot(self):
+        # Scans are checked by the server alone until the snapshot arrives
+        now = time.monotonic()
+        if now - self.resync_requested >= RESYNC_INTERVAL:
+            self.resync_requested = now
+            self.client.publish(protocol.SNAPSHOT_REQUEST_TOPIC, KIOSK_ID)
+
+    def expire(self, request_id):
+        if self.pending.pop(request_id, None) is not None:
+            self.app.display_instruction("Error No response from server")
 
     def start(self):
         self.client.loop_start()
 
     def stop(self):
+        self.client.disconnect()
         self.client.loop_stop()
+        self.outbox.close()
 
 class MqttApp(App):
     def build(self):
@@ -70,6 +213,11 @@ class MqttApp(App):
         self.layout.add_widget(self.return_button)
         self.return_button.bind(on_press=self.return_mode)
 
+        # Action Button: one badge scan, then any number of containers
+        self.session_button = Button(text="Checkout Many", size_hint_y=None, height=50, background_color=(0.6, 0.4, 0.1, 1))
+        self.layout.add_widget(self.session_button)
+        self.session_button.bind(on_press=self.session_mode)
+
         # Placeholder for success/error feedback if we need it
         self.feedback_label = Label(text="", font_size=20, size_hint_y=None, height=40)
         self.layout.add_widget(self.feedback_label)
@@ -87,9 +235,79 @@ class MqttApp(App):
         )
         self.layout.add_widget(self.ip_label)
 
+        # Set in on_start when SCANNERS are read directly
+        self.scanner = None
+
+        # Popups are built once here and reused for every scan and message
+        self.build_feedback_popup()
+        self.build_checkout_popup()
+        self.build_return_popup()
+        self.build_session_popup()
+
+        # One trigger per timer: calling it again while it is pending does
+        # not add a second callback, and cancel() restarts the wait
+        self.dismiss_feedback = Clock.create_trigger(lambda dt: self.feedback_popup.dismiss(), FEEDBACK_SECONDS)
+        self.reset_trigger = Clock.create_trigger(lambda dt: self.reset_ui(), RESET_SECONDS)
+
+        # Messages from the MQTT thread, applied together on the next frame
+        self.updates = {}
+        self.updates_lock = threading.Lock()
+        self.merged_updates = 0
+        self.apply_updates_trigger = Clock.create_trigger(self.apply_updates)
+
+        if SHOW_STATS:
+            self.stats_label = Label(text="", font_size=14, size_hint_y=None, height=24, color=(0.5, 0.5, 0.5, 1))
+            self.layout.add_widget(self.stats_label)
+            self.frames = 0
+            self.frame_total = 0.0
+            self.frame_max = 0.0
+            Clock.schedule_interval(self.record_frame, 0)
+            Clock.schedule_interval(self.show_stats, STATS_INTERVAL)
 
         return self.layout
 
+    def post_update(self, kind, value):
+        """Hand a message from the MQTT thread to the UI. Everything that
+        arrives within one frame becomes a single update: the latest
+        connection state and the latest message, which would replace any
+        earlier one on screen anyway."""
+        with self.updates_lock:
+            if kind == 'online':
+                self.updates['online'] = value
+            else:
+                if 'display' in self.updates:
+                    self.merged_updates += 1
+                self.updates['display'] = (kind, value)
+        self.apply_updates_trigger()
+
+    def apply_updates(self, dt):
+        with self.updates_lock:
+            updates, self.updates = self.updates, {}
+        if 'online' in updates:
+            self.set_online(updates['online'])
+        if 'display' in updates:
+            kind, value = updates['display']
+            if kind == 'result':
+                self.display_result(value)
+            else:
+                self.display_instruction(value)
+
+    def record_frame(self, dt):
+        self.frames += 1
+        self.frame_total += dt
+        self.frame_max = max(self.frame_max, dt)
+
+    def show_stats(self, dt):
+        # Counted from the garbage collector so widgets that were dropped
+        # from the screen but never freed show up too
+        widgets = sum(1 for obj in gc.get_objects() if isinstance(obj, Widget))
+        average = self.frame_total / self.frames * 1000 if self.frames else 0
+        self.stats_label.text = (f"frame {average:.1f} ms avg, {self.frame_max * 1000:.1f} ms max | "
+                                 f"{widgets} widgets | {self.merged_updates} updates merged")
+        self.frames = 0
+        self.frame_total = 0.0
+        self.frame_max = 0.0
+
     def display_instruction(self, instruction):
         """Update the UI based on the received MQTT message"""
         if instruction == "return":
@@ -100,15 +318,48 @@ class MqttApp(App):
                 self.update_ui("Scan Badge", "Checkout", "Scan User Badge")
         elif "Success" in instruction:
             self.update_ui(instruction, "Success", "", success=True)
-            # one second reset
-            Clock.schedule_once(lambda dt: self.reset_ui(), 2)
+            self.restart(self.reset_trigger)
         elif "Error" in instruction:
             self.update_ui(instruction, "Error", "There was an error!", success=False)
-            # one second reset
-            Clock.schedule_once(lambda dt: self.reset_ui(), 2)
+            self.restart(self.reset_trigger)
         else:
             self.update_ui("Choose a Mode", "No action", "")
 
+    def restart(self, trigger):
+        """Start a trigger's wait over, so a newer message gets its full time."""
+        trigger.cancel()
+        trigger()
+
+    def set_online(self, online):
+        self.ip_label.color = (0.5, 0.5, 0.5, 1) if online else (0.8, 0.2, 0.2, 1)
+        queued = len(self.mqtt_client.outbox)
+        status = "online" if online else f"offline, {queued} scans queued" if queued else "offline"
+        self.ip_label.text = f"Device IP: {get_ip_address('wlan0')} ({status})"
+
+    def send_command(self, op, **fields):
+        if not self.mqtt_client.send(op, **fields):
+            self.display_instruction("Success Saved, will send when back online ")
+
+    def display_result(self, result):
+        """Show the server's answer to one of our requests."""
+        if result['status'] == 'ok':
+            self.display_instruction(f"Success {result['msg']} ")
+        elif result['status'] == 'partial':
+            # Some of a session's containers went out: neither a success
+            # nor a failure, and the user needs to see which
+            lines = describe_items(result.get('items', ()))
+            message = f"Partly done: {result['msg']}"
+            self.instruction_label.text = message
+            self.show_feedback_popup(partial=True, message="\n\n".join([message] + lines))
+            self.feedback_label.text = " | ".join(lines)
+            self.restart(self.reset_trigger)
+        else:
+            self.display_instruction(f"Error {result['msg']}")
+            # A session's result also says which containers failed
+            lines = describe_items(result.get('items', ()))
+            if lines:
+                self.feedback_label.text = " | ".join(lines)
+
     def update_ui(self, message, button_text, feedback_message, success=None):
         """Update UI elements based on instruction"""
         self.instruction_label.text = message
@@ -121,138 +372,295 @@ class MqttApp(App):
             self.show_feedback_popup(success=False, message=message)
         self.feedback_label.text = feedback_message
 
-    def show_feedback_popup(self, success=True, message="Success"):
-        """Show a fullscreen popup with success or error message that auto-dismisses after 1 second."""
+    def build_feedback_popup(self):
         popup_content = BoxLayout(orientation='vertical', padding=0, spacing=0)
-        
-        feedback_label = Label(text=message, font_size=30, color=(1, 1, 1, 1), size_hint=(1, 1))
-        popup_content.add_widget(feedback_label)
-        
-        feedback_popup = Popup(
+
+        self.feedback_popup_label = Label(text="", font_size=30, color=(1, 1, 1, 1), size_hint=(1, 1),
+                                          halign='center', valign='middle')
+        # Wrap long messages, such as a session's list of containers
+        self.feedback_popup_label.bind(size=lambda label, size: setattr(label, 'text_size', size))
+        popup_content.add_widget(self.feedback_popup_label)
+
+        self.feedback_popup = Popup(
             title="",  
             content=popup_content,
             size_hint=(1, 1),  
             auto_dismiss=False 
         )
-        
+        self.feedback_open = False
+        self.feedback_popup.bind(on_dismiss=self.on_feedback_dismiss)
+
+    def on_feedback_dismiss(self, popup):
+        self.feedback_open = False
+
+    def show_feedback_popup(self, success=True, message="Success", partial=False):
+        """Show a fullscreen popup with success or error message that auto-dismisses after 1 second."""
+        self.feedback_popup_label.text = message
+
         # Set background color 
-        if success:
-            feedback_popup.background_color = (0.2, 0.8, 0.2, 1)  # Green 
+        if partial:
+            self.feedback_popup.background_color = (0.9, 0.6, 0.1, 1)  # Amber
+        elif success:
+            self.feedback_popup.background_color = (0.2, 0.8, 0.2, 1)  # Green 
         else:
-            feedback_popup.background_color = (0.8, 0.2, 0.2, 1)  # Red
-        
-        # Show the popup
-        feedback_popup.open()
-        
-        # Dismiss the popup after 1 second
-        Clock.schedule_once(lambda dt: feedback_popup.dismiss(), 1)
+            self.feedback_popup.background_color = (0.8, 0.2, 0.2, 1)  # Red
+
+        # Already open for an earlier message: just show the new one longer
+        if not self.feedback_open:
+            self.feedback_open = True
+            self.feedback_popup.open()
+        self.restart(self.dismiss_feedback)
 
     def reset_ui(self):
         """Reset the UI to the default state after success or error"""
         self.update_ui("Select Mode", "No action", "")
 
-        
-    def checkout_mode(self, instance):
-        """Show a popup for scanning when the button is pressed"""
-        # Create a popup with a TextInput
+    def build_checkout_popup(self):
         popup_content = BoxLayout(orientation='vertical', padding=20)
         
         popup_title = Label(text="Checkout", font_size=40, size_hint_y=None, height=60)
         popup_content.add_widget(popup_title)
 
-        popup_header = Label(text="Scan Container", font_size=35, size_hint_y=None, height=50)
-        popup_content.add_widget(popup_header)
+        self.checkout_header = Label(text="Scan Container", font_size=35, size_hint_y=None, height=50)
+        popup_content.add_widget(self.checkout_header)
 
         # make input area invisable
-        input_text = TextInput(hint_text="Type here", multiline=False, opacity=0, height=0)
-        popup_content.add_widget(input_text)
-        badge_text = TextInput(hint_text="Type here", multiline=False, opacity=0, height=0)
-        popup_content.add_widget(badge_text)
+        self.checkout_serial = TextInput(hint_text="Type here", multiline=False, opacity=0, height=0)
+        popup_content.add_widget(self.checkout_serial)
+        self.checkout_badge = TextInput(hint_text="Type here", multiline=False, opacity=0, height=0)
+        popup_content.add_widget(self.checkout_badge)
 
         # hidden button
         submit_button = Button(opacity=0, text="", size_hint=(1, 0.25))
         popup_content.add_widget(submit_button)
 
-        popup = Popup(title="Input", content=popup_content, size_hint=(None, None), size=(400, 400))
+        self.checkout_popup = Popup(title="Input", content=popup_content, size_hint=(None, None), size=(400, 400))
+        # True from opening until the scan is submitted
+        self.checkout_active = False
 
         # When the submit button is pressed, publish the input as MQTT message
-        def on_submit(instance):
-            input_value = input_text.text.strip()
-            badge_value = badge_text.text.strip()
-            if input_value:
-                self.mqtt_client.client.publish(TOPIC, f"control:checkout:{input_value}:{badge_value}")
-            popup.dismiss()
-
-        submit_button.bind(on_press=on_submit)
-
-        def on_popup_open(popup_instance):
-            input_text.focus = True  # Focus on the input box after opening the popup
-
-        popup.bind(on_open=on_popup_open)
+        submit_button.bind(on_press=self.submit_checkout)
+        self.checkout_popup.bind(on_open=self.on_checkout_open)
+        self.checkout_serial.bind(focus=self.on_checkout_serial_focus)
+        self.checkout_badge.bind(focus=self.on_checkout_badge_focus)
 
-        def on_focus_change_input(instance, value):
-            if not value:  # If the input box loses focus
-                badge_text.focus = True
-                popup_header.text = "Scan Badge"
-
-        def on_focus_change_badge(instance, value):
-            if not value:  # If the badge box loses focus
-                on_submit(submit_button)  # Automatically call submit when focus is lost
-                
-        input_text.bind(focus=on_focus_change_input)
-        badge_text.bind(focus=on_focus_change_badge)
-
-        popup.open()
+    def checkout_mode(self, instance):
+        """Show the checkout popup for scanning when the button is pressed"""
+        self.checkout_popup.open()
+
+    def on_checkout_open(self, popup):
+        # Start each checkout from a clean popup
+        self.checkout_active = True
+        self.checkout_header.text = "Scan Container"
+        self.checkout_serial.text = ""
+        self.checkout_badge.text = ""
+        if self.scanner is None:
+            self.checkout_serial.focus = True  # Focus on the input box after opening the popup
+
+    def submit_checkout(self, instance=None):
+        if not self.checkout_active:
+            # Losing focus as the popup closes must not submit again
+            return
+        self.checkout_active = False
+        input_value = self.checkout_serial.text.strip()
+        badge_value = self.checkout_badge.text.strip()
+        if input_value and badge_value:
+            self.send_command('checkout', serial=input_value, badge=badge_value)
+        elif input_value:
+            self.display_instruction("Error No badge scanned")
+        self.checkout_popup.dismiss()
+
+    def on_checkout_serial_focus(self, instance, value):
+        if not value and self.checkout_active:  # If the input box loses focus
+            self.checkout_badge.focus = True
+            self.checkout_header.text = "Scan Badge"
+
+    def on_checkout_badge_focus(self, instance, value):
+        if not value:  # If the badge box loses focus
+            self.submit_checkout()  # Automatically call submit when focus is lost
 
     #Return screen, same logic as checkout with only needing container
-    def return_mode(self, instance):
-            """Show a popup for scanning when the button is pressed"""
-
-            popup_content = BoxLayout(orientation='vertical', padding=20)
-            
-            popup_title = Label(text="Return", font_size=40, size_hint_y=None, height=60)
-            popup_content.add_widget(popup_title)
-
-            popup_header = Label(text="Scan Container", font_size=30, size_hint_y=None, height=40)
-            popup_content.add_widget(popup_header)
-
-            input_text = TextInput(hint_text="Type here", multiline=False, opacity=0, height=0)
-            popup_content.add_widget(input_text)
-
-            submit_button = Button(opacity=0, text="", size_hint=(1, 0.25))
-            popup_content.add_widget(submit_button)
+    def build_return_popup(self):
+        popup_content = BoxLayout(orientation='vertical', padding=20)
 
-            popup = Popup(title="Input", content=popup_content, size_hint=(None, None), size=(400, 400))
+        popup_title = Label(text="Return", font_size=40, size_hint_y=None, height=60)
+        popup_content.add_widget(popup_title)
 
-            def on_submit(instance):
-                input_value = input_text.text.strip()
-                if input_value:
-                    self.mqtt_client.client.publish(TOPIC, f"control:return:{input_value}")
-                popup.dismiss()
+        popup_header = Label(text="Scan Container", font_size=30, size_hint_y=None, height=40)
+        popup_content.add_widget(popup_header)
 
-            submit_button.bind(on_press=on_submit)
+        self.return_serial = TextInput(hint_text="Type here", multiline=False, opacity=0, height=0)
+        popup_content.add_widget(self.return_serial)
 
-            def on_popup_open(popup_instance):
-                input_text.focus = True
+        submit_button = Button(opacity=0, text="", size_hint=(1, 0.25))
+        popup_content.add_widget(submit_button)
 
-            popup.bind(on_open=on_popup_open)
+        self.return_popup = Popup(title="Input", content=popup_content, size_hint=(None, None), size=(400, 400))
+        self.return_active = False
 
-            def on_focus_change_input(instance, value):
-                if not value:  
-                    on_submit(submit_button) 
+        submit_button.bind(on_press=self.submit_return)
+        self.return_popup.bind(on_open=self.on_return_open)
+        self.return_serial.bind(focus=self.on_return_serial_focus)
 
-            input_text.bind(focus=on_focus_change_input)
-            popup.open()
+    def return_mode(self, instance):
+        """Show the return popup for scanning when the button is pressed"""
+        self.return_popup.open()
+
+    def on_return_open(self, popup):
+        self.return_active = True
+        self.return_serial.text = ""
+        if self.scanner is None:
+            self.return_serial.focus = True
+
+    def submit_return(self, instance=None):
+        if not self.return_active:
+            return
+        self.return_active = False
+        input_value = self.return_serial.text.strip()
+        if input_value:
+            self.send_command('return', serial=input_value)
+        self.return_popup.dismiss()
+
+    def on_return_serial_focus(self, instance, value):
+        if not value:
+            self.submit_return()
+
+    # Checkout session: scan a badge once, then each container, then Done
+    def build_session_popup(self):
+        popup_content = BoxLayout(orientation='vertical', padding=20, spacing=10)
+
+        popup_title = Label(text="Checkout Many", font_size=40, size_hint_y=None, height=60)
+        popup_content.add_widget(popup_title)
 
+        self.session_header = Label(text="Scan Badge", font_size=30, size_hint_y=None, height=50)
+        popup_content.add_widget(self.session_header)
+
+        self.session_list = Label(text="", font_size=18, halign='center')
+        popup_content.add_widget(self.session_list)
+
+        # One hidden input for every code; Enter from the scanner keeps it
+        # focused for the next one
+        self.session_input = TextInput(hint_text="Type here", multiline=False, opacity=0, height=0,
+                                       text_validate_unfocus=False)
+        popup_content.add_widget(self.session_input)
+
+        buttons = BoxLayout(orientation='horizontal', size_hint_y=None, height=50, spacing=10)
+        cancel_button = Button(text="Cancel", background_color=(0.8, 0.2, 0.2, 1))
+        buttons.add_widget(cancel_button)
+        done_button = Button(text="Done", background_color=(0.2, 0.6, 0.2, 1))
+        buttons.add_widget(done_button)
+        popup_content.add_widget(buttons)
+
+        self.session_popup = Popup(title="Input", content=popup_content, size_hint=(None, None), size=(400, 500),
+                                   auto_dismiss=False)
+        self.session_active = False
+        self.session_badge = None
+        self.session_serials = []
+
+        cancel_button.bind(on_press=self.cancel_session)
+        done_button.bind(on_press=self.submit_session)
+        self.session_popup.bind(on_open=self.on_session_open)
+        self.session_input.bind(on_text_validate=self.on_session_input)
+
+    def session_mode(self, instance):
+        self.session_popup.open()
+
+    def on_session_open(self, popup):
+        self.session_active = True
+        self.session_badge = None
+        self.session_serials = []
+        self.session_header.text = "Scan Badge"
+        self.session_list.text = ""
+        self.session_input.text = ""
+        if self.scanner is None:
+            self.session_input.focus = True
+
+    def on_session_input(self, instance):
+        code = instance.text.strip()
+        instance.text = ""
+        if code:
+            self.on_session_code(code)
+
+    def on_session_code(self, code):
+        """A badge or container scanned during a session. Scanning the
+        badge again finishes the session, like pressing Done."""
+        directory = self.mqtt_client.directory
+        if self.session_badge is None:
+            self.session_badge = code
+            self.session_header.text = "Scan Containers"
+            self.show_session(f"Badge {code}" + self.check_directory(directory.check_badge(code)))
+        elif code == self.session_badge:
+            self.submit_session()
+        elif code in self.session_serials:
+            self.show_session(f"{code} already scanned")
+        elif len(self.session_serials) >= protocol.MAX_BATCH:
+            self.show_session(f"At most {protocol.MAX_BATCH} containers, press Done")
+        else:
+            self.session_serials.append(code)
+            self.show_session(code + self.check_directory(directory.check_serial(code)))
+
+    def check_directory(self, error):
+        """A note for a scan the directory does not know. The scan is sent
+        anyway: our copy can lag behind changes nobody announced, or whose
+        event was lost, so only the server can turn it away."""
+        return "" if error is None else " (not in directory yet)"
+
+    def show_session(self, note):
+        recent = self.session_serials[-SESSION_SHOWN:]
+        more = len(self.session_serials) - len(recent)
+        lines = [note, f"{len(self.session_serials)} containers"]
+        lines += ([f"... {more} more"] if more else []) + recent
+        self.session_list.text = "\n".join(lines)
+
+    def submit_session(self, instance=None):
+        if not self.session_active:
+            return
+        self.session_active = False
+        if self.session_badge and self.session_serials:
+            self.send_command('checkout_batch', badge=self.session_badge, serials=self.session_serials)
+        elif self.session_badge is None:
+            self.display_instruction("Error No badge scanned")
+        self.session_popup.dismiss()
+
+    def cancel_session(self, instance=None):
+        self.session_active = False
+        self.session_popup.dismiss()
+
+    def on_scan(self, code):
+        """A code from a directly read scanner: fills the open popup the
+        way typing into its hidden inputs would."""
+        if self.checkout_active:
+            if not self.checkout_serial.text:
+                self.checkout_serial.text = code
+                self.checkout_header.text = "Scan Badge"
+            else:
+                self.checkout_badge.text = code
+                self.submit_checkout()
+        elif self.return_active:
+            self.return_serial.text = code
+            self.submit_return()
+        elif self.session_active:
+            self.on_session_code(code)
+        else:
+            self.display_instruction("Choose a Mode")
 
     def on_stop(self):
         """Stop MQTT client when the app is closed"""
+        if self.scanner is not None:
+            self.scanner.stop()
         self.mqtt_client.stop()
 
     def on_start(self):
         """Start MQTT client when the app starts"""
         self.mqtt_client = MqttClient(self)
         self.mqtt_client.start()
+        if SCANNERS:
+            sources = [scanner.open_source(path, gap=scanner.GAP) for path in SCANNERS]
+            # Runs on the reader's thread; every scan is handled, none merged
+            self.scanner = scanner.ScannerReader(
+                sources, lambda code, source: Clock.schedule_once(lambda dt: self.on_scan(code)))
+            self.scanner.start()
 
 if __name__ == '__main__':
+    log.setup()
     MqttApp().run()
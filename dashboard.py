@@ -0,0 +1,394 @@
+"""Flask dashboard and HTTP API.
+
+The app is built by create_app() so importing this module (or main.py) has
+no side effects. Serve it with one of the servers from make_server(), or
+under any WSGI server, e.g.:
+
+    gunicorn -k gthread -w 4 --threads 17 -b 0.0.0.0:5000 'dashboard:create_app()'
+
+Each open /stream screen holds a server thread for as long as it is open,
+so the threaded servers get MAX_STREAMS threads for screens on top of the
+ones for other requests, and screens past MAX_STREAMS are turned away.
+Use a threaded worker class under gunicorn: a sync worker would spend
+itself on one screen and be killed at the worker timeout.
+"""
+import io
+import json
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from flask import Blueprint, Flask, Response, g, render_template, request, redirect, url_for, jsonify, stream_with_context, abort
+
+import bulk
+import live
+import log
+import main
+import metrics
+import storage
+from cache import LRUCache
+
+
+HOST = "0.0.0.0"
+PORT = 5000
+WORKERS = 4
+SERVERS = ('dev', 'threads', 'processes')
+RESPONSE_CACHE_SIZE = 256
+# Live screens served at once, per process
+MAX_STREAMS = 16
+
+bp = Blueprint('dashboard', __name__)
+
+
+def create_app(connect_mqtt=True):
+    """Build the dashboard app.
+
+    With connect_mqtt the process gets its own MQTT connection for the
+    messages add_user/add_container publish; pass False when the app runs
+    inside the ingest process, which already has one.
+    """
+    log.setup()
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    if connect_mqtt:
+        main.start_mqtt_publisher()
+    return app
+
+
+class _WaitressServer:
+    def __init__(self, app, host, port, workers):
+        from waitress.server import create_server
+        self.server = create_server(app, host=host, port=port, threads=workers + MAX_STREAMS)
+
+    def serve_forever(self):
+        self.server.run()
+
+    def shutdown(self):
+        self.server.close()
+
+
+class _GunicornServer:
+    """Runs the app in a separate pre-forked gunicorn process pool."""
+
+    def __init__(self, app, host, port, workers):
+        # Threaded workers: a stream ties up a thread, not the whole
+        # process, and the worker heartbeat keeps running while it is open
+        self.command = [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+                        '--worker-class', 'gthread', '--threads', str(1 + MAX_STREAMS),
+                        '--bind', f'{host}:{port}', 'dashboard:create_app()']
+        self.process = None
+
+    def serve_forever(self):
+        self.process = subprocess.Popen(self.command)
+        self.process.wait()
+
+    def shutdown(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def make_server(app, server='dev', host=HOST, port=PORT, workers=WORKERS):
+    """Return a server with serve_forever() and shutdown().
+
+    'dev' is the single process Werkzeug server. 'threads' serves from a
+    waitress thread pool of `workers` threads and 'processes' runs `workers`
+    gunicorn processes, which need waitress or gunicorn installed. Both
+    get MAX_STREAMS more threads for live screens.
+    """
+    if server == 'threads':
+        return _WaitressServer(app, host, port, workers)
+    if server == 'processes':
+        return _GunicornServer(app, host, port, workers)
+    from werkzeug.serving import make_server as make_dev_server
+    return make_dev_server(host, port, app, threaded=True)
+
+
+PAGE_SIZE = 50
+
+@bp.route('/', methods=['GET'])
+def index():
+    search = request.args.get('q', '').strip()
+    users_after = request.args.get('users_after', 0, type=int)
+    containers_after = request.args.get('containers_after', 0, type=int)
+
+    # One extra row tells us whether there is a next page
+    store = storage.get_store()
+    users = store.users_page(users_after, PAGE_SIZE + 1, search)
+    containers = store.containers_page(containers_after, PAGE_SIZE + 1, search)
+    checked_out, available = store.container_counts()
+
+    return render_template(
+        'index.html',
+        users=users[:PAGE_SIZE],
+        containers=containers[:PAGE_SIZE],
+        users_next=users[PAGE_SIZE - 1][0] if len(users) > PAGE_SIZE else None,
+        containers_next=containers[PAGE_SIZE - 1][0] if len(containers) > PAGE_SIZE else None,
+        users_after=users_after,
+        containers_after=containers_after,
+        search=search,
+        checked_out=checked_out,
+        available=available
+    )
+
+
+
+def back_to_index():
+    # Background submits from the page get their update over /stream
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return '', 204
+    return redirect(url_for('dashboard.index'))
+
+@bp.route('/add_user', methods=['POST'])
+def add_user_route():
+    name = request.form['name']
+    badgeID = request.form['badgeID']
+    main.add_user(name, badgeID)
+    return back_to_index()
+
+@bp.route('/delete_user/<int:user_id>', methods=['POST'])
+def delete_user(user_id):
+    main.delete_user(user_id)
+    return back_to_index()
+
+@bp.route('/add_container', methods=['POST'])
+def add_container_route():
+    serial = request.form['serial_number']
+    main.add_container(serial)
+    return back_to_index()
+
+@bp.route('/delete_container/<int:container_id>', methods=['POST'])
+def delete_container(container_id):
+    main.delete_container(container_id)
+    return back_to_index()
+
+@bp.route('/users', methods=['GET'])
+def get_users_with_containers():
+    """All users with their checked out containers.
+
+    Pass ?stream=1 to have the array written out as rows are read instead
+    of being built in memory first.
+    """
+    if request.args.get('stream'):
+        return Response(stream_with_context(stream_users_json()), mimetype='application/json')
+
+    return cached_json(users_json)
+
+# Rendered API bodies keyed by endpoint and the query args it reads, each
+# tagged with the data version it was built from
+response_cache = LRUCache(RESPONSE_CACHE_SIZE)
+
+metrics.registry.gauge('container_tracking_response_cache', "API response cache counters.",
+                       lambda: {(key,): value for key, value in response_cache.stats().items()}, ('field',))
+# Taken by each open /stream, so screens cannot use up every server thread
+stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+metrics.registry.gauge('container_tracking_live_screens', "Dashboards connected to /stream.",
+                       lambda: HeldStream.open)
+
+def users_json():
+    return '[' + ','.join(storage.get_store().iter_users_json()) + ']'
+
+def cached_json(build, args=()):
+    """Serve build()'s JSON text with a data-version ETag.
+
+    Answers 304 when the client already has the current version, and reuses
+    the body rendered for this endpoint until the next write bumps the
+    version. args names the query args build() reads; any others are
+    ignored, so junk query strings share the one cached body.
+    """
+    key = (request.endpoint,) + tuple(request.args.get(arg, '').strip() for arg in args)
+    store = storage.get_store()
+    with store.snapshot():
+        version = store.data_version()
+        etag = f'v{version}'
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            cached = response_cache.get(key)
+            if cached is not None and cached[0] == version:
+                body = cached[1]
+            else:
+                body = build()
+                response_cache.put(key, (version, body))
+            response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # Clients may keep the body but must revalidate before using it
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@bp.route('/api/v1/users', methods=['GET'])
+def api_users():
+    """Every user with the serials they hold."""
+    return cached_json(users_json)
+
+@bp.route('/api/v1/containers', methods=['GET'])
+def api_containers():
+    """Every container with the name of whoever holds it."""
+    return cached_json(lambda: json.dumps(
+        [{'id': id, 'serial_number': serial, 'holder': holder}
+         for id, serial, holder in storage.get_store().iter_containers_with_holder()],
+        separators=(',', ':')))
+
+@bp.route('/api/v1/counts', methods=['GET'])
+def api_counts():
+    def build():
+        checked_out, available = storage.get_store().container_counts()
+        return json.dumps({'checked_out': checked_out, 'available': available}, separators=(',', ':'))
+    return cached_json(build)
+
+@bp.route('/stream', methods=['GET'])
+def stream():
+    """Server-sent events for live dashboard updates.
+
+    Each open screen holds one server thread; past MAX_STREAMS of them the
+    answer is 503 and the page tries again later.
+    """
+    if not stream_slots.acquire(blocking=False):
+        return Response("Too many live screens", status=503, headers={'Retry-After': '30'})
+    return Response(HeldStream(live.sse_stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+class HeldStream:
+    """A response body holding a stream slot until the server closes it,
+    which it does even when the client left before the first event."""
+
+    open = 0
+    _lock = threading.Lock()
+
+    def __init__(self, events):
+        self.events = events
+        self.closed = False
+        with self._lock:
+            HeldStream.open += 1
+
+    def __iter__(self):
+        return self.events
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            HeldStream.open -= 1
+        self.events.close()
+        stream_slots.release()
+
+@bp.before_app_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@bp.after_app_request
+def record_latency(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        metrics.http_request_seconds.observe(time.perf_counter() - start, request.endpoint or 'unmatched',
+                                             request.method, str(response.status_code))
+    return response
+
+@bp.route('/metrics', methods=['GET'])
+def metrics_route():
+    """Prometheus scrape endpoint."""
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+@bp.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        'pipeline': main.pipeline.metrics(),
+        'cache': dict(storage.get_store().cache_stats(), responses=response_cache.stats()),
+        'live_screens': len(live.broker),
+        'requests': main.recent_requests.stats(),
+        'scans': main.recent_scans.stats(),
+    })
+
+def parse_time(value):
+    """Accept unix seconds or an ISO 8601 timestamp."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+@bp.route('/history', methods=['GET'])
+def get_history():
+    """Checkout/return events, newest first.
+
+    Filter with ?serial=, ?badge=, ?since= and ?until=. Follow the returned
+    'next' cursor with ?cursor= to page back in time.
+    """
+    limit = request.args.get('limit', 100, type=int)
+    if limit < 1:
+        # LIMIT -1 would mean no limit at all to SQLite
+        return jsonify({'error': "limit must be at least 1"}), 400
+    limit = min(limit, 1000)
+    before_id = request.args.get('cursor', type=int)
+    try:
+        since = parse_time(request.args.get('since'))
+        until = parse_time(request.args.get('until'))
+    except ValueError:
+        return jsonify({'error': "since/until must be unix seconds or ISO 8601"}), 400
+
+    events = storage.get_store().history(request.args.get('serial'), request.args.get('badge'),
+                              since, until, before_id, limit)
+    for event in events:
+        event['time'] = datetime.fromtimestamp(event['created_at'], timezone.utc).isoformat()
+    next_cursor = events[-1]['id'] if len(events) == limit else None
+    return jsonify({'events': events, 'next': next_cursor})
+
+@bp.route('/import/<table>', methods=['POST'])
+def import_route(table):
+    """Bulk import users or containers from CSV or JSONL.
+
+    Send the file as the request body (text/csv or application/x-ndjson) or
+    as a multipart 'file' upload. ?format= overrides the detected format.
+    """
+    if table not in bulk.FIELDS:
+        abort(404)
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files['file']
+        raw, fmt = upload.stream, bulk.guess_format(upload.filename)
+    else:
+        raw, fmt = request.stream, 'jsonl' if 'json' in request.mimetype else 'csv'
+    fmt = request.args.get('format', fmt)
+    if fmt not in bulk.FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(bulk.FORMATS)}"}), 400
+
+    stream = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+    summary = bulk.import_stream(table, stream, fmt)
+    if summary['inserted']:
+        main.publish_event({'type': 'import', 'table': table, 'inserted': summary['inserted']})
+    return jsonify(summary)
+
+@bp.route('/export/<table>', methods=['GET'])
+def export_route(table):
+    if table not in bulk.FIELDS:
+        abort(404)
+    fmt = request.args.get('format', 'csv')
+    if fmt not in bulk.FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(bulk.FORMATS)}"}), 400
+
+    return Response(
+        stream_with_context(bulk.export_rows(table, fmt)),
+        mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename={table}.{fmt}'}
+    )
+
+@bp.route('/users/<int:user_id>/containers', methods=['GET'])
+def get_user_containers(user_id):
+    return jsonify(storage.get_store().user_containers(user_id))
+
+def stream_users_json(chunk_size=200):
+    chunk = []
+    separator = '['
+    for user in storage.get_store().iter_users_json():
+        chunk.append(separator)
+        chunk.append(user)
+        separator = ','
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append('[]' if separator == '[' else ']')
+    yield ''.join(chunk)
@@ -0,0 +1,637 @@
+import os
+import sqlite3
+import threading
+import queue
+import time
+from contextlib import contextmanager
+
+import metrics
+import migrations
+from cache import LRUCache
+
+
+DB_PATH = os.environ.get('CONTAINER_TRACKING_DB', 'container_tracking.db')
+POOL_SIZE = 8
+# Seconds to wait for a free pooled connection before giving up
+POOL_TIMEOUT = 30
+USER_CACHE_SIZE = 10000
+CONTAINER_CACHE_SIZE = 50000
+
+# Record every checkout and return in the events table
+HISTORY = True
+
+# Applied to every pooled connection when it is opened
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+    # Off by default in SQLite; deleting a user releases their containers
+    "PRAGMA foreign_keys=ON",
+)
+
+# Statements are kept as module constants so each connection's statement
+# cache hands back the already prepared statement on every call
+SQL_CONTAINER_BY_SERIAL = "SELECT id, serial_number, user_id FROM containers WHERE serial_number=?"
+SQL_USER_BY_NAME_OR_BADGE = "SELECT id FROM users WHERE name=? OR badgeID=?"
+SQL_INSERT_CONTAINER = "INSERT INTO containers (serial_number) VALUES (?)"
+SQL_INSERT_USER = "INSERT INTO users (name, badgeID) VALUES (?, ?)"
+
+SQL_CONTAINER_ID_BY_SERIAL = "SELECT id FROM containers WHERE serial_number=?"
+SQL_USER_BY_BADGE = "SELECT id, name FROM users WHERE badgeID=?"
+
+# Assigns only when the container is free and the user still exists, so the
+# common case is decided and applied by this one statement. The ids come
+# from the lookup caches, so the serial and badge they were cached for are
+# matched too: another process may have deleted either row and SQLite may
+# have given its id to a new one.
+SQL_CHECKOUT = """
+    UPDATE containers SET user_id = ?
+    WHERE id = ? AND serial_number = ? AND user_id IS NULL
+      AND EXISTS (SELECT 1 FROM users WHERE id = ? AND badgeID = ?)
+    RETURNING id"""
+
+# Only run when SQL_CHECKOUT changed nothing, to say why
+SQL_CHECKOUT_CONFLICT = """
+    SELECT containers.user_id, holder.name, (SELECT id FROM users WHERE id = ? AND badgeID = ?)
+    FROM containers
+    LEFT JOIN users AS holder ON holder.id = containers.user_id
+    WHERE containers.id = ? AND containers.serial_number = ?"""
+
+SQL_RETURN = "UPDATE containers SET user_id=NULL WHERE id=?"
+
+SQL_EVENT_CHECKOUT = """
+    INSERT INTO events (container_id, user_id, action, source, created_at)
+    VALUES (?, ?, 'checkout', ?, ?)"""
+
+SQL_EVENT_RETURN = """
+    INSERT INTO events (container_id, user_id, action, source, created_at)
+    VALUES (?, ?, 'return', ?, ?)"""
+
+SQL_HOLDER = """
+    SELECT containers.user_id, users.name
+    FROM containers LEFT JOIN users ON users.id = containers.user_id
+    WHERE containers.id = ? AND containers.serial_number = ?"""
+SQL_DELETE_USER = "DELETE FROM users WHERE id=? RETURNING badgeID"
+SQL_DELETE_CONTAINER = "DELETE FROM containers WHERE id=? RETURNING serial_number, user_id"
+
+# One row per user, already serialized by SQLite, with the serials of the
+# containers they hold folded in by the GROUP BY. Read a page at a time
+# after the last id seen, so a download never holds a pooled connection
+# while the client reads.
+SQL_USERS_JSON = """
+    SELECT users.id,
+           json_object('id', users.id, 'name', users.name, 'badgeID', users.badgeID,
+                       'containers', json_group_array(containers.serial_number)
+                                     FILTER (WHERE containers.serial_number IS NOT NULL))
+    FROM users
+    LEFT JOIN containers ON containers.user_id = users.id
+    WHERE users.id > ?
+    GROUP BY users.id
+    ORDER BY users.id
+    LIMIT ?"""
+
+SQL_CONTAINER_COUNTS = "SELECT COUNT(user_id), COUNT(*) - COUNT(user_id) FROM containers"
+
+SQL_DATA_VERSION = "SELECT value FROM meta WHERE key = 'data_version'"
+
+SQL_USER_CONTAINERS = "SELECT serial_number FROM containers WHERE user_id=? ORDER BY serial_number"
+
+SQL_CONTAINERS_WITH_HOLDER = """
+    SELECT containers.id, containers.serial_number, users.name
+    FROM containers
+    LEFT JOIN users ON users.id = containers.user_id
+    ORDER BY containers.id"""
+
+SQL_USERS = "SELECT id, name, badgeID FROM users ORDER BY id"
+
+# Bulk import and export, per table. Import rows are in the column order
+# listed here; anything that would break a UNIQUE constraint is skipped.
+SQL_IMPORT = {
+    'users': "INSERT INTO users (name, badgeID) VALUES (?, ?) ON CONFLICT DO NOTHING",
+    'containers': "INSERT INTO containers (serial_number) VALUES (?) ON CONFLICT DO NOTHING",
+}
+
+# Exports go a page at a time after the id in the first column
+SQL_EXPORT_PAGE = {
+    'users': "SELECT id, name, badgeID FROM users WHERE id > ? ORDER BY id LIMIT ?",
+    'containers': """
+        SELECT containers.id, containers.serial_number, users.badgeID
+        FROM containers LEFT JOIN users ON users.id = containers.user_id
+        WHERE containers.id > ?
+        ORDER BY containers.id
+        LIMIT ?""",
+}
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of SQLite connections.
+
+    A thread holds at most one connection at a time; nested calls from the
+    same thread (e.g. a route calling add_user) reuse it instead of taking a
+    second one from the pool.
+    """
+
+    def __init__(self, path=DB_PATH, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._slots = threading.BoundedSemaphore(size)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all = []
+        self._closed = False
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        with self._lock:
+            self._all.append(conn)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the current thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise RuntimeError(f"No free database connection after {self.timeout}s")
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._open()
+        except Exception:
+            self._slots.release()
+            raise
+
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+            self._slots.release()
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """Borrow a connection and commit on success, roll back on error.
+
+        immediate takes the write lock up front, for transactions that read
+        a row and then write based on what they read.
+        """
+        with self.connection() as conn:
+            if immediate and not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            if getattr(self._local, 'in_transaction', False):
+                # Nested: the outermost transaction commits
+                yield conn
+                return
+            self._local.in_transaction = True
+            start = time.perf_counter()
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self._local.in_transaction = False
+                metrics.transaction_seconds.observe(time.perf_counter() - start, 'sqlite')
+
+    @contextmanager
+    def snapshot(self):
+        """Borrow a connection inside a read transaction, so every query in
+        the block sees the database as of the same moment."""
+        with self.connection() as conn:
+            if conn.in_transaction:
+                yield conn
+                return
+            conn.execute("BEGIN")
+            try:
+                yield conn
+            finally:
+                conn.rollback()
+
+    def close(self):
+        """Close every connection the pool has opened."""
+        self._closed = True
+        with self._lock:
+            conns, self._all = self._all, []
+        for conn in conns:
+            conn.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Scans resolve badge -> (user id, name) and serial -> container id from
+# these; every write that adds or removes a user or container invalidates
+# the affected key
+user_cache = LRUCache(USER_CACHE_SIZE)
+container_cache = LRUCache(CONTAINER_CACHE_SIZE)
+
+
+def configure(path=DB_PATH, size=POOL_SIZE):
+    """Point the shared pool at a database file, replacing any existing pool."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = ConnectionPool(path, size)
+    clear_caches()
+    return _pool
+
+
+def get_pool():
+    """Return the shared pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+def connection():
+    return get_pool().connection()
+
+
+def transaction(immediate=False):
+    return get_pool().transaction(immediate)
+
+
+def snapshot():
+    return get_pool().snapshot()
+
+
+def close():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def clear_caches():
+    user_cache.clear()
+    container_cache.clear()
+
+
+def cache_stats():
+    return {'users': user_cache.stats(), 'containers': container_cache.stats()}
+
+
+def _lookup_user(conn, badgeID):
+    user = user_cache.get(badgeID)
+    if user is None:
+        user = conn.execute(SQL_USER_BY_BADGE, (badgeID,)).fetchone()
+        if user is not None:
+            user_cache.put(badgeID, user)
+    return user
+
+
+def _lookup_container(conn, serial_number):
+    container_id = container_cache.get(serial_number)
+    if container_id is None:
+        row = conn.execute(SQL_CONTAINER_ID_BY_SERIAL, (serial_number,)).fetchone()
+        if row is not None:
+            container_id = row[0]
+            container_cache.put(serial_number, container_id)
+    return container_id
+
+
+def create_database():
+    """Create the database, or upgrade an existing file to the current schema."""
+    migrations.migrate(get_pool().path)
+
+
+def add_container(serial_number):
+    """Insert a container. Returns its id, or None if the serial is taken."""
+    with transaction() as conn:
+        if conn.execute(SQL_CONTAINER_BY_SERIAL, (serial_number,)).fetchone():
+            return None
+        container_id = conn.execute(SQL_INSERT_CONTAINER, (serial_number,)).lastrowid
+    container_cache.invalidate(serial_number)
+    return container_id
+
+
+def add_user(name, badgeID):
+    """Insert a user. Returns their id, or None if the name or badge is taken."""
+    with transaction() as conn:
+        if conn.execute(SQL_USER_BY_NAME_OR_BADGE, (name, badgeID)).fetchone():
+            return None
+        user_id = conn.execute(SQL_INSERT_USER, (name, badgeID)).lastrowid
+    user_cache.invalidate(badgeID)
+    return user_id
+
+
+def delete_user(user_id):
+    """Delete a user. Returns (badgeID, serials of the containers the delete
+    released), or None if there was no such user."""
+    with transaction() as conn:
+        serials = [row[0] for row in conn.execute(SQL_USER_CONTAINERS, (user_id,))]
+        row = conn.execute(SQL_DELETE_USER, (user_id,)).fetchone()
+    if row:
+        user_cache.invalidate(row[0])
+        return row[0], serials
+    return None
+
+
+def delete_container(container_id):
+    """Delete a container. Returns (serial_number, user_id) or None."""
+    with transaction() as conn:
+        row = conn.execute(SQL_DELETE_CONTAINER, (container_id,)).fetchone()
+    if row:
+        container_cache.invalidate(row[0])
+    return row
+
+
+def checkout_container(container_serial, user_badgeID, source=None):
+    """Assign a free container to a user in one atomic statement.
+
+    The container and user are resolved through the lookup caches, so a scan
+    of known identities costs a single UPDATE (plus the history insert).
+    Returns a (status, name) tuple: 'ok' with the user's name, 'conflict'
+    with the name of the user already holding the container, 'no_container'
+    or 'no_user'.
+    """
+    with transaction() as conn:
+        return _checkout(conn, container_serial, user_badgeID, source)
+
+
+def checkout_containers(container_serials, user_badgeID, source=None):
+    """Assign several containers to one user in a single transaction.
+
+    Returns a (status, name) tuple per serial, in order, with the same
+    meanings as checkout_container(); a serial listed twice is a conflict
+    with the user the first one went to.
+    """
+    with transaction(immediate=True) as conn:
+        return [_checkout(conn, container_serial, user_badgeID, source) for container_serial in container_serials]
+
+
+def _checkout(conn, container_serial, user_badgeID, source):
+    # A cached id that no longer matches its serial or badge was deleted
+    # by another process; the second pass looks both up afresh
+    for attempt in range(2):
+        container_id = _lookup_container(conn, container_serial)
+        if container_id is None:
+            return 'no_container', None
+        user = _lookup_user(conn, user_badgeID)
+        if user is None:
+            return 'no_user', None
+
+        if conn.execute(SQL_CHECKOUT, (user[0], container_id, container_serial, user[0], user_badgeID)).fetchone():
+            if HISTORY:
+                conn.execute(SQL_EVENT_CHECKOUT, (container_id, user[0], source, time.time()))
+            return 'ok', user[1]
+
+        row = conn.execute(SQL_CHECKOUT_CONFLICT, (user[0], user_badgeID, container_id, container_serial)).fetchone()
+        if row is not None and row[2] is not None:
+            return 'conflict', row[1]
+        container_cache.invalidate(container_serial)
+        user_cache.invalidate(user_badgeID)
+    # Both rows were read in this transaction on the second pass
+    raise RuntimeError(f"checkout of {container_serial} by {user_badgeID} did not settle")
+
+
+def return_container(container_serial, source=None):
+    """Unassign a container.
+
+    Returns a (status, name) tuple: 'ok' with the name of the user who
+    held it (None if it was not checked out), or 'no_container'.
+    """
+    with transaction(immediate=True) as conn:
+        for attempt in range(2):
+            container_id = _lookup_container(conn, container_serial)
+            if container_id is None:
+                return 'no_container', None
+            holder = conn.execute(SQL_HOLDER, (container_id, container_serial)).fetchone()
+            if holder is not None:
+                break
+            # Deleted by another process after we cached it, and perhaps
+            # re-added under a new id
+            container_cache.invalidate(container_serial)
+        else:
+            return 'no_container', None
+        if holder[0] is None:
+            return 'ok', None
+
+        conn.execute(SQL_RETURN, (container_id,))
+        if HISTORY:
+            conn.execute(SQL_EVENT_RETURN, (container_id, holder[0], source, time.time()))
+        return 'ok', holder[1]
+
+
+def _iter_pages(sql, batch_size):
+    """Yield lists of rows, batch_size at a time, with the id in the first
+    column dropped. The connection goes back to the pool between pages."""
+    after_id = 0
+    while True:
+        with connection() as conn:
+            rows = conn.execute(sql, (after_id, batch_size)).fetchall()
+        if not rows:
+            break
+        after_id = rows[-1][0]
+        yield [row[1:] for row in rows]
+        if len(rows) < batch_size:
+            break
+
+
+def iter_users_json(batch_size=500):
+    """Yield each user with their container serials as a JSON object string."""
+    for rows in _iter_pages(SQL_USERS_JSON, batch_size):
+        for row in rows:
+            yield row[0]
+
+
+def iter_users():
+    """Yield (id, name, badgeID) for every user."""
+    with connection() as conn:
+        yield from conn.execute(SQL_USERS)
+
+
+def iter_containers_with_holder():
+    """Yield (id, serial_number, holder name or None) for every container."""
+    with connection() as conn:
+        yield from conn.execute(SQL_CONTAINERS_WITH_HOLDER)
+
+
+def _prefix_range(search):
+    """Bounds for an index-friendly prefix match: col >= low AND col < high."""
+    return search, search + '\U0010ffff'
+
+
+def data_version():
+    """Counter bumped by triggers on every users/containers change."""
+    with connection() as conn:
+        return conn.execute(SQL_DATA_VERSION).fetchone()[0]
+
+
+def container_counts():
+    """Return (checked_out, available) from a single pass over containers."""
+    with connection() as conn:
+        return conn.execute(SQL_CONTAINER_COUNTS).fetchone()
+
+
+def users_page_query(after_id=0, limit=50, search=None):
+    """SQL and parameters for users_page."""
+    sql = ["SELECT users.id, users.name, users.badgeID,",
+           "       (SELECT COUNT(*) FROM containers WHERE containers.user_id = users.id)",
+           "FROM users WHERE users.id > ?"]
+    params = [after_id]
+    if search:
+        low, high = _prefix_range(search)
+        sql.append("AND ((users.name >= ? AND users.name < ?) OR (users.badgeID >= ? AND users.badgeID < ?))")
+        params += [low, high, low, high]
+    sql.append("ORDER BY users.id LIMIT ?")
+    params.append(limit)
+    return '\n'.join(sql), params
+
+
+def users_page(after_id=0, limit=50, search=None):
+    """One page of (id, name, badgeID, container_count) rows ordered by id.
+
+    Keyset paginated: pass the last id of the previous page as after_id.
+    search matches a prefix of the name or badge ID.
+    """
+    with connection() as conn:
+        return conn.execute(*users_page_query(after_id, limit, search)).fetchall()
+
+
+def containers_page_query(after_id=0, limit=50, search=None):
+    """SQL and parameters for containers_page."""
+    sql = ["SELECT containers.id, containers.serial_number, users.name",
+           "FROM containers LEFT JOIN users ON users.id = containers.user_id",
+           "WHERE containers.id > ?"]
+    params = [after_id]
+    if search:
+        sql.append("AND containers.serial_number >= ? AND containers.serial_number < ?")
+        params += list(_prefix_range(search))
+    sql.append("ORDER BY containers.id LIMIT ?")
+    params.append(limit)
+    return '\n'.join(sql), params
+
+
+def containers_page(after_id=0, limit=50, search=None):
+    """One page of (id, serial_number, holder name) rows ordered by id.
+
+    Keyset paginated like users_page; search matches a serial prefix.
+    """
+    with connection() as conn:
+        return conn.execute(*containers_page_query(after_id, limit, search)).fetchall()
+
+
+def user_containers(user_id):
+    """Serial numbers of the containers a user holds."""
+    with connection() as conn:
+        return [row[0] for row in conn.execute(SQL_USER_CONTAINERS, (user_id,))]
+
+
+def history(container_serial=None, user_badgeID=None, since=None, until=None, before_id=None, limit=100):
+    """Page through checkout/return events, newest first.
+
+    Filters by container serial, user badge and a [since, until) range of
+    unix timestamps. before_id is the id of the last event of the previous
+    page. Returns a list of dicts.
+    """
+    with connection() as conn:
+        container_id = user_id = None
+        if container_serial is not None:
+            container_id = _lookup_container(conn, container_serial)
+            if container_id is None:
+                return []
+        if user_badgeID is not None:
+            user = _lookup_user(conn, user_badgeID)
+            if user is None:
+                return []
+            user_id = user[0]
+
+        sql, params = history_query(container_id, user_id, since, until, before_id, limit)
+        return history_rows(conn.execute(sql, params))
+
+
+def history_query(container_id=None, user_id=None, since=None, until=None, before_id=None, limit=100):
+    """SQL and parameters for history, with the container and user resolved to ids."""
+    where = []
+    params = []
+    if container_id is not None:
+        where.append("events.container_id = ?")
+        params.append(container_id)
+    if user_id is not None:
+        where.append("events.user_id = ?")
+        params.append(user_id)
+    if since is not None:
+        where.append("events.created_at >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("events.created_at < ?")
+        params.append(until)
+    if before_id is not None:
+        where.append("events.id < ?")
+        params.append(before_id)
+
+    sql = """
+        SELECT events.id, containers.serial_number, users.name, users.badgeID,
+               events.action, events.source, events.created_at
+        FROM events
+        LEFT JOIN containers ON containers.id = events.container_id
+        LEFT JOIN users ON users.id = events.user_id"""
+    if where:
+        sql += "\nWHERE " + " AND ".join(where)
+    sql += "\nORDER BY events.id DESC LIMIT ?"
+    params.append(limit)
+    return sql, params
+
+
+def history_rows(rows):
+    return [
+        {'id': row[0], 'serial_number': row[1], 'user': row[2], 'badgeID': row[3],
+         'action': row[4], 'source': row[5], 'created_at': row[6]}
+        for row in rows
+    ]
+
+
+def existing_keys(table, rows):
+    """Return the unique values in rows (tuples in SQL_IMPORT column order)
+    that are already taken, as a set of (column, value) pairs."""
+    with connection() as conn:
+        if table == 'users':
+            names = [values[0] for values in rows]
+            badges = [values[1] for values in rows]
+            sql = (f"SELECT name, badgeID FROM users WHERE name IN ({','.join('?' * len(names))}) "
+                   f"OR badgeID IN ({','.join('?' * len(badges))})")
+            found = set()
+            for name, badge in conn.execute(sql, names + badges):
+                found.add(('name', name))
+                found.add(('badgeID', badge))
+            return found
+
+        serials = [values[0] for values in rows]
+        sql = f"SELECT serial_number FROM containers WHERE serial_number IN ({','.join('?' * len(serials))})"
+        return {('serial_number', row[0]) for row in conn.execute(sql, serials)}
+
+
+def insert_rows(table, rows):
+    """Insert rows, skipping conflicts. Returns how many were inserted."""
+    if not rows:
+        return 0
+    with transaction() as conn:
+        # rowcount, unlike total_changes, leaves out the version triggers
+        return conn.executemany(SQL_IMPORT[table], rows).rowcount
+
+
+def iter_export(table, batch_size=500):
+    """Yield lists of export rows for table, batch_size at a time."""
+    yield from _iter_pages(SQL_EXPORT_PAGE[table], batch_size)
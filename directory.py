@@ -0,0 +1,252 @@
+"""Valid badges and container serials, replicated from the server to kiosks.
+
+The ingest service runs a DirectoryPublisher, which keeps a retained
+snapshot on protocol.SNAPSHOT_TOPIC and publishes a delta for each batch of
+users and containers added or deleted. Kiosks keep a Directory built from
+these and flag unknown badges and serials as they are scanned into a
+session. Every scan still goes to the server, which has the final say:
+the directory can lag behind, and one that has not seen a snapshot, or
+has missed a delta, answers nothing.
+"""
+import logging
+import queue
+import threading
+import time
+import uuid
+
+import live
+import protocol
+import storage
+
+
+# Changes arriving this close together go out as one delta (seconds)
+DELTA_WAIT = 0.05
+# The retained snapshot, which kiosks get when they connect, is rewritten
+# at most this often while changes keep coming
+SNAPSHOT_INTERVAL = 5
+# Reread everything from the database this often, to pick up changes made
+# without an event (direct edits) or whose event was lost
+REFRESH_INTERVAL = 600
+# Deltas a kiosk holds on to while it waits for a snapshot
+BUFFERED_DELTAS = 1000
+
+logger = logging.getLogger(__name__)
+
+_WAKE = object()
+_STOP = object()
+
+
+class Directory:
+    """A kiosk's copy of the directory. Updated from the MQTT thread and
+    read from the UI thread."""
+
+    def __init__(self):
+        self.epoch = None
+        self.version = 0
+        self.badges = set()
+        self.serials = set()
+        self.in_sync = False
+        self._buffered = []
+        self._lock = threading.Lock()
+
+    def apply_snapshot(self, snapshot):
+        """Replace the directory, then replay deltas that arrived while we
+        waited. Returns whether we are now in sync."""
+        with self._lock:
+            if self.in_sync and snapshot['epoch'] == self.epoch and snapshot['version'] <= self.version:
+                return True
+            self.epoch = snapshot['epoch']
+            self.version = snapshot['version']
+            self.badges = set(snapshot['badges'])
+            self.serials = set(snapshot['serials'])
+            self.in_sync = True
+            buffered, self._buffered = self._buffered, []
+            for delta in sorted(buffered, key=lambda delta: delta['version']):
+                if delta['epoch'] == self.epoch and delta['version'] > self.version:
+                    self._apply(delta)
+            return self.in_sync
+
+    def apply_delta(self, delta):
+        """Returns False when a delta was missed and a snapshot is needed."""
+        with self._lock:
+            if not self.in_sync:
+                if len(self._buffered) < BUFFERED_DELTAS:
+                    self._buffered.append(delta)
+                return False
+            return self._apply(delta)
+
+    def _apply(self, delta):
+        if delta['epoch'] == self.epoch and delta['version'] <= self.version:
+            # Seen already
+            return True
+        if delta['epoch'] != self.epoch or delta['version'] != self.version + 1:
+            self.in_sync = False
+            self._buffered = [delta]
+            return False
+        for current, changes in ((self.badges, delta['badges']), (self.serials, delta['serials'])):
+            current.difference_update(changes['remove'])
+            current.update(changes['add'])
+        self.version = delta['version']
+        return True
+
+    def check_serial(self, serial):
+        """The server's likely error message for a code we do not know, or
+        None if it is known (or we cannot tell). Only a hint: changes made
+        without an event reach us at the next refresh."""
+        if self.in_sync and serial not in self.serials:
+            return f"Container {serial} does not exist"
+        return None
+
+    def check_badge(self, badge):
+        if self.in_sync and badge not in self.badges:
+            return f"User with badge ID {badge} does not exist"
+        return None
+
+
+class DirectoryPublisher:
+    """Publishes the directory from the server, following the same events
+    as the live dashboards.
+
+    Changes made in other processes reach it over live.EVENTS_TOPIC, so
+    only one publisher should run against a database.
+    """
+
+    def __init__(self, client, qos=1):
+        self.client = client
+        self.qos = qos
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.badges = set()
+        self.serials = set()
+        self.deltas = 0
+        self.snapshots = 0
+        self._snapshot_requested = False
+        self._subscriber = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            # Subscribe before loading, so no change falls in between
+            self._subscriber = live.broker.subscribe()
+            self._thread = threading.Thread(target=self._run, name="directory", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        if self._thread is not None:
+            self._subscriber.queue.put(_STOP)
+            self._thread.join(timeout)
+            live.broker.unsubscribe(self._subscriber)
+            self._thread = None
+
+    def on_request(self, client, userdata, msg):
+        """A kiosk missed a delta."""
+        self._snapshot_requested = True
+        try:
+            self._subscriber.queue.put_nowait(_WAKE)
+        except queue.Full:
+            # Already busy; the flag is seen on the next pass
+            pass
+
+    def _run(self):
+        self._reload()
+        self._publish_snapshot()
+        last_snapshot = last_refresh = time.monotonic()
+        dirty = False
+        stopping = False
+        while not stopping:
+            events, stopping = self._next_events()
+            badges = {'add': set(), 'remove': set()}
+            serials = {'add': set(), 'remove': set()}
+            reload = self._subscriber.overflowed
+            for event in events:
+                kind = event.get('type')
+                if kind == 'user_added':
+                    self._change(badges, 'add', event['badgeID'])
+                elif kind == 'user_deleted':
+                    self._change(badges, 'remove', event['badgeID'])
+                elif kind == 'container_added':
+                    self._change(serials, 'add', event['serial'])
+                elif kind == 'container_deleted':
+                    self._change(serials, 'remove', event['serial'])
+                elif kind == 'import':
+                    reload = True
+
+            now = time.monotonic()
+            if reload or now - last_refresh >= REFRESH_INTERVAL:
+                self._subscriber.overflowed = False
+                last_refresh = now
+                if self._reload():
+                    # Kiosks replace their copy with the new snapshot
+                    self._snapshot_requested = True
+            elif any(badges.values()) or any(serials.values()):
+                self._publish_delta(badges, serials)
+                dirty = True
+
+            if self._snapshot_requested or (dirty and now - last_snapshot >= SNAPSHOT_INTERVAL):
+                self._snapshot_requested = False
+                self._publish_snapshot()
+                last_snapshot = now
+                dirty = False
+
+    def _next_events(self):
+        """Block for the next event, then take whatever else arrives within
+        DELTA_WAIT. Returns (events, stopping)."""
+        events = []
+        try:
+            first = self._subscriber.queue.get(timeout=SNAPSHOT_INTERVAL)
+        except queue.Empty:
+            return events, False
+        deadline = time.monotonic() + DELTA_WAIT
+        item = first
+        while True:
+            if item is _STOP:
+                return events, True
+            if item is not _WAKE:
+                events.append(item)
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._subscriber.queue.get(timeout=remaining) if remaining > 0 else self._subscriber.queue.get_nowait()
+            except queue.Empty:
+                return events, False
+
+    @staticmethod
+    def _change(changes, change, value):
+        # Net effect of the batch: a badge deleted and added again is added
+        undo = 'remove' if change == 'add' else 'add'
+        changes[undo].discard(value)
+        changes[change].add(value)
+
+    def _reload(self):
+        """Reread the directory from the database; returns whether it changed."""
+        store = storage.get_store()
+        badges = {badge for _, _, badge in store.iter_users() if badge is not None}
+        serials = {serial for _, serial, _ in store.iter_containers_with_holder() if serial is not None}
+        if badges == self.badges and serials == self.serials:
+            return False
+        self.badges = badges
+        self.serials = serials
+        self.version += 1
+        return True
+
+    def _publish_delta(self, badges, serials):
+        self.badges.difference_update(badges['remove'])
+        self.badges.update(badges['add'])
+        self.serials.difference_update(serials['remove'])
+        self.serials.update(serials['add'])
+        self.version += 1
+        self.deltas += 1
+        self.client.publish(protocol.DELTA_TOPIC, protocol.encode_delta(
+            self.epoch, self.version,
+            {change: sorted(values) for change, values in badges.items()},
+            {change: sorted(values) for change, values in serials.items()}), qos=self.qos)
+
+    def _publish_snapshot(self):
+        self.snapshots += 1
+        logger.info("Publishing directory snapshot %s/%d: %d badges, %d serials.",
+                    self.epoch, self.version, len(self.badges), len(self.serials))
+        self.client.publish(protocol.SNAPSHOT_TOPIC, protocol.encode_snapshot(
+            self.epoch, self.version, self.badges, self.serials), qos=self.qos, retain=True)
+
+    def metrics(self):
+        return {'version': self.version, 'badges': len(self.badges), 'serials': len(self.serials),
+                'deltas': self.deltas, 'snapshots': self.snapshots}
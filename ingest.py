@@ -0,0 +1,191 @@
+import logging
+import queue
+import threading
+import time
+import zlib
+
+import storage
+
+
+BATCH_SIZE = 50
+BATCH_WAIT = 0.02  # seconds
+
+_STOP = object()
+
+logger = logging.getLogger(__name__)
+
+
+def partition(serial, count):
+    """Stable partition of a container serial in range(count).
+
+    Every command for a container lands in the same partition, so they are
+    applied in the order they arrived.
+    """
+    return zlib.crc32(serial.encode()) % count
+
+
+class ScanPipeline:
+    """Queue of scan commands between the MQTT network thread and SQLite.
+
+    on_message only parses and calls submit(). A worker thread drains the
+    queue and applies up to batch_size commands, or whatever arrived within
+    batch_wait of the first one, in a single transaction. Results are
+    reported only after that transaction commits.
+
+    apply(command) runs one command against the database and returns its
+    result; report(command, result) publishes it. A command that fails
+    even when applied on its own is reported with result None.
+    """
+
+    def __init__(self, apply, report, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT, name="scan-pipeline"):
+        self.apply = apply
+        self.report = report
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+
+        self.commands = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Apply everything already queued, then stop the worker."""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def drain(self):
+        """Apply, on the caller's thread, whatever was submitted after stop()."""
+        commands = []
+        while True:
+            try:
+                command = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if command is not _STOP:
+                commands.append(command)
+        for start in range(0, len(commands), self.batch_size):
+            self._process(commands[start:start + self.batch_size])
+
+    def submit(self, command):
+        self._queue.put(command)
+
+    def metrics(self):
+        return {
+            'queue_depth': self._queue.qsize(),
+            'commands': self.commands,
+            'batches': self.batches,
+            'failed_batches': self.failed_batches,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size,
+            'avg_batch_size': self.commands / self.batches if self.batches else 0.0,
+        }
+
+    def _next_batch(self):
+        """Block for one command, then collect more until the batch is full
+        or batch_wait has passed. Returns (batch, stop_requested)."""
+        first = self._queue.get()
+        if first is _STOP:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                command = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if command is _STOP:
+                return batch, True
+            batch.append(command)
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                self._process(batch)
+
+    def _process(self, batch):
+        store = storage.get_store()
+        try:
+            # Take the write lock up front: with other shards or processes
+            # writing, upgrading a read transaction later can fail outright
+            with store.transaction(immediate=True):
+                results = [self.apply(command) for command in batch]
+        except Exception as e:
+            # One bad command must not sink the rest, so retry them singly
+            logger.warning("Batch of %d failed (%s), applying individually.", len(batch), e)
+            self.failed_batches += 1
+            results = []
+            for command in batch:
+                try:
+                    with store.transaction(immediate=True):
+                        results.append(self.apply(command))
+                except Exception as e:
+                    logger.exception("Error applying %s: %s", command, e)
+                    results.append(None)
+
+        self.batches += 1
+        self.commands += len(batch)
+        self.last_batch_size = len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+
+        for command, result in zip(batch, results):
+            try:
+                self.report(command, result)
+            except Exception as e:
+                logger.exception("Error reporting %s: %s", command, e)
+
+
+class ShardedPipeline:
+    """Several ScanPipelines, each with its own worker thread, with commands
+    routed by a hash of command[1]: the container serial, or the badge of a
+    checkout session.
+
+    When processes already split serials with partition(serial, stride),
+    pass the same stride so the hash bits used here are independent of
+    that split.
+    """
+
+    def __init__(self, apply, report, shards, stride=1, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT):
+        self.stride = stride
+        self.shards = [ScanPipeline(apply, report, batch_size, batch_wait, f"scan-pipeline-{i}")
+                       for i in range(shards)]
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+
+    def stop(self, timeout=None):
+        for shard in self.shards:
+            shard.stop(timeout)
+
+    def drain(self):
+        for shard in self.shards:
+            shard.drain()
+
+    def submit(self, command):
+        index = zlib.crc32(command[1].encode()) // self.stride % len(self.shards)
+        self.shards[index].submit(command)
+
+    def metrics(self):
+        shards = [shard.metrics() for shard in self.shards]
+        total = {key: sum(m[key] for m in shards)
+                 for key in ('queue_depth', 'commands', 'batches', 'failed_batches')}
+        total['max_batch_size'] = max(m['max_batch_size'] for m in shards)
+        total['avg_batch_size'] = total['commands'] / total['batches'] if total['batches'] else 0.0
+        total['shards'] = shards
+        return total
@@ -1,4 +1,3 @@
-import sqlite3
 from kivy.app import App
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.label import Label
@@ -7,52 +6,27 @@ from kivy.uix.button import Button
 from kivy.uix.popup import Popup
 from kivy.uix.scrollview import ScrollView
 
-# SQLite database setup (same as before)
+import storage
+
+# Database setup (shared with main.py; SQLite or PostgreSQL per storage.py)
 def create_database():
-    conn = sqlite3.connect('container_tracking.db')
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS containers (
-                        id INTEGER PRIMARY KEY,
-                        serial_number TEXT UNIQUE,
-                        user_id INTEGER,
-                        FOREIGN KEY (user_id) REFERENCES users(id))''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                        id INTEGER PRIMARY KEY,
-                        name TEXT UNIQUE,
-                        badgeID TEXT UNIQUE)''')
-    conn.commit()
-    conn.close()
+    storage.get_store().create_database()
 
 # Database functions
 def checkout_container(container_serial, user_badgeID):
-    conn = sqlite3.connect('container_tracking.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM containers WHERE serial_number=?", (container_serial,))
-    container = cursor.fetchone()
-    if not container:
+    status, name = storage.get_store().checkout_container(container_serial, user_badgeID, "kivy_app")
+    if status == 'no_container':
         return f"Container {container_serial} does not exist."
-
-    cursor.execute("SELECT * FROM users WHERE badgeID=?", (user_badgeID,))
-    user = cursor.fetchone()
-    if not user:
+    if status == 'no_user':
         return f"User with badge ID {user_badgeID} does not exist."
-
-    cursor.execute("UPDATE containers SET user_id=? WHERE serial_number=?", (user[0], container_serial))
-    conn.commit()
-    conn.close()
-    return f"Container {container_serial} checked out to {user[1]} (Badge ID: {user_badgeID})."
+    if status == 'conflict':
+        return f"Container {container_serial} is already checked out to {name or 'another user'}."
+    return f"Container {container_serial} checked out to {name} (Badge ID: {user_badgeID})."
 
 def return_container(container_serial):
-    conn = sqlite3.connect('container_tracking.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM containers WHERE serial_number=?", (container_serial,))
-    container = cursor.fetchone()
-    if not container:
+    status, _ = storage.get_store().return_container(container_serial, "kivy_app")
+    if status == 'no_container':
         return f"Container {container_serial} does not exist."
-
-    cursor.execute("UPDATE containers SET user_id=NULL WHERE serial_number=?", (container_serial,))
-    conn.commit()
-    conn.close()
     return f"Container {container_serial} returned and unassigned from user."
 
 # Kivy UI
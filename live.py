@@ -0,0 +1,92 @@
+"""Fan-out of data change events to live dashboard screens.
+
+Events are small dicts with a 'type' ('checkout', 'return',
+'container_added', 'container_deleted', 'user_added', 'user_deleted',
+'import') and the fields a screen needs to patch itself; 'user_deleted'
+carries the serials its delete released. The process that makes a change
+publishes the event locally and on EVENTS_TOPIC, so dashboards running in
+other processes can relay it to their own screens.
+"""
+import json
+import queue
+import threading
+import uuid
+
+
+EVENTS_TOPIC = "container_tracking/events"
+QUEUE_SIZE = 1000
+
+# Lets a process ignore its own events when they come back over MQTT
+ORIGIN = uuid.uuid4().hex
+
+
+class Subscriber:
+    def __init__(self, size=QUEUE_SIZE):
+        self.queue = queue.Queue(size)
+        # Set when events were dropped; the screen must reload to catch up
+        self.overflowed = False
+
+
+class EventBroker:
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        subscriber = Subscriber()
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(event)
+            except queue.Full:
+                subscriber.overflowed = True
+
+    def __len__(self):
+        return len(self._subscribers)
+
+
+broker = EventBroker()
+
+
+def encode(event):
+    return json.dumps(dict(event, origin=ORIGIN), separators=(',', ':'))
+
+
+def on_mqtt_event(client, userdata, msg):
+    """Relay events published by other processes to local screens."""
+    try:
+        event = json.loads(msg.payload)
+    except ValueError:
+        return
+    if event.pop('origin', None) != ORIGIN:
+        broker.publish(event)
+
+
+def sse_stream(keepalive=15):
+    """Yield server-sent events for one screen until it disconnects."""
+    subscriber = broker.subscribe()
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            if subscriber.overflowed:
+                yield 'data: {"type":"resync"}\n\n'
+                return
+            try:
+                event = subscriber.queue.get(timeout=keepalive)
+            except queue.Empty:
+                # Comment line, keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                continue
+            yield f"data: {json.dumps(event, separators=(',', ':'))}\n\n"
+    finally:
+        broker.unsubscribe(subscriber)
@@ -0,0 +1,123 @@
+"""JSON logging that never blocks the thread that logs.
+
+setup() points the root logger at a queue; a listener thread formats the
+records and writes them out, so a slow console or journal delays the log,
+not the scan. Records are formatted on the listener thread too, so a
+message's %-style arguments cost nothing until then.
+
+Each line is one JSON object with ts, level, logger and msg, plus any
+fields passed with extra=. High-volume messages can pass
+extra=log.SAMPLED (or {'sample': N, ...}) to keep only every Nth of them;
+the kept ones carry "sample": N so counts can be scaled back up.
+
+The level comes from CONTAINER_TRACKING_LOG_LEVEL (default INFO).
+"""
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+
+LEVEL = os.environ.get('CONTAINER_TRACKING_LOG_LEVEL', 'INFO').upper()
+
+# Records waiting for the listener. When it falls this far behind, new
+# records are dropped (and counted) rather than making the caller wait.
+QUEUE_SIZE = 10000
+
+# Default 1-in-N rate for sampled messages
+SAMPLE = 100
+SAMPLED = {'sample': SAMPLE}
+
+# Attributes every LogRecord has; anything else came from extra=
+_STANDARD = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'sample'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                  .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD:
+                entry[key] = value
+        if getattr(record, 'sample', 1) > 1:
+            entry['sample'] = record.sample
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SampleFilter(logging.Filter):
+    """Keep every Nth record of each message that asks to be sampled."""
+
+    def __init__(self):
+        super().__init__()
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        every = getattr(record, 'sample', 1)
+        if every <= 1:
+            return True
+        # Keyed by the unformatted message, so each call site counts alone
+        key = (record.name, record.msg)
+        with self._lock:
+            seen = self._seen.get(key, 0)
+            self._seen[key] = seen + 1
+        return seen % every == 0
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The record is only read by our own listener thread, so skip the
+        # stock handler's formatting and copying on the caller's thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+handler = None
+_listener = None
+
+
+def setup(level=None, stream=None):
+    """Send all logging through the queue. Safe to call more than once;
+    only the first call configures anything."""
+    global handler, _listener
+    if handler is not None:
+        return handler
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter())
+    log_queue = queue.Queue(QUEUE_SIZE)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(SampleFilter())
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level or LEVEL)
+    _listener = logging.handlers.QueueListener(log_queue, output)
+    _listener.start()
+    # Flush what is still queued on a normal exit
+    atexit.register(_listener.stop)
+    return handler
+
+
+def dropped():
+    """Records dropped because the queue was full."""
+    return handler.dropped if handler is not None else 0
@@ -1,163 +1,394 @@
-import sqlite3
 import paho.mqtt.client as mqtt
-from flask import Flask, render_template, request, redirect, url_for, jsonify
+import argparse
+import logging
+import os
 import threading
 
+import storage
+import directory
+import ingest
+import live
+import log
+import metrics
+from cache import LRUCache, TTLCache
+import protocol
+import service
+
 
 # MQTT settings for local broker
-BROKER = "localhost"  
-PORT = 1883 
+BROKER = os.environ.get('CONTAINER_TRACKING_BROKER', "localhost")
+PORT = int(os.environ.get('CONTAINER_TRACKING_BROKER_PORT', 1883))
 TOPIC = "container_tracking"
 FEED = "container_controls"
 
+# Kiosk commands and their results use QoS 1. The ingest client keeps a
+# persistent session so the broker queues commands while it is down.
+QOS = 1
+CLIENT_ID = "container-tracking-ingest"
+
+# Recently seen (kiosk, request id) pairs. QoS 1 and the kiosk outbox can
+# deliver a command twice; repeats are answered from here, not re-applied.
+REQUEST_CACHE_SIZE = 10000
+
+# A scan repeating the latest command for its serial (same kiosk, op and
+# badge) within this many seconds is a duplicate: a scanner firing twice or
+# a kiosk retrying. It gets the first scan's result without touching the
+# database. Any other command for the serial ends the window.
+DEDUPE_WINDOW = 2.0
+DEDUPE_SIZE = 10000
+
+# Seconds shutdown waits for the broker to take the results still queued
+# in the client (paho holds back all but a few unacknowledged ones)
+RESULT_FLUSH_TIMEOUT = 10
+
+# 'ingest' handles MQTT scans, 'dashboard' serves the web app
+ROLES = ('all', 'ingest', 'dashboard')
+
 mqttMode = False
 
 # MQTT client setup
 mqtt_client = mqtt.Client()
 
-def create_database():
-    """Create the database and tables."""
-    conn = sqlite3.connect('container_tracking.db')
-    cursor = conn.cursor()
+dashboard_server = None
+
+# The most recent result published; results go out in order, so once it
+# is acknowledged so are all the others
+last_result = None
 
-    # Containers
-    cursor.execute('''CREATE TABLE IF NOT EXISTS containers (
-                        id INTEGER PRIMARY KEY,
-                        serial_number TEXT UNIQUE,
-                        user_id INTEGER,
-                        FOREIGN KEY (user_id) REFERENCES users(id))''')
+recent_requests = LRUCache(REQUEST_CACHE_SIZE)
+_IN_PROGRESS = object()
 
-    # Users
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                        id INTEGER PRIMARY KEY,
-                        name TEXT UNIQUE,
-                        badgeID TEXT UNIQUE)''')
+# serial -> ((kiosk, op, badge), state), where state is the list of
+# requests waiting on a scan still being applied, or its result
+recent_scans = TTLCache(DEDUPE_SIZE, DEDUPE_WINDOW)
+# queued command -> that same waiting list. The window can expire, or be
+# taken by another command, while a scan is queued; its waiters are still
+# found from here when it is done.
+_waiting = {}
+_scans_lock = threading.Lock()
 
-    conn.commit()
-    conn.close()
+# What a kiosk is told when its scan could not be applied at all
+FAILED_MESSAGE = "Scan failed, please try again"
+# ...and when it sends a checkout session to a sharded server
+SESSIONS_OFF_MESSAGE = "Checkout sessions are not available, scan containers one at a time"
+# Store operation behind each queued command, for metrics labels
+OPERATIONS = {'checkout': 'checkout_container', 'return': 'return_container',
+              'checkout_batch': 'checkout_containers'}
+
+logger = logging.getLogger(__name__)
+
+def create_database():
+    """Create the database and tables."""
+    storage.get_store().create_database()
 
 def add_container(serial_number):
     """Add a new container to the database."""
-    conn = sqlite3.connect('container_tracking.db')
-    cursor = conn.cursor()
-    
-    # Already exists
-    cursor.execute("SELECT * FROM containers WHERE serial_number=?", (serial_number,))
-    if cursor.fetchone():
-        print(f"Container {serial_number} already exists.")
+    container_id = storage.get_store().add_container(serial_number)
+    if container_id is None:
+        metrics.operation_errors.inc('add_container', 'already_exists')
+        logger.info("Container %s already exists.", serial_number, extra={'serial': serial_number})
         publish_instruction(f"Error Container {serial_number} already exists")
     else:
-        cursor.execute("INSERT INTO containers (serial_number) VALUES (?)", (serial_number,))
-        conn.commit()
-        print(f"Container {serial_number} added.")
+        logger.info("Container %s added.", serial_number, extra={'serial': serial_number})
         publish_instruction(f"Container {serial_number} added successfully ")
-    
-    conn.close()
+        publish_event({'type': 'container_added', 'id': container_id, 'serial': serial_number})
 
 def add_user(name, badgeID):
     """Add a new user to the database."""
-    conn = sqlite3.connect('container_tracking.db')
-    cursor = conn.cursor()
-    
-    # Already exists
-    cursor.execute("SELECT * FROM users WHERE name=? OR badgeID=?", (name, badgeID))
-    if cursor.fetchone():
-        print(f"User {name} with badge ID {badgeID} already exists.")
+    user_id = storage.get_store().add_user(name, badgeID)
+    if user_id is None:
+        metrics.operation_errors.inc('add_user', 'already_exists')
+        logger.info("User %s with badge ID %s already exists.", name, badgeID, extra={'badge': badgeID})
         publish_instruction(f"Error User {name} with badge ID {badgeID} already exists")
     else:
-        cursor.execute("INSERT INTO users (name, badgeID) VALUES (?, ?)", (name, badgeID))
-        conn.commit()
-        print(f"User {name} with badge ID {badgeID} added.")
+        logger.info("User %s with badge ID %s added.", name, badgeID, extra={'badge': badgeID})
         publish_instruction(f"User {name} with Badge ID {badgeID} added successfully ")
-    
-    conn.close()
-
-def checkout_container(container_serial, user_badgeID):
-    """Checkout a container to a user."""
-    conn = sqlite3.connect('container_tracking.db')
-    cursor = conn.cursor()
-
-    # Check if container exists
-    cursor.execute("SELECT * FROM containers WHERE serial_number=?", (container_serial,))
-    container = cursor.fetchone()
-    if not container:
-        print(f"Container {container_serial} does not exist.")
-        publish_instruction(f"Error Container {container_serial} does not exist")
-        return
+        publish_event({'type': 'user_added', 'id': user_id, 'name': name, 'badgeID': badgeID})
 
-    # Check if user exists by badgeID
-    cursor.execute("SELECT * FROM users WHERE badgeID=?", (user_badgeID,))
-    user = cursor.fetchone()
-    if not user:
-        print(f"User with badge ID {user_badgeID} does not exist.")
-        publish_instruction(f"Error User with badge ID {user_badgeID} does not exist")
-        return
-
-    # Assign
-    cursor.execute("UPDATE containers SET user_id=? WHERE serial_number=?", (user[0], container_serial))
-    conn.commit()
-    print(f"Container {container_serial} checked out to {user[1]} (Badge ID: {user_badgeID}).")
-    publish_instruction(f"Success {user[1]} ")
-    
-    conn.close()
+def delete_container(container_id):
+    """Delete a container from the database."""
+    deleted = storage.get_store().delete_container(container_id)
+    if deleted:
+        serial_number, user_id = deleted
+        logger.info("Container %s deleted.", serial_number, extra={'serial': serial_number})
+        publish_event({'type': 'container_deleted', 'id': container_id, 'serial': serial_number,
+                       'checked_out': user_id is not None})
 
-def return_container(container_serial):
+def delete_user(user_id):
+    """Delete a user from the database."""
+    deleted = storage.get_store().delete_user(user_id)
+    if deleted:
+        badgeID, serials = deleted
+        logger.info("User with badge ID %s deleted.", badgeID, extra={'badge': badgeID})
+        publish_event({'type': 'user_deleted', 'id': user_id, 'badgeID': badgeID, 'serials': serials})
+
+def checkout_container(container_serial, user_badgeID, source="console"):
+    """Checkout a container to a user."""
+    report_checkout(container_serial, user_badgeID, storage.get_store().checkout_container(container_serial, user_badgeID, source))
+
+def report_checkout(container_serial, user_badgeID, result, reply_to=None):
+    status, name = result
+    if status != 'ok':
+        metrics.operation_errors.inc('checkout_container', status)
+    fields = {'serial': container_serial, 'badge': user_badgeID, 'status': status}
+    if status == 'no_container':
+        logger.info("Container %s does not exist.", container_serial, extra=fields)
+        return send_result(reply_to, status, checkout_error(container_serial, user_badgeID, status, name))
+    elif status == 'no_user':
+        logger.info("User with badge ID %s does not exist.", user_badgeID, extra=fields)
+        return send_result(reply_to, status, checkout_error(container_serial, user_badgeID, status, name))
+    elif status == 'conflict':
+        logger.info("Container %s is already checked out to %s.", container_serial, name or "another user", extra=fields)
+        return send_result(reply_to, status, checkout_error(container_serial, user_badgeID, status, name), name)
+    else:
+        # One line per scan: sampled, the history table has every one
+        logger.info("Container %s checked out to %s (Badge ID: %s).", container_serial, name, user_badgeID,
+                    extra=dict(fields, sample=log.SAMPLE))
+        publish_event({'type': 'checkout', 'serial': container_serial, 'user': name})
+        return send_result(reply_to, status, name, name)
+
+def checkout_error(container_serial, user_badgeID, status, name):
+    """What a kiosk shows for a checkout that failed with status."""
+    if status == 'no_container':
+        return f"Container {container_serial} does not exist"
+    if status == 'no_user':
+        return f"User with badge ID {user_badgeID} does not exist"
+    return f"Container {container_serial} already checked out to {name or 'another user'}"
+
+def report_checkout_batch(user_badgeID, container_serials, results, reply_to):
+    """Answer a checkout session with one item per serial. The overall
+    status is 'ok' when every container was checked out, 'partial' when
+    some were, and otherwise 'no_user' for an unknown badge or 'error'."""
+    items = []
+    user = None
+    for container_serial, (status, name) in zip(container_serials, results):
+        if status == 'ok':
+            user = name
+            publish_event({'type': 'checkout', 'serial': container_serial, 'user': name})
+            items.append({'serial': container_serial, 'status': status, 'msg': name})
+        else:
+            metrics.operation_errors.inc('checkout_containers', status)
+            items.append({'serial': container_serial, 'status': status,
+                          'msg': checkout_error(container_serial, user_badgeID, status, name)})
+    checked_out = sum(item['status'] == 'ok' for item in items)
+    total = len(items)
+    logger.info("Checked out %d of %d containers to badge %s.", checked_out, total, user_badgeID,
+                extra={'badge': user_badgeID, 'containers': total, 'checked_out': checked_out})
+    if checked_out == total:
+        return send_result(reply_to, 'ok', f"{total} containers checked out to {user}", user, items)
+    if checked_out:
+        return send_result(reply_to, 'partial', f"{checked_out} of {total} containers checked out to {user}", user, items)
+    if any(item['status'] == 'no_user' for item in items):
+        return send_result(reply_to, 'no_user', f"User with badge ID {user_badgeID} does not exist", None, items)
+    return send_result(reply_to, 'error', f"None of {total} containers checked out", None, items)
+
+def return_container(container_serial, source="console"):
     """Return a container (remove its association with a user)."""
-    conn = sqlite3.connect('container_tracking.db')
-    cursor = conn.cursor()
-
-    # Check if container exists
-    cursor.execute("SELECT * FROM containers WHERE serial_number=?", (container_serial,))
-    container = cursor.fetchone()
-    if not container:
-        print(f"Container {container_serial} does not exist.")
-        publish_instruction(f"Error Container {container_serial} does not exist")
+    report_return(container_serial, storage.get_store().return_container(container_serial, source))
+
+def report_return(container_serial, result, reply_to=None):
+    status, name = result
+    if status != 'ok':
+        metrics.operation_errors.inc('return_container', status)
+    fields = {'serial': container_serial, 'status': status}
+    if status == 'no_container':
+        logger.info("Container %s does not exist.", container_serial, extra=fields)
+        return send_result(reply_to, status, f"Container {container_serial} does not exist")
+    else:
+        logger.info("Container %s returned and unassigned from user.", container_serial,
+                    extra=dict(fields, sample=log.SAMPLE))
+        if name is not None:
+            publish_event({'type': 'return', 'serial': container_serial, 'user': name})
+        return send_result(reply_to, status, "", name)
+
+def send_result(reply_to, status, message, name=None, items=None):
+    """Answer a structured request on its kiosk's result topic, or publish
+    the legacy free-text instruction when reply_to is None. Returns the
+    answer as (status, message, name), plus items for a session."""
+    global last_result
+    answer = (status, message, name) if items is None else (status, message, name, items)
+    if reply_to is None:
+        if status == 'ok':
+            publish_instruction(f"Success {message} ")
+        else:
+            publish_instruction(f"Error {message}")
+    else:
+        recent_requests.put(reply_to, answer)
+        metrics.mqtt_messages.inc('published', 'result')
+        kiosk, request_id = reply_to
+        last_result = mqtt_client.publish(protocol.result_topic(kiosk),
+                                          protocol.encode_result(request_id, status, message, name, items), qos=QOS)
+    return answer
+
+# Queued scan commands are ('checkout', serial, badge, kiosk, request_id) or
+# ('return', serial, kiosk, request_id); request_id is None for legacy
+# messages, whose results go out as free text on TOPIC. A checkout session
+# is ('checkout_batch', badge, serials, kiosk, request_id): it is routed by
+# badge, since its containers are checked out in one transaction. That only
+# works unsharded; see sharded()
+
+def apply_command(command):
+    """Run one queued scan command against the database."""
+    if command[0] == 'checkout':
+        return storage.get_store().checkout_container(command[1], command[2], command[3])
+    if command[0] == 'checkout_batch':
+        return storage.get_store().checkout_containers(command[2], command[1], command[3])
+    return storage.get_store().return_container(command[1], command[2])
+
+def report_command(command, result):
+    """Publish the result of a queued scan command once it is committed.
+    result is None when the command failed and nothing was changed."""
+    kiosk, request_id = command[-2:]
+    reply_to = None if request_id is None else (kiosk, request_id)
+    if result is None:
+        metrics.operation_errors.inc(OPERATIONS[command[0]], 'failed')
+        send_result(reply_to, 'error', FAILED_MESSAGE)
+        # Not a final answer: a redelivery of the request is applied again
+        if reply_to is not None:
+            recent_requests.invalidate(reply_to)
+        if command[0] != 'checkout_batch':
+            finish_scan(command, None)
         return
-    
-    # Remove user association
-    cursor.execute("UPDATE containers SET user_id=NULL WHERE serial_number=?", (container_serial,))
-    conn.commit()
-    print(f"Container {container_serial} returned and unassigned from user.")
-    publish_instruction(f"Success ")
-    
-    conn.close()
+    if command[0] == 'checkout_batch':
+        report_checkout_batch(command[1], command[2], result, reply_to)
+        return
+    if command[0] == 'checkout':
+        answer = report_checkout(command[1], command[2], result, reply_to)
+    else:
+        answer = report_return(command[1], result, reply_to)
+    finish_scan(command, answer)
+
+def scan_key(command):
+    """(kiosk, op, badge) of a queued scan command; badge is None for returns."""
+    if command[0] == 'checkout':
+        return command[3], 'checkout', command[2]
+    return command[2], 'return', None
+
+def claim_scan(command, reply_to):
+    """Record a scan about to be applied. Returns True if it should be, or
+    False for a duplicate, which is answered here (or once the scan it
+    repeats has been applied) instead."""
+    serial, key = command[1], scan_key(command)
+    path = 'legacy' if reply_to is None else 'structured'
+    with _scans_lock:
+        entry = recent_scans.get(serial)
+        if entry is None or entry[0] != key:
+            recent_scans.put(serial, (key, _waiting.setdefault(command, [])))
+            return True
+        state = entry[1]
+        if isinstance(state, list):
+            # Still queued: structured requests get the result when it is
+            # ready; the legacy result is broadcast once for all of them
+            if reply_to is not None:
+                state.append(reply_to)
+            metrics.duplicate_scans.inc(path, 'in_progress')
+            return False
+    metrics.duplicate_scans.inc(path, 'answered')
+    send_result(reply_to, *state)
+    return False
+
+def finish_scan(command, answer):
+    """Store a scan's answer for its duplicates and send it to those that
+    arrived while it was being applied. answer is None when the scan
+    failed: the waiters are told so, and the next repeat is applied."""
+    serial = command[1]
+    with _scans_lock:
+        waiting = _waiting.pop(command, [])
+        entry = recent_scans.get(serial)
+        # Unless replaced by a newer command for the serial, or expired
+        if entry is not None and entry[1] is waiting:
+            if answer is None:
+                recent_scans.invalidate(serial)
+            else:
+                recent_scans.put(serial, (entry[0], answer))
+    for reply_to in waiting:
+        if answer is None:
+            send_result(reply_to, 'error', FAILED_MESSAGE)
+            recent_requests.invalidate(reply_to)
+        else:
+            send_result(reply_to, *answer)
+
+def end_scans(container_serials):
+    """Close the duplicate windows of serials a session is about to change,
+    so a scan repeated after it is applied again."""
+    with _scans_lock:
+        for container_serial in container_serials:
+            entry = recent_scans.get(container_serial)
+            # A scan still being applied keeps its entry: the requests
+            # waiting on it are answered from there
+            if entry is not None and not isinstance(entry[1], list):
+                recent_scans.invalidate(container_serial)
+
+# Scans are parsed on the MQTT thread and applied in batches by a worker
+# (or, with --shards, by one worker per partition of serials)
+pipeline = ingest.ScanPipeline(apply_command, report_command)
+
+# (index, count) from --shard: which partition of serials this ingest
+# process applies when several of them share the broker and database
+shard = (0, 1)
+
+# Publishes valid badges and serials to kiosks; run by one ingest process
+directory_publisher = None
+
+metrics.registry.gauge('container_tracking_pipeline', "Scan pipeline queue and batch counters.",
+                       lambda: {(key,): value for key, value in pipeline.metrics().items() if key != 'shards'},
+                       ('field',))
+metrics.registry.gauge('container_tracking_directory', "Badge/serial directory published to kiosks.",
+                       lambda: {(key,): value for key, value in directory_publisher.metrics().items()},
+                       ('field',))
+metrics.registry.gauge('container_tracking_log_dropped', "Log records dropped because the log queue was full.",
+                       log.dropped)
+metrics.registry.gauge('container_tracking_scan_dedupe', "Duplicate-scan window: hits are repeats of a serial's latest command.",
+                       lambda: {(key,): value for key, value in recent_scans.stats().items()},
+                       ('field',))
+metrics.registry.gauge('container_tracking_request_dedupe', "Redelivered-command cache: hits are duplicates answered from it.",
+                       lambda: {(key,): value for key, value in recent_requests.stats().items()},
+                       ('field',))
+
+def sharded():
+    """Whether serials are split between workers or processes. A session's
+    containers could then belong to several of them, and checking them out
+    in the badge's partition would race the scans each owner applies, so
+    sessions are refused."""
+    return shard[1] > 1 or isinstance(pipeline, ingest.ShardedPipeline)
+
+def owns(container_serial):
+    index, count = shard
+    return count == 1 or ingest.partition(container_serial, count) == index
 
 def show_users_and_containers():
     """Show all users and containers in the database."""
-    conn = sqlite3.connect('container_tracking.db')
-    cursor = conn.cursor()
-
+    store = storage.get_store()
     # Display all users
     print("\n-- Users --")
-    cursor.execute("SELECT id, name, badgeID FROM users")
-    users = cursor.fetchall()
-    if users:
-        for user in users:
-            print(f"ID: {user[0]}, Name: {user[1]}, Badge ID: {user[2]}")
-    else:
+    found = False
+    for user in store.iter_users():
+        found = True
+        print(f"ID: {user[0]}, Name: {user[1]}, Badge ID: {user[2]}")
+    if not found:
         print("No users found.")
 
     # Display all containers
     print("\n-- Containers --")
-    cursor.execute("SELECT id, serial_number, user_id FROM containers")
-    containers = cursor.fetchall()
-    if containers:
-        for container in containers:
-            user_assigned = "No user assigned"
-            if container[2]:
-                cursor.execute("SELECT name FROM users WHERE id=?", (container[2],))
-                user_assigned = cursor.fetchone()[0]
-            print(f"ID: {container[0]}, Serial Number: {container[1]}, Assigned to: {user_assigned}")
-    else:
+    found = False
+    for container_id, serial_number, user_name in store.iter_containers_with_holder():
+        found = True
+        print(f"ID: {container_id}, Serial Number: {serial_number}, Assigned to: {user_name or 'No user assigned'}")
+    if not found:
         print("No containers found.")
 
-    conn.close()
-
 def publish_instruction(instruction):
     """Publish an instruction to the MQTT broker."""
-    print(f"Publishing to MQTT: {instruction}")
+    logger.info("Publishing to MQTT: %s", instruction, extra=log.SAMPLED)
+    metrics.mqtt_messages.inc('published', 'instruction')
     mqtt_client.publish(TOPIC, instruction)
 
+def publish_event(event):
+    """Push a data change to live dashboards, here and in other processes."""
+    live.broker.publish(event)
+    metrics.mqtt_messages.inc('published', 'event')
+    mqtt_client.publish(live.EVENTS_TOPIC, live.encode(event))
+
 def display_menu():
     """Display the main menu for the app."""
     print("\n-- Container Tracking System --")
@@ -182,150 +413,227 @@ def handle_operation(operation):
         return_container(container_serial)
     mqttMode=False
 
+def on_command(client, userdata, msg):
+    """Handle a structured command from a kiosk's command topic."""
+    kiosk = protocol.kiosk_from_topic(msg.topic)
+    try:
+        command = protocol.decode_command(msg.payload)
+    except protocol.ProtocolError as e:
+        metrics.mqtt_messages.inc('received', 'malformed')
+        logger.warning("Ignoring malformed command from %s: %s", kiosk, e, extra={'kiosk': kiosk})
+        return
+    metrics.mqtt_messages.inc('received', command['op'])
+
+    if not owns(command['badge'] if command['op'] == 'checkout_batch' else command['serial']):
+        return
+
+    reply_to = (kiosk, command['id'])
+    seen = recent_requests.get(reply_to)
+    if seen is not None:
+        # Still queued, or already done: resend the result it got
+        metrics.mqtt_messages.inc('received', 'duplicate')
+        if seen is not _IN_PROGRESS:
+            send_result(reply_to, *seen)
+        return
+    recent_requests.put(reply_to, _IN_PROGRESS)
+
+    if command['op'] == 'checkout_batch':
+        if sharded():
+            metrics.operation_errors.inc('checkout_containers', 'sharded')
+            send_result(reply_to, 'error', SESSIONS_OFF_MESSAGE)
+            return
+        queued = ('checkout_batch', command['badge'], tuple(command['serials']), kiosk, command['id'])
+        end_scans(queued[2])
+        pipeline.submit(queued)
+        return
+    if command['op'] == 'checkout':
+        queued = ('checkout', command['serial'], command['badge'], kiosk, command['id'])
+    else:
+        queued = ('return', command['serial'], kiosk, command['id'])
+    if claim_scan(queued, reply_to):
+        pipeline.submit(queued)
+
 def on_message(client, userdata, msg):
+    """Handle the legacy colon-delimited commands on TOPIC."""
     message = msg.payload.decode().strip().lower()
-    print(f"Received MQTT message: {message}")
+    # TOPIC also carries our own instructions; drop them before any parsing
+    if not message.startswith(("control:", "test")):
+        metrics.mqtt_messages.inc('received', 'echo')
+        return
+    metrics.mqtt_messages.inc('received', 'legacy')
+    logger.info("Received MQTT message: %s", message, extra=log.SAMPLED)
     
     if message == "test":
         mqttMode = True
         handle_operation("checkout")
-    elif "control:checkout" in message:  
+    elif message.startswith("control:checkout:"):
         # Split the message with :
         parts = message.split(":")
         
-        # Ensure there are 4 parts ( control, checkout, container serial, badge ID)
-        if len(parts) == 4:
+        # Ensure there are 4 parts ( control, checkout, container serial, badge ID), plus an optional kiosk ID
+        if len(parts) in (4, 5):
             container_serial = parts[2]
             user_badgeID = parts[3]
+            kiosk = parts[4] if len(parts) == 5 else "mqtt"
             
-            checkout_container(container_serial, user_badgeID)
+            command = ('checkout', container_serial, user_badgeID, kiosk, None)
+            if owns(container_serial) and claim_scan(command, None):
+                pipeline.submit(command)
         else:
-            print("Error: Invalid message format. Expected format 'control:checkout:{container_serial}:{user_badgeID}'.")
-    elif "control:return" in message:  # Check if message contains "control:checkout"
+            logger.warning("Invalid message format %r. Expected format "
+                           "'control:checkout:{container_serial}:{user_badgeID}[:{kiosk}]'.", message)
+    elif message.startswith("control:return:"):
         # Split the message with :
         parts = message.split(":")
         
-        # Ensure there are 3 parts ( control, checkout, container serial)
-        if len(parts) == 3:
+        # Ensure there are 3 parts ( control, checkout, container serial), plus an optional kiosk ID
+        if len(parts) in (3, 4):
             container_serial = parts[2]
+            kiosk = parts[3] if len(parts) == 4 else "mqtt"
             
-            return_container(container_serial)
+            command = ('return', container_serial, kiosk, None)
+            if owns(container_serial) and claim_scan(command, None):
+                pipeline.submit(command)
         else:
-            print("Error: Invalid message format. Expected format 'control:return:{container_serial}'.")
-
-def run_flask():
-    app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False)
-
-def main():
-    threading.Thread(target=run_flask, daemon=True).start()
-    
-    # Connect to MQTT broker
+            logger.warning("Invalid message format %r. Expected format "
+                           "'control:return:{container_serial}[:{kiosk}]'.", message)
+
+def start_dashboard(app, server, port, workers):
+    global dashboard_server
+    import dashboard
+    dashboard_server = dashboard.make_server(app, server, dashboard.HOST, port, workers)
+    threading.Thread(target=dashboard_server.serve_forever, name="dashboard", daemon=True).start()
+
+def stop_dashboard():
+    dashboard_server.shutdown()
+
+def on_connect(client, userdata, flags, rc):
+    # Subscribe on every (re)connect so a broker restart doesn't drop us.
+    # Events from other processes feed live screens and the directory.
+    topics = [(TOPIC, 0), (protocol.COMMAND_TOPICS, QOS), (live.EVENTS_TOPIC, 0)]
+    if directory_publisher is not None:
+        topics.append((protocol.SNAPSHOT_REQUEST_TOPIC, 0))
+    client.subscribe(topics)
+
+def start_mqtt():
+    index, count = shard
+    # Each shard needs its own broker session
+    client_id = CLIENT_ID if count == 1 else f"{CLIENT_ID}-{index}of{count}"
+    mqtt_client.reinitialise(client_id=client_id, clean_session=False)
+    mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message  
+    mqtt_client.message_callback_add(protocol.COMMAND_TOPICS, on_command)
+    mqtt_client.message_callback_add(live.EVENTS_TOPIC, live.on_mqtt_event)
+    if directory_publisher is not None:
+        mqtt_client.message_callback_add(protocol.SNAPSHOT_REQUEST_TOPIC, directory_publisher.on_request)
     mqtt_client.connect(BROKER, PORT, 60)
-    mqtt_client.subscribe(TOPIC)        
     mqtt_client.loop_start() 
 
-    create_database()  
-    
-    try:
-        while True:
+def on_publisher_connect(client, userdata, flags, rc):
+    client.subscribe(live.EVENTS_TOPIC)
+
+def start_mqtt_publisher():
+    """Connect for dashboard processes without ingest: publish instructions
+    and relay events from other processes to this one's live screens."""
+    if not mqtt_client.is_connected():
+        mqtt_client.on_connect = on_publisher_connect
+        mqtt_client.message_callback_add(live.EVENTS_TOPIC, live.on_mqtt_event)
+        # Retries in the background, so the dashboard still serves without a broker
+        mqtt_client.connect_async(BROKER, PORT, 60)
+        mqtt_client.loop_start()
+
+def stop_mqtt():
+    mqtt_client.disconnect()
+    mqtt_client.loop_stop()
+
+def stop_pipeline():
+    """Apply and answer the scans already queued, then stop taking more.
+
+    The subscriptions stay: they belong to the persistent session, and the
+    broker only keeps commands for us while we are down if they exist.
+    Disconnecting is what stops deliveries; the few scans that arrive
+    between the drain and the disconnect are still applied, but their
+    results cannot be sent.
+    """
+    pipeline.stop()
+    if last_result is not None:
+        try:
+            last_result.wait_for_publish(RESULT_FLUSH_TIMEOUT)
+        except RuntimeError:
+            # Not connected: the session resends it after the restart
             pass
-    except KeyboardInterrupt:
-        print("Service interrupted. Shutting down.")
-
-app = Flask(__name__)
-
-@app.route('/', methods=['GET'])
-def index():
-    conn = sqlite3.connect('container_tracking.db')
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        SELECT users.id, users.name, users.badgeID, COUNT(containers.id) as container_count
-        FROM users
-        LEFT JOIN containers ON users.id = containers.user_id
-        GROUP BY users.id
-    """)
-    users = cursor.fetchall()
-
-    cursor.execute("""
-        SELECT containers.id, containers.serial_number, users.name
-        FROM containers
-        LEFT JOIN users ON containers.user_id = users.id
-    """)
-    containers = cursor.fetchall()
-
-    cursor.execute("SELECT COUNT(*) FROM containers WHERE user_id IS NOT NULL")
-    checked_out = cursor.fetchone()[0]
-
-    cursor.execute("SELECT COUNT(*) FROM containers WHERE user_id IS NULL")
-    available = cursor.fetchone()[0]
+    mqtt_client.disconnect()
+    mqtt_client.loop_stop()
+    pipeline.drain()
 
-    conn.close()
-
-    return render_template(
-        'index.html',
-        users=users,
-        containers=containers,
-        checked_out=checked_out,
-        available=available
-    )
-
-
-
-@app.route('/add_user', methods=['POST'])
-def add_user_route():
-    name = request.form['name']
-    badgeID = request.form['badgeID']
-    add_user(name, badgeID)
-    return redirect(url_for('index'))
+def parse_shard(value):
+    """'I/N' -> (I, N) for --shard."""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected INDEX/COUNT, e.g. 0/4")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError("INDEX must be in 0..COUNT-1")
+    return index, count
 
-@app.route('/delete_user/<int:user_id>', methods=['POST'])
-def delete_user(user_id):
-    conn = sqlite3.connect('container_tracking.db')
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM users WHERE id=?", (user_id,))
-    conn.commit()
-    conn.close()
-    return redirect(url_for('index'))
-
-@app.route('/add_container', methods=['POST'])
-def add_container_route():
-    serial = request.form['serial_number']
-    add_container(serial)
-    return redirect(url_for('index'))
-
-@app.route('/delete_container/<int:container_id>', methods=['POST'])
-def delete_container(container_id):
-    conn = sqlite3.connect('container_tracking.db')
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM containers WHERE id=?", (container_id,))
-    conn.commit()
-    conn.close()
-    return redirect(url_for('index'))
-
-@app.route('/users', methods=['GET'])
-def get_users_with_containers():
-    conn = sqlite3.connect('container_tracking.db')
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT id, name, badgeID FROM users")
-    users = cursor.fetchall()
-
-    user_list = []
-    for user in users:
-        user_id, name, badgeID = user
-        cursor.execute("SELECT serial_number FROM containers WHERE user_id=?", (user_id,))
-        containers = [row[0] for row in cursor.fetchall()]
-        user_list.append({
-            'id': user_id, 
-            'name': name,
-            'badgeID': badgeID,
-            'containers': containers
-        })
-
-    conn.close()
-    return jsonify(user_list)
+def main():
+    global BROKER, PORT, pipeline, shard, directory_publisher
+    import dashboard
+
+    parser = argparse.ArgumentParser(description="Container tracking service")
+    parser.add_argument('--role', choices=ROLES, default='all',
+                        help="'ingest' handles MQTT scans, 'dashboard' serves the web app, 'all' does both")
+    parser.add_argument('--server', choices=dashboard.SERVERS, default='dev',
+                        help="how the dashboard is served")
+    parser.add_argument('--workers', type=int, default=dashboard.WORKERS,
+                        help="threads or processes for the 'threads' and 'processes' servers")
+    parser.add_argument('--port', type=int, default=dashboard.PORT)
+    parser.add_argument('--db', default=storage.DB_URL, help="SQLite file or postgresql:// URL")
+    parser.add_argument('--broker', default=BROKER, help="MQTT broker host")
+    parser.add_argument('--broker-port', type=int, default=PORT)
+    parser.add_argument('--shards', type=int, default=1,
+                        help="ingest worker threads, each applying its own partition of container serials "
+                             "(checkout sessions are refused when sharded)")
+    parser.add_argument('--shard', type=parse_shard, default=(0, 1), metavar='INDEX/COUNT',
+                        help="run as one of COUNT ingest processes, applying only partition INDEX of the serials")
+    args = parser.parse_args()
+    log.setup()
+
+    # Also picked up by dashboard worker processes
+    os.environ['CONTAINER_TRACKING_DB'] = args.db
+    os.environ['CONTAINER_TRACKING_BROKER'] = BROKER = args.broker
+    os.environ['CONTAINER_TRACKING_BROKER_PORT'] = str(args.broker_port)
+    PORT = args.broker_port
+    storage.configure(args.db)
+
+    shard = args.shard
+    if args.shards > 1:
+        pipeline = ingest.ShardedPipeline(apply_command, report_command, args.shards, stride=shard[1])
+    if args.role in ('all', 'ingest') and shard[0] == 0:
+        directory_publisher = directory.DirectoryPublisher(mqtt_client, QOS)
+
+    runner = service.Service(f"container tracking ({args.role})")
+    runner.add("database", create_database, storage.close)
+    if args.role in ('all', 'ingest'):
+        runner.add("MQTT client", start_mqtt, stop_mqtt)
+        runner.add("scan pipeline", pipeline.start, stop_pipeline)
+        if directory_publisher is not None:
+            runner.add("directory publisher", directory_publisher.start, directory_publisher.stop)
+    if args.role in ('all', 'dashboard'):
+        if args.server == 'processes':
+            # Each gunicorn worker builds its own app and MQTT connection
+            app = None
+        else:
+            app = dashboard.create_app(connect_mqtt=args.role == 'dashboard')
+            if args.role == 'dashboard':
+                runner.add("MQTT publisher", None, stop_mqtt)
+        runner.add(f"dashboard ({args.server} server)",
+                   lambda: start_dashboard(app, args.server, args.port, args.workers),
+                   stop_dashboard)
+    runner.run()
 
 if __name__ == "__main__":
-    main()
+    # Run from the importable module so dashboard's `import main` shares
+    # this process's MQTT client and pipeline instead of loading a copy
+    import main as service_main
+    service_main.main()
@@ -0,0 +1,189 @@
+"""In-process metrics in the Prometheus text format.
+
+Counters and histograms are plain dicts behind a lock, cheap enough to
+update on every scan. Values that already live elsewhere (queue depths,
+cache hit counts) are read when /metrics is scraped instead of being
+copied on every change.
+
+Each process keeps its own numbers; with the 'processes' dashboard server a
+scrape sees only the worker that answered it.
+"""
+import bisect
+import threading
+import time
+from functools import wraps
+
+
+# Seconds. Scans are expected to take well under a millisecond in SQLite,
+# HTTP requests a few milliseconds.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def time(self, *labels):
+        """Decorator recording how long each call takes."""
+        def decorate(function):
+            @wraps(function)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *labels)
+            return timed
+        return decorate
+
+    def count(self, *labels):
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = _format_labels(self.labels, labels, [('le', _format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Value read from a callback at scrape time. The callback returns a
+    number, or a dict of label value tuples to numbers."""
+
+    def __init__(self, name, help, read, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.read = read
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.read()
+        except Exception:
+            # A component that is not running has nothing to report
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, read, labels=()):
+        return self.register(Gauge(name, help, read, labels))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Shared by the modules that record them
+operation_seconds = registry.histogram(
+    'container_tracking_operation_seconds', "Time spent in each storage operation.", ('operation',))
+transaction_seconds = registry.histogram(
+    'container_tracking_db_transaction_seconds', "Time from BEGIN to COMMIT of outermost transactions.", ('backend',))
+operation_errors = registry.counter(
+    'container_tracking_operation_errors_total', "Operations refused, by reason.", ('operation', 'reason'))
+duplicate_scans = registry.counter(
+    'container_tracking_duplicate_scans_total', "Repeated scans answered without touching the database.",
+    ('path', 'state'))
+mqtt_messages = registry.counter(
+    'container_tracking_mqtt_messages_total', "MQTT messages handled, by direction and type.", ('direction', 'type'))
+http_request_seconds = registry.histogram(
+    'container_tracking_http_request_seconds', "Dashboard request latency until the response starts.",
+    ('endpoint', 'method', 'status'))
+
+
+def instrument(obj, names, histogram=operation_seconds):
+    """Replace obj's methods `names` with versions timed into histogram,
+    labelled with the method name."""
+    for name in names:
+        setattr(obj, name, histogram.time(name)(getattr(obj, name)))
+    return obj
@@ -0,0 +1,266 @@
+"""Versioned schema migrations for the SQLite database.
+
+The schema version is kept in PRAGMA user_version. migrate() applies every
+migration past it, in order, each in its own transaction, so files made by
+any earlier version of the app are brought up to date in place:
+
+    python migrations.py migrate [DB]    upgrade a database file
+    python migrations.py status [DB]     show its version
+    python migrations.py check [DB]      fail unless the hot queries use indexes
+
+Migrations are never edited once released; add a new one instead.
+"""
+import argparse
+import logging
+import sqlite3
+import sys
+
+
+logger = logging.getLogger(__name__)
+
+
+def _create_version_triggers(conn, table):
+    # data_version goes up on every change to users or containers, from
+    # any process, so readers can tell whether cached results are stale
+    for change in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_{change.lower()}_version
+                            AFTER {change} ON {table}
+                            BEGIN
+                                UPDATE meta SET value = value + 1 WHERE key = 'data_version';
+                            END''')
+
+
+def _baseline(conn):
+    """The schema create_database() built before migrations existed. Every
+    statement is IF NOT EXISTS, so older files just gain what they lack."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS containers (
+                        id INTEGER PRIMARY KEY,
+                        serial_number TEXT UNIQUE,
+                        user_id INTEGER,
+                        FOREIGN KEY (user_id) REFERENCES users(id))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS users (
+                        id INTEGER PRIMARY KEY,
+                        name TEXT UNIQUE,
+                        badgeID TEXT UNIQUE)''')
+    # Per-user joins and the checked out / available counts
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_containers_user_id ON containers(user_id)")
+
+    # Append-only checkout/return history. No foreign keys, so history
+    # outlives deleted users and containers.
+    conn.execute('''CREATE TABLE IF NOT EXISTS events (
+                        id INTEGER PRIMARY KEY,
+                        container_id INTEGER NOT NULL,
+                        user_id INTEGER,
+                        action TEXT NOT NULL,
+                        source TEXT,
+                        created_at REAL NOT NULL)''')
+    # Events are appended in time order, so ids order them and the
+    # rowid these indexes carry serves newest-first paging per container
+    # or user. Kept to two because each index costs every scan a write.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_container ON events(container_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_user ON events(user_id)")
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS meta (
+                        key TEXT PRIMARY KEY,
+                        value INTEGER NOT NULL)''')
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('data_version', 0)")
+    for table in ('users', 'containers'):
+        _create_version_triggers(conn, table)
+
+
+def _containers_on_delete_set_null(conn):
+    """Deleting a user releases their containers instead of leaving them
+    held by an id that no longer exists.
+
+    SQLite cannot alter a foreign key, so containers is rebuilt. Containers
+    already held by deleted users are released first.
+    """
+    released = conn.execute('''UPDATE containers SET user_id = NULL
+                               WHERE user_id IS NOT NULL
+                                 AND user_id NOT IN (SELECT id FROM users)''').rowcount
+    if released:
+        logger.info("Released %d containers held by deleted users.", released)
+
+    conn.execute('''CREATE TABLE containers_new (
+                        id INTEGER PRIMARY KEY,
+                        serial_number TEXT UNIQUE,
+                        user_id INTEGER REFERENCES users(id) ON DELETE SET NULL)''')
+    conn.execute('''INSERT INTO containers_new (id, serial_number, user_id)
+                    SELECT id, serial_number, user_id FROM containers''')
+    # Takes the table's index and triggers with it
+    conn.execute("DROP TABLE containers")
+    conn.execute("ALTER TABLE containers_new RENAME TO containers")
+    # Also the index the foreign key needs: deleting a user looks up the
+    # containers that point at it
+    conn.execute("CREATE INDEX idx_containers_user_id ON containers(user_id)")
+    _create_version_triggers(conn, 'containers')
+    problems = conn.execute("PRAGMA foreign_key_check(containers)").fetchall()
+    if problems:
+        raise sqlite3.IntegrityError(f"containers still reference missing users: {problems[:5]}")
+
+
+def _never_reuse_ids(conn):
+    """Give users and containers AUTOINCREMENT ids.
+
+    Events refer to both by id, so an id SQLite handed out again after a
+    delete made the new user or container inherit the old one's history.
+    The rebuilt tables count on from the highest id that either the table
+    or the events have ever used.
+    """
+    conn.execute('''CREATE TABLE users_new (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT UNIQUE,
+                        badgeID TEXT UNIQUE)''')
+    conn.execute("INSERT INTO users_new (id, name, badgeID) SELECT id, name, badgeID FROM users")
+    conn.execute("DROP TABLE users")
+    conn.execute("ALTER TABLE users_new RENAME TO users")
+    _create_version_triggers(conn, 'users')
+
+    conn.execute('''CREATE TABLE containers_new (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        serial_number TEXT UNIQUE,
+                        user_id INTEGER REFERENCES users(id) ON DELETE SET NULL)''')
+    conn.execute('''INSERT INTO containers_new (id, serial_number, user_id)
+                    SELECT id, serial_number, user_id FROM containers''')
+    conn.execute("DROP TABLE containers")
+    conn.execute("ALTER TABLE containers_new RENAME TO containers")
+    conn.execute("CREATE INDEX idx_containers_user_id ON containers(user_id)")
+    _create_version_triggers(conn, 'containers')
+
+    for table, column in (('users', 'user_id'), ('containers', 'container_id')):
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+        conn.execute(f'''INSERT INTO sqlite_sequence (name, seq)
+                         SELECT ?, MAX(COALESCE((SELECT MAX(id) FROM {table}), 0),
+                                       COALESCE((SELECT MAX({column}) FROM events), 0))''', (table,))
+    problems = conn.execute("PRAGMA foreign_key_check(containers)").fetchall()
+    if problems:
+        raise sqlite3.IntegrityError(f"containers still reference missing users: {problems[:5]}")
+
+
+# Index + 1 is the user_version a database has once the migration is applied
+MIGRATIONS = (
+    _baseline,
+    _containers_on_delete_set_null,
+    _never_reuse_ids,
+)
+
+LATEST = len(MIGRATIONS)
+
+
+def version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(path):
+    """Bring the database at path up to LATEST. Returns the version it was at."""
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        # Rebuilding a table drops the old one, which would set every
+        # reference to it to NULL if enforcement were on; migrations that
+        # rebuild check the result themselves
+        conn.execute("PRAGMA foreign_keys=OFF")
+        start = current = version(conn)
+        while current < LATEST:
+            # Taking the write lock before reading the version means two
+            # processes starting together cannot both apply a migration
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                current = version(conn)
+                if current >= LATEST:
+                    conn.execute("ROLLBACK")
+                    break
+                migration = MIGRATIONS[current]
+                migration(conn)
+                # PRAGMA arguments cannot be bound
+                conn.execute(f"PRAGMA user_version = {current + 1:d}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            logger.info("Migrated %s to schema version %d (%s).", path, current + 1, migration.__name__.strip('_'))
+            current += 1
+        return start
+    finally:
+        conn.close()
+
+
+def hot_queries():
+    """(name, sql, params) for the statements run on every scan or page
+    load. Each should be answered through an index, never a table scan."""
+    import database
+    history_by_container = database.history_query(container_id=1)
+    history_by_user = database.history_query(user_id=1)
+    return (
+        ('container by serial', database.SQL_CONTAINER_BY_SERIAL, ('C1',)),
+        ('container id by serial', database.SQL_CONTAINER_ID_BY_SERIAL, ('C1',)),
+        ('user by badge', database.SQL_USER_BY_BADGE, ('B1',)),
+        ('user by name or badge', database.SQL_USER_BY_NAME_OR_BADGE, ('A', 'B1')),
+        ('checkout', database.SQL_CHECKOUT, (1, 1, 'C1', 1, 'B1')),
+        ('checkout conflict', database.SQL_CHECKOUT_CONFLICT, (1, 'B1', 1, 'C1')),
+        ('return', database.SQL_RETURN, (1,)),
+        ('holder', database.SQL_HOLDER, (1, 'C1')),
+        ('containers of user', database.SQL_USER_CONTAINERS, (1,)),
+        ('users page', *database.users_page_query(0, 51, '')),
+        ('containers page', *database.containers_page_query(0, 51, '')),
+        ('users page, searched', *database.users_page_query(0, 51, 'A')),
+        ('containers page, searched', *database.containers_page_query(0, 51, 'C')),
+        ('history of container', *history_by_container),
+        ('history of user', *history_by_user),
+    )
+
+
+def check_plans(conn):
+    """Problems found: hot queries that scan a table, and foreign keys
+    whose child column has no index. An empty list means all is well."""
+    problems = []
+    for name, sql, params in hot_queries():
+        for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+            detail = row[-1]
+            # "SCAN t USING INDEX" walks an index in order, which is fine
+            # when the query stops at a LIMIT; a bare "SCAN t" reads it all
+            if detail.startswith('SCAN') and 'INDEX' not in detail:
+                problems.append(f"{name}: {detail}")
+
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    for table in tables:
+        indexed = {conn.execute(f"PRAGMA index_info({index[1]})").fetchone()[2]
+                   for index in conn.execute(f"PRAGMA index_list({table})")}
+        for key in conn.execute(f"PRAGMA foreign_key_list({table})"):
+            if key[3] not in indexed:
+                problems.append(f"{table}.{key[3]} references {key[2]} but has no index")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=('migrate', 'status', 'check'))
+    parser.add_argument('db', nargs='?')
+    args = parser.parse_args()
+
+    import database
+    path = args.db or database.DB_PATH
+    if args.command == 'migrate':
+        start = migrate(path)
+        print(f"{path}: schema version {start} -> {LATEST}.")
+    elif args.command == 'status':
+        conn = sqlite3.connect(path)
+        current = version(conn)
+        conn.close()
+        print(f"{path}: schema version {current} of {LATEST}.")
+    else:
+        conn = sqlite3.connect(path)
+        current = version(conn)
+        if current != LATEST:
+            parser.exit(2, f"{path} is at schema version {current}, run migrate first.\n")
+        problems = check_plans(conn)
+        conn.close()
+        for problem in problems:
+            print(problem)
+        print(f"{len(problems)} problems." if problems else "All hot queries use indexes.")
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
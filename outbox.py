@@ -0,0 +1,136 @@
+"""Durable outbox for kiosk commands.
+
+Each command is written here before it is published with QoS 1, and deleted
+once the broker acknowledges it. Commands made while the kiosk is offline,
+or still unacknowledged when it restarts or loses power, are published again
+on the next start. A command can therefore be delivered twice; the server
+drops repeats by their request id.
+"""
+import sqlite3
+import threading
+import time
+
+
+OUTBOX_PATH = "kiosk_outbox.db"
+
+# Acknowledged rows are deleted this many at a time
+ACK_BATCH = 50
+# Seconds an acknowledgement for an unknown packet id is kept, waiting for
+# publish() to return that id. Only the outbox's own publishes need it, and
+# they claim it at once; anything older is for a message the outbox did
+# not send, and keeping it could ack a later message that reuses the id.
+EARLY_ACK_WINDOW = 10
+
+
+class Outbox:
+    def __init__(self, path=OUTBOX_PATH, ack_batch=ACK_BATCH):
+        self.ack_batch = ack_batch
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._acked = []
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # A scan must survive a power cut the moment add() returns
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS outbox (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                topic TEXT NOT NULL,
+                                payload BLOB NOT NULL)''')
+
+    def add(self, topic, payload):
+        """Store a message and return its row id."""
+        with self._lock:
+            return self._conn.execute("INSERT INTO outbox (topic, payload) VALUES (?, ?)",
+                                      (topic, payload)).lastrowid
+
+    def pending(self):
+        """Every stored message as (id, topic, payload), oldest first."""
+        with self._lock:
+            return self._conn.execute("SELECT id, topic, payload FROM outbox ORDER BY id").fetchall()
+
+    def ack(self, row_id):
+        """Mark a message delivered. Deletes are batched; losing the last
+        few on a crash only means those messages are sent again."""
+        with self._lock:
+            self._acked.append((row_id,))
+            if len(self._acked) >= self.ack_batch:
+                self._delete_acked()
+
+    def commit_acks(self):
+        with self._lock:
+            self._delete_acked()
+
+    def _delete_acked(self):
+        if self._acked:
+            with self._conn:
+                self._conn.execute("BEGIN")
+                self._conn.executemany("DELETE FROM outbox WHERE id = ?", self._acked)
+            self._acked = []
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] - len(self._acked)
+
+    def close(self):
+        self.commit_acks()
+        self._conn.close()
+
+
+class OutboxPublisher:
+    """Publishes through a paho client, keeping each message in the outbox
+    until its PUBACK arrives.
+
+    paho itself queues QoS 1 messages published while disconnected and
+    resends unacknowledged ones after a reconnect, so the outbox is only
+    replayed by resend_stored(), once per process start.
+    """
+
+    def __init__(self, client, outbox, qos=1):
+        self.client = client
+        self.outbox = outbox
+        self.qos = qos
+        # Packet id -> outbox row, for messages paho has not had acked yet
+        self._inflight = {}
+        # Packet id -> when its PUBACK arrived, for acks that came before
+        # publish() returned the id to us
+        self._early = {}
+        self._lock = threading.Lock()
+        client.on_publish = self.on_publish
+
+    def publish(self, topic, payload):
+        self._publish(self.outbox.add(topic, payload), topic, payload)
+
+    def resend_stored(self):
+        """Publish whatever an earlier run left unacknowledged."""
+        for row_id, topic, payload in self.outbox.pending():
+            self._publish(row_id, topic, payload)
+
+    def _publish(self, row_id, topic, payload):
+        info = self.client.publish(topic, payload, qos=self.qos)
+        with self._lock:
+            if self._early.pop(info.mid, None) is not None:
+                self._acked(row_id)
+            else:
+                self._inflight[info.mid] = row_id
+
+    def on_publish(self, client, userdata, mid):
+        # Runs on the network thread while paho holds its own lock, so
+        # publish() must not hold self._lock while calling into paho
+        with self._lock:
+            row_id = self._inflight.pop(mid, None)
+            if row_id is None:
+                # Also called for messages published on the same client
+                # without the outbox, which nobody will claim
+                now = time.monotonic()
+                for stale in [early for early, at in self._early.items() if now - at > EARLY_ACK_WINDOW]:
+                    del self._early[stale]
+                self._early[mid] = now
+            else:
+                self._acked(row_id)
+
+    def _acked(self, row_id):
+        self.outbox.ack(row_id)
+        if not self._inflight:
+            self.outbox.commit_acks()
+
+    def inflight(self):
+        return len(self._inflight)
@@ -0,0 +1,192 @@
+"""Versioned MQTT message schema shared by the server and the kiosks.
+
+Kiosks publish commands to their own command topic and get results back on
+their own result topic, so nobody receives their own messages:
+
+    container_tracking/v1/cmd/<kiosk>      {"v":1,"id":"…","op":"checkout","serial":"C1","badge":"B7"}
+    container_tracking/v1/result/<kiosk>   {"v":1,"id":"…","status":"ok","name":"Alex","msg":"Alex"}
+
+A session checks out many containers to one badge in one transaction, and
+its result carries one item per serial, in order:
+
+    {"v":1,"id":"…","op":"checkout_batch","badge":"B7","serials":["C1","C2"]}
+    {"v":1,"id":"…","status":"partial","msg":"1 of 2 checked out to Alex","name":"Alex",
+     "items":[{"serial":"C1","status":"ok","msg":"Alex"},{"serial":"C2","status":"conflict","msg":"…"}]}
+
+A server running sharded ingest (--shards or --shard) answers every
+session with status "error" and no items; its kiosks scan one at a time.
+
+"id" is chosen by the kiosk and echoed in the result so it can match replies
+to requests. The old colon-delimited strings on main.TOPIC are still
+accepted from kiosks that have not been updated.
+
+The server also publishes the directory of valid badges and serials, so
+kiosks can flag unknown ones as they are scanned:
+
+    container_tracking/v1/directory/snapshot   retained, zlib-compressed
+        {"v":1,"epoch":"…","version":7,"badges":[…],"serials":[…]}
+    container_tracking/v1/directory/delta
+        {"v":1,"epoch":"…","version":8,"badges":{"add":[…],"remove":[…]},"serials":{…}}
+
+A delta applies to the directory at version - 1 of the same epoch; the
+epoch changes whenever the server restarts its count. A kiosk that sees a
+gap publishes to container_tracking/v1/directory/request and the server
+answers with a new snapshot.
+"""
+import itertools
+import json
+import os
+import zlib
+
+
+VERSION = 1
+PREFIX = f"container_tracking/v{VERSION}"
+COMMAND_TOPICS = f"{PREFIX}/cmd/+"
+SNAPSHOT_TOPIC = f"{PREFIX}/directory/snapshot"
+DELTA_TOPIC = f"{PREFIX}/directory/delta"
+# A kiosk that missed a delta asks for a fresh snapshot here
+SNAPSHOT_REQUEST_TOPIC = f"{PREFIX}/directory/request"
+
+# Fields each op must carry, besides v, id and op
+REQUIRED = {
+    'checkout': ('serial', 'badge'),
+    'return': ('serial',),
+    'checkout_batch': ('badge', 'serials'),
+}
+# Fields that hold a list of strings rather than one
+LISTS = {'serials'}
+# Most containers one session may check out
+MAX_BATCH = 500
+
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def command_topic(kiosk):
+    return f"{PREFIX}/cmd/{kiosk}"
+
+
+def result_topic(kiosk):
+    return f"{PREFIX}/result/{kiosk}"
+
+
+def kiosk_from_topic(topic):
+    return topic.rsplit('/', 1)[1]
+
+
+_ids = itertools.count(1)
+_id_prefix = os.urandom(3).hex()
+
+
+def new_id():
+    """Short request id, unique per kiosk process."""
+    return f"{_id_prefix}{next(_ids):x}"
+
+
+def encode_command(op, request_id, **fields):
+    return _encoder.encode(dict(v=VERSION, id=request_id, op=op, **fields)).encode()
+
+
+def encode_result(request_id, status, message, name=None, items=None):
+    result = {'v': VERSION, 'id': request_id, 'status': status, 'msg': message}
+    if name is not None:
+        result['name'] = name
+    if items is not None:
+        result['items'] = items
+    return _encoder.encode(result).encode()
+
+
+def _decode(payload):
+    try:
+        message = json.loads(payload)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ProtocolError(f"not JSON: {e}")
+    if not isinstance(message, dict):
+        raise ProtocolError("expected a JSON object")
+    if message.get('v') != VERSION:
+        raise ProtocolError(f"unsupported version {message.get('v')!r}")
+    if not isinstance(message.get('id'), str) or not message['id']:
+        raise ProtocolError("missing id")
+    return message
+
+
+def decode_command(payload):
+    """Parse and check a command payload; raises ProtocolError."""
+    command = _decode(payload)
+    op = command.get('op')
+    if op not in REQUIRED:
+        raise ProtocolError(f"unknown op {op!r}")
+    for field in REQUIRED[op]:
+        value = command.get(field)
+        if field in LISTS:
+            if not isinstance(value, list) or not value:
+                raise ProtocolError(f"missing {field}")
+            if len(value) > MAX_BATCH:
+                raise ProtocolError(f"more than {MAX_BATCH} {field}")
+            if not all(isinstance(item, str) and item.strip() for item in value):
+                raise ProtocolError(f"empty or non-string item in {field}")
+            command[field] = [item.strip() for item in value]
+        elif not isinstance(value, str) or not value.strip():
+            raise ProtocolError(f"missing {field}")
+        else:
+            command[field] = value.strip()
+    return command
+
+
+def decode_result(payload):
+    result = _decode(payload)
+    if not isinstance(result.get('status'), str):
+        raise ProtocolError("missing status")
+    return result
+
+
+def encode_snapshot(epoch, version, badges, serials):
+    snapshot = {'v': VERSION, 'epoch': epoch, 'version': version,
+                'badges': sorted(badges), 'serials': sorted(serials)}
+    return zlib.compress(_encoder.encode(snapshot).encode())
+
+
+def decode_snapshot(payload):
+    try:
+        payload = zlib.decompress(payload)
+    except zlib.error as e:
+        raise ProtocolError(f"bad snapshot: {e}")
+    snapshot = _decode_directory(payload)
+    for field in ('badges', 'serials'):
+        if not isinstance(snapshot.get(field), list):
+            raise ProtocolError(f"missing {field}")
+    return snapshot
+
+
+def encode_delta(epoch, version, badges, serials):
+    """badges and serials are {'add': [...], 'remove': [...]}."""
+    return _encoder.encode({'v': VERSION, 'epoch': epoch, 'version': version,
+                            'badges': badges, 'serials': serials}).encode()
+
+
+def decode_delta(payload):
+    delta = _decode_directory(payload)
+    for field in ('badges', 'serials'):
+        changes = delta.get(field)
+        if not isinstance(changes, dict):
+            raise ProtocolError(f"missing {field}")
+        for change in ('add', 'remove'):
+            changes.setdefault(change, [])
+    return delta
+
+
+def _decode_directory(payload):
+    try:
+        message = json.loads(payload)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ProtocolError(f"not JSON: {e}")
+    if not isinstance(message, dict):
+        raise ProtocolError("expected a JSON object")
+    if message.get('v') != VERSION:
+        raise ProtocolError(f"unsupported version {message.get('v')!r}")
+    if not isinstance(message.get('epoch'), str) or not isinstance(message.get('version'), int):
+        raise ProtocolError("missing epoch or version")
+    return message
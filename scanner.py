@@ -0,0 +1,377 @@
+"""Non-blocking input from barcode and badge scanners.
+
+A ScannerReader watches any number of sources with one selector and calls
+on_code(code, source) for each complete scan. It never sleeps or polls:
+it wakes on input, or when a code framed by timing is due. Sources:
+
+    -                  stdin (a keyboard-wedge scanner typing into a terminal)
+    /dev/input/eventN  a HID scanner read through evdev, grabbed so its
+                       keystrokes do not also reach the desktop
+    anything else      a serial scanner (/dev/ttyACM0, /dev/ttyUSB0) or a
+                       pipe/FIFO, read as raw bytes
+
+Codes end at a terminator (CR, LF or Tab by default) or, with gap set, when
+no character arrives for gap seconds, for scanners configured without a
+suffix.
+
+    python scanner.py read /dev/input/event3
+    python scanner.py record /dev/ttyACM0 scans.jsonl
+    python scanner.py replay scans.jsonl --speed 0
+"""
+import argparse
+import codecs
+import fcntl
+import json
+import os
+import selectors
+import struct
+import sys
+import termios
+import threading
+import time
+
+
+TERMINATORS = "\r\n\t"
+# Scanners send a code's characters a few ms apart at most; a person
+# typing leaves longer gaps than this
+GAP = 0.05
+BAUD = 9600
+
+# struct input_event: struct timeval, __u16 type, __u16 code, __s32 value
+_EVENT = struct.Struct('llHHi')
+_EV_KEY = 1
+_KEY_DOWN = 1
+_EVIOCGRAB = 0x40044590
+_SHIFT_KEYS = {42, 54}
+
+# Linux key codes to characters, US layout, as scanners emulate it
+_KEYS = {code: char for code, char in zip(range(2, 12), "1234567890")}
+_KEYS.update({code: char for code, char in zip(range(16, 26), "qwertyuiop")})
+_KEYS.update({code: char for code, char in zip(range(30, 39), "asdfghjkl")})
+_KEYS.update({code: char for code, char in zip(range(44, 51), "zxcvbnm")})
+_KEYS.update({12: '-', 13: '=', 51: ',', 52: '.', 53: '/', 57: ' ', 15: '\t', 28: '\n', 96: '\n'})
+_SHIFTED = {char: shifted for char, shifted in zip("1234567890-=,./", "!@#$%^&*()_+<>?")}
+
+
+class Framer:
+    """Splits a stream of characters into codes at a terminator, or where
+    the gap between two characters is longer than gap seconds."""
+
+    def __init__(self, terminators=TERMINATORS, gap=None):
+        self.terminators = terminators
+        self.gap = gap
+        self._buffer = []
+        self._last = 0.0
+
+    def feed(self, text, now):
+        """Add characters received at now; returns the codes completed."""
+        codes = []
+        for char in text:
+            if self.gap is not None and self._buffer and now - self._last > self.gap:
+                codes.append(self._flush())
+            if char in self.terminators:
+                if self._buffer:
+                    codes.append(self._flush())
+            elif char.isprintable():
+                self._buffer.append(char)
+            self._last = now
+        return codes
+
+    def deadline(self):
+        """When the code being received is complete if nothing else comes."""
+        if self.gap is not None and self._buffer:
+            return self._last + self.gap
+        return None
+
+    def expire(self, now):
+        deadline = self.deadline()
+        if deadline is not None and now >= deadline:
+            return [self._flush()]
+        return []
+
+    def finish(self):
+        """The code still being received, at end of input."""
+        return [self._flush()] if self._buffer else []
+
+    def _flush(self):
+        code = ''.join(self._buffer).strip()
+        self._buffer = []
+        return code
+
+
+class TextDecoder:
+    """Bytes from a serial port, pipe or terminal."""
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def decode(self, data, now):
+        return [(self._decoder.decode(data), now)]
+
+
+class EvdevDecoder:
+    """struct input_event records from /dev/input/eventN. Each key press
+    carries the kernel's own timestamp, which inter-key timing uses."""
+
+    def __init__(self):
+        self._pending = b''
+        self._shift = False
+
+    def decode(self, data, now):
+        data = self._pending + data
+        whole = len(data) - len(data) % _EVENT.size
+        self._pending = data[whole:]
+        chars = []
+        for seconds, micros, kind, code, value in _EVENT.iter_unpack(data[:whole]):
+            if kind != _EV_KEY:
+                continue
+            if code in _SHIFT_KEYS:
+                self._shift = value != 0
+            elif value == _KEY_DOWN and code in _KEYS:
+                char = _KEYS[code]
+                if self._shift:
+                    char = _SHIFTED.get(char, char.upper())
+                # Event times are wall clock; map them onto now's clock
+                chars.append((char, now - (time.time() - (seconds + micros / 1e6))))
+        return chars
+
+
+class Source:
+    def __init__(self, name, fd, decoder, framer, close=True):
+        self.name = name
+        self.fd = fd
+        self.decoder = decoder
+        self.framer = framer
+        self._close = close
+
+    def close(self):
+        if self._close:
+            os.close(self.fd)
+
+
+def _set_raw(fd, baud):
+    attrs = termios.tcgetattr(fd)
+    # iflag, oflag, cflag, lflag: no translation, no echo, no line editing
+    attrs[0] = 0
+    attrs[1] = 0
+    attrs[2] = termios.CS8 | termios.CREAD | termios.CLOCAL
+    attrs[3] = 0
+    speed = getattr(termios, f'B{baud}')
+    attrs[4] = attrs[5] = speed
+    # Return whatever is there; the selector says when something is
+    attrs[6][termios.VMIN] = 0
+    attrs[6][termios.VTIME] = 0
+    termios.tcsetattr(fd, termios.TCSANOW, attrs)
+
+
+def open_source(path, terminators=TERMINATORS, gap=None, baud=BAUD, grab=True):
+    """Open a scanner by path; see the module docstring."""
+    framer = Framer(terminators, gap)
+    if path == '-':
+        # Left blocking: it may share its file with stdout, and a read
+        # after the selector reports it readable returns at once anyway
+        return Source('stdin', sys.stdin.fileno(), TextDecoder(), framer, close=False)
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK | os.O_NOCTTY)
+    if path.startswith('/dev/input/'):
+        if grab:
+            fcntl.ioctl(fd, _EVIOCGRAB, 1)
+        return Source(path, fd, EvdevDecoder(), framer)
+    if os.isatty(fd):
+        _set_raw(fd, baud)
+    return Source(path, fd, TextDecoder(), framer)
+
+
+class ScannerReader:
+    """Reads every source from one thread (or run() in the caller's) and
+    calls on_code(code, source_name) for each scan, in arrival order."""
+
+    def __init__(self, sources, on_code):
+        self.sources = list(sources)
+        self.on_code = on_code
+        self.codes = 0
+        self._selector = selectors.DefaultSelector()
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+        self._selector.register(self._wake_read, selectors.EVENT_READ, None)
+        for source in self.sources:
+            self._selector.register(source.fd, selectors.EVENT_READ, source)
+        self._stopping = False
+        self._thread = None
+        # Guards the wake pipe: once run() closes it, its fd numbers can be
+        # handed to another file, which stop() must then not write to
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="scanner", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping = True
+        with self._lock:
+            if not self._closed:
+                try:
+                    os.write(self._wake_write, b'x')
+                except BlockingIOError:
+                    # The pipe is full of wake-ups already
+                    pass
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run(self):
+        """Read until stop() or every source reaches end of file."""
+        try:
+            while not self._stopping and self.sources:
+                for key, _ in self._selector.select(self._timeout()):
+                    if key.data is None:
+                        os.read(self._wake_read, 64)
+                    else:
+                        self._read(key.data)
+                now = time.monotonic()
+                for source in self.sources:
+                    self._emit(source, source.framer.expire(now))
+        finally:
+            for source in self.sources:
+                self._selector.unregister(source.fd)
+                source.close()
+            self.sources = []
+            self._selector.close()
+            with self._lock:
+                self._closed = True
+                os.close(self._wake_read)
+                os.close(self._wake_write)
+
+    def _timeout(self):
+        deadlines = [deadline for deadline in (source.framer.deadline() for source in self.sources)
+                     if deadline is not None]
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def _read(self, source):
+        try:
+            data = os.read(source.fd, 4096)
+        except BlockingIOError:
+            return
+        now = time.monotonic()
+        if not data:
+            # End of a file or pipe: whatever is left is the last code
+            self._emit(source, source.framer.finish())
+            self._selector.unregister(source.fd)
+            source.close()
+            self.sources.remove(source)
+            return
+        for text, at in source.decoder.decode(data, now):
+            self._emit(source, source.framer.feed(text, at))
+
+    def _emit(self, source, codes):
+        for code in codes:
+            if code and not self._stopping:
+                self.codes += 1
+                self.on_code(code, source.name)
+
+
+def record(path, output):
+    """Write what a scanner sends, with timing, as JSON lines for replay."""
+    source = open_source(path)
+    selector = selectors.DefaultSelector()
+    selector.register(source.fd, selectors.EVENT_READ)
+    start = time.monotonic()
+    try:
+        while True:
+            selector.select()
+            data = os.read(source.fd, 4096)
+            if not data:
+                break
+            now = time.monotonic()
+            for text, at in source.decoder.decode(data, now):
+                if text:
+                    output.write(json.dumps({'t': round(at - start, 6), 'data': text}) + '\n')
+                    output.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        source.close()
+
+
+def load_recording(lines):
+    """(offset seconds, text) chunks from a recording, or from a plain file
+    with one code per line (sent back to back)."""
+    chunks = []
+    for line in lines:
+        try:
+            chunk = json.loads(line)
+            chunks.append((float(chunk['t']), chunk['data']))
+        except (ValueError, TypeError, KeyError):
+            chunks.append((0.0, line if line.endswith('\n') else line + '\n'))
+    return chunks
+
+
+def replay(chunks, speed=1.0, gap=None, on_code=None):
+    """Feed recorded chunks through a pipe into a ScannerReader, keeping the
+    recorded timing scaled by 1/speed (0 sends everything at once).
+    Returns (codes, seconds)."""
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(read_fd, False)
+    source = Source('replay', read_fd, TextDecoder(), Framer(gap=gap))
+    reader = ScannerReader([source], on_code or (lambda code, name: None))
+
+    def feed():
+        start = time.monotonic()
+        with os.fdopen(write_fd, 'wb', buffering=0) as pipe:
+            for offset, text in chunks:
+                if speed:
+                    delay = start + offset / speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                pipe.write(text.encode())
+
+    feeder = threading.Thread(target=feed, name="replay-feeder", daemon=True)
+    start = time.perf_counter()
+    feeder.start()
+    reader.run()
+    elapsed = time.perf_counter() - start
+    feeder.join()
+    return reader.codes, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    read = commands.add_parser('read', help="print each code scanned")
+    read.add_argument('paths', nargs='+')
+    read.add_argument('--gap', type=float, help="also end codes after this many seconds without input")
+
+    rec = commands.add_parser('record', help="save a scanner's raw input with timing for replay")
+    rec.add_argument('path')
+    rec.add_argument('output', type=argparse.FileType('w'))
+
+    rep = commands.add_parser('replay', help="scans/sec framing a recording, no hardware needed")
+    rep.add_argument('file', type=argparse.FileType('r'))
+    rep.add_argument('--speed', type=float, default=1.0, help="timing multiplier; 0 sends as fast as possible")
+    rep.add_argument('--gap', type=float, help="also end codes after this many seconds without input")
+    rep.add_argument('--print', action='store_true', help="print each code")
+    args = parser.parse_args()
+
+    if args.command == 'read':
+        reader = ScannerReader([open_source(path, gap=args.gap) for path in args.paths],
+                               lambda code, name: print(f"{name}: {code}", flush=True))
+        try:
+            reader.run()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'record':
+        record(args.path, args.output)
+    else:
+        chunks = load_recording(args.file)
+        codes, elapsed = replay(chunks, args.speed, args.gap,
+                                (lambda code, name: print(code)) if args.print else None)
+        print(f"{codes} codes in {elapsed:.3f}s, {codes / elapsed:.0f} codes/sec")
+
+
+if __name__ == "__main__":
+    main()
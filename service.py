@@ -0,0 +1,56 @@
+import logging
+import signal
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class Service:
+    """Starts a set of components and keeps the process alive without polling.
+
+    run() starts components in the order they were added, then blocks on an
+    event until SIGINT/SIGTERM or shutdown() is called, and stops them in
+    reverse order so later components (which depend on earlier ones) are
+    wound down first.
+    """
+
+    def __init__(self, name="service"):
+        self.name = name
+        self._components = []
+        self._started = []
+        self._stop_event = threading.Event()
+
+    def add(self, name, start=None, stop=None):
+        self._components.append((name, start, stop))
+
+    def shutdown(self, *_):
+        self._stop_event.set()
+
+    def run(self):
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, self.shutdown)
+
+        try:
+            for name, start, stop in self._components:
+                if start:
+                    start()
+                self._started.append((name, stop))
+                logger.info("Started %s.", name)
+
+            # Signal handlers run on the main thread and wake this wait
+            self._stop_event.wait()
+            logger.info("Shutting down %s.", self.name)
+        finally:
+            self._stop()
+
+    def _stop(self):
+        while self._started:
+            name, stop = self._started.pop()
+            if not stop:
+                continue
+            try:
+                stop()
+                logger.info("Stopped %s.", name)
+            except Exception as e:
+                logger.exception("Error stopping %s: %s", name, e)
@@ -0,0 +1,738 @@
+"""Storage backends behind one interface.
+
+The rest of the app talks to a ContainerStore from get_store(). Two
+implementations exist:
+
+- SqliteStore: the single-file database in database.py. It is the default.
+- PostgresStore: lets several sites and ingest processes write concurrently
+  instead of queueing on SQLite's single writer lock. It needs psycopg and
+  psycopg_pool.
+
+The backend is chosen by CONTAINER_TRACKING_DB (or --db): a postgresql://
+URL selects PostgreSQL, anything else is a SQLite file path.
+
+Check that a backend behaves like the others against an empty database:
+
+    python storage.py check /tmp/scratch.db
+    python storage.py check postgresql://localhost/container_tracking_check
+"""
+import argparse
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import database
+import metrics
+from cache import LRUCache
+
+
+DB_URL = database.DB_PATH
+POSTGRES_SCHEMES = ('postgresql://', 'postgres://')
+
+# Store methods timed into metrics.operation_seconds. Generators are left
+# out: timing them would only measure creating the generator.
+INSTRUMENTED = (
+    'add_container', 'add_user', 'delete_user', 'delete_container',
+    'checkout_container', 'checkout_containers', 'return_container', 'data_version', 'container_counts',
+    'users_page', 'containers_page', 'user_containers', 'history',
+    'existing_keys', 'insert_rows',
+)
+
+
+class ContainerStore:
+    """Operations the app needs from a database.
+
+    Writes return the same values and statuses on every backend; see the
+    SQLite implementation in database.py for the full contract of each.
+    transaction() groups calls into one atomic unit: calls made inside it
+    from the same thread join it rather than committing on their own.
+    """
+
+    def create_database(self):
+        raise NotImplementedError
+
+    def transaction(self, immediate=False):
+        raise NotImplementedError
+
+    def snapshot(self):
+        """Context in which every read sees the same committed state."""
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def cache_stats(self):
+        return {}
+
+    def add_container(self, serial_number):
+        raise NotImplementedError
+
+    def add_user(self, name, badgeID):
+        raise NotImplementedError
+
+    def delete_user(self, user_id):
+        raise NotImplementedError
+
+    def delete_container(self, container_id):
+        raise NotImplementedError
+
+    def checkout_container(self, container_serial, user_badgeID, source=None):
+        raise NotImplementedError
+
+    def checkout_containers(self, container_serials, user_badgeID, source=None):
+        raise NotImplementedError
+
+    def return_container(self, container_serial, source=None):
+        raise NotImplementedError
+
+    def iter_users(self):
+        raise NotImplementedError
+
+    def iter_users_json(self, batch_size=500):
+        raise NotImplementedError
+
+    def iter_containers_with_holder(self):
+        raise NotImplementedError
+
+    def data_version(self):
+        raise NotImplementedError
+
+    def container_counts(self):
+        raise NotImplementedError
+
+    def users_page(self, after_id=0, limit=50, search=None):
+        raise NotImplementedError
+
+    def containers_page(self, after_id=0, limit=50, search=None):
+        raise NotImplementedError
+
+    def user_containers(self, user_id):
+        raise NotImplementedError
+
+    def history(self, container_serial=None, user_badgeID=None, since=None, until=None, before_id=None, limit=100):
+        raise NotImplementedError
+
+    def existing_keys(self, table, rows):
+        raise NotImplementedError
+
+    def insert_rows(self, table, rows):
+        raise NotImplementedError
+
+    def iter_export(self, table, batch_size=500):
+        raise NotImplementedError
+
+
+class SqliteStore(ContainerStore):
+    """The database module's shared pool, pointed at one file."""
+
+    def __init__(self, path=database.DB_PATH, size=database.POOL_SIZE):
+        self.path = path
+        database.configure(path, size)
+
+    def create_database(self):
+        database.create_database()
+
+    def transaction(self, immediate=False):
+        return database.transaction(immediate)
+
+    def snapshot(self):
+        return database.snapshot()
+
+    def close(self):
+        database.close()
+
+    def cache_stats(self):
+        return database.cache_stats()
+
+    def add_container(self, serial_number):
+        return database.add_container(serial_number)
+
+    def add_user(self, name, badgeID):
+        return database.add_user(name, badgeID)
+
+    def delete_user(self, user_id):
+        return database.delete_user(user_id)
+
+    def delete_container(self, container_id):
+        return database.delete_container(container_id)
+
+    def checkout_container(self, container_serial, user_badgeID, source=None):
+        return database.checkout_container(container_serial, user_badgeID, source)
+
+    def checkout_containers(self, container_serials, user_badgeID, source=None):
+        return database.checkout_containers(container_serials, user_badgeID, source)
+
+    def return_container(self, container_serial, source=None):
+        return database.return_container(container_serial, source)
+
+    def iter_users(self):
+        return database.iter_users()
+
+    def iter_users_json(self, batch_size=500):
+        return database.iter_users_json(batch_size)
+
+    def iter_containers_with_holder(self):
+        return database.iter_containers_with_holder()
+
+    def data_version(self):
+        return database.data_version()
+
+    def container_counts(self):
+        return database.container_counts()
+
+    def users_page(self, after_id=0, limit=50, search=None):
+        return database.users_page(after_id, limit, search)
+
+    def containers_page(self, after_id=0, limit=50, search=None):
+        return database.containers_page(after_id, limit, search)
+
+    def user_containers(self, user_id):
+        return database.user_containers(user_id)
+
+    def history(self, container_serial=None, user_badgeID=None, since=None, until=None, before_id=None, limit=100):
+        return database.history(container_serial, user_badgeID, since, until, before_id, limit)
+
+    def existing_keys(self, table, rows):
+        return database.existing_keys(table, rows)
+
+    def insert_rows(self, table, rows):
+        return database.insert_rows(table, rows)
+
+    def iter_export(self, table, batch_size=500):
+        return database.iter_export(table, batch_size)
+
+
+def _pg(sql):
+    """Statements whose SQL is the same on both backends differ only in
+    their placeholder style."""
+    return sql.replace('?', '%s')
+
+
+PG_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS users (
+           id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+           name TEXT UNIQUE,
+           badgeID TEXT UNIQUE)''',
+    '''CREATE TABLE IF NOT EXISTS containers (
+           id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+           serial_number TEXT UNIQUE,
+           user_id BIGINT REFERENCES users(id) ON DELETE SET NULL)''',
+    "CREATE INDEX IF NOT EXISTS idx_containers_user_id ON containers(user_id)",
+    '''CREATE TABLE IF NOT EXISTS events (
+           id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+           container_id BIGINT NOT NULL,
+           user_id BIGINT,
+           action TEXT NOT NULL,
+           source TEXT,
+           created_at DOUBLE PRECISION NOT NULL)''',
+    "CREATE INDEX IF NOT EXISTS idx_events_container ON events(container_id)",
+    "CREATE INDEX IF NOT EXISTS idx_events_user ON events(user_id)",
+    '''CREATE TABLE IF NOT EXISTS meta (
+           key TEXT PRIMARY KEY,
+           value BIGINT NOT NULL)''',
+    "INSERT INTO meta (key, value) VALUES ('data_version', 0) ON CONFLICT DO NOTHING",
+    # Bumped once per writing transaction, from a deferred trigger, so the
+    # meta row is only locked while that transaction commits and writers
+    # are not serialized behind it
+    '''CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger LANGUAGE plpgsql AS $$
+       BEGIN
+           IF current_setting('container_tracking.version_bumped', true) IS DISTINCT FROM 'on' THEN
+               PERFORM set_config('container_tracking.version_bumped', 'on', true);
+               UPDATE meta SET value = value + 1 WHERE key = 'data_version';
+           END IF;
+           RETURN NULL;
+       END $$''',
+)
+
+PG_VERSION_TRIGGER = '''
+    CREATE CONSTRAINT TRIGGER {table}_version
+    AFTER INSERT OR UPDATE OR DELETE ON {table}
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW EXECUTE FUNCTION bump_data_version()'''
+
+PG_INSERT_CONTAINER = "INSERT INTO containers (serial_number) VALUES (%s) ON CONFLICT DO NOTHING RETURNING id"
+PG_INSERT_USER = "INSERT INTO users (name, badgeID) VALUES (%s, %s) ON CONFLICT DO NOTHING RETURNING id"
+
+# Row lock instead of SQLite's BEGIN IMMEDIATE: a concurrent return or
+# checkout of the same container waits here
+PG_HOLDER = """
+    SELECT containers.user_id, users.name
+    FROM containers LEFT JOIN users ON users.id = containers.user_id
+    WHERE containers.id = %s AND containers.serial_number = %s
+    FOR UPDATE OF containers"""
+
+# Streamed reads go a page at a time after the id in the first column,
+# like database._iter_pages, so no connection is held while a client reads
+PG_USERS_JSON = """
+    SELECT users.id,
+           json_build_object('id', users.id, 'name', users.name, 'badgeID', users.badgeID,
+                             'containers', COALESCE(json_agg(containers.serial_number ORDER BY containers.id)
+                                                    FILTER (WHERE containers.serial_number IS NOT NULL), '[]'))::text
+    FROM users
+    LEFT JOIN containers ON containers.user_id = users.id
+    WHERE users.id > %s
+    GROUP BY users.id
+    ORDER BY users.id
+    LIMIT %s"""
+PG_USERS_PAGE = "SELECT id, name, badgeID FROM users WHERE id > %s ORDER BY id LIMIT %s"
+PG_CONTAINERS_WITH_HOLDER_PAGE = """
+    SELECT containers.id, containers.serial_number, users.name
+    FROM containers
+    LEFT JOIN users ON users.id = containers.user_id
+    WHERE containers.id > %s
+    ORDER BY containers.id
+    LIMIT %s"""
+PG_EXPORT_PAGE = {table: _pg(sql) for table, sql in database.SQL_EXPORT_PAGE.items()}
+
+PG_IMPORT = {table: _pg(sql) for table, sql in database.SQL_IMPORT.items()}
+PG_EXISTING = {
+    'users': "SELECT name, badgeID FROM users WHERE name = ANY(%s) OR badgeID = ANY(%s)",
+    'containers': "SELECT serial_number FROM containers WHERE serial_number = ANY(%s)",
+}
+
+PG_CONTAINER_ID_BY_SERIAL = _pg(database.SQL_CONTAINER_ID_BY_SERIAL)
+PG_USER_BY_BADGE = _pg(database.SQL_USER_BY_BADGE)
+PG_CHECKOUT = _pg(database.SQL_CHECKOUT)
+PG_CHECKOUT_CONFLICT = _pg(database.SQL_CHECKOUT_CONFLICT)
+PG_RETURN = _pg(database.SQL_RETURN)
+PG_EVENT_CHECKOUT = _pg(database.SQL_EVENT_CHECKOUT)
+PG_EVENT_RETURN = _pg(database.SQL_EVENT_RETURN)
+PG_DELETE_USER = _pg(database.SQL_DELETE_USER)
+PG_DELETE_CONTAINER = _pg(database.SQL_DELETE_CONTAINER)
+PG_USER_CONTAINERS = _pg(database.SQL_USER_CONTAINERS)
+
+
+class PostgresStore(ContainerStore):
+    """PostgreSQL through a psycopg connection pool.
+
+    Connections are opened with prepare_threshold=0, so every statement is
+    prepared on the server the first time a connection runs it and reused
+    after that. Like the SQLite pool, a thread reuses its connection for
+    nested calls, so a batch of scans shares one transaction.
+    """
+
+    def __init__(self, url, size=database.POOL_SIZE):
+        # Optional dependencies, only needed when PostgreSQL is configured
+        from psycopg.pq import TransactionStatus
+        from psycopg_pool import ConnectionPool
+
+        self.url = url
+        self._idle = TransactionStatus.IDLE
+        self._pool = ConnectionPool(url, min_size=1, max_size=size, open=True,
+                                    kwargs={'prepare_threshold': 0})
+        self._local = threading.local()
+        self.user_cache = LRUCache(database.USER_CACHE_SIZE)
+        self.container_cache = LRUCache(database.CONTAINER_CACHE_SIZE)
+
+    @contextmanager
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+
+        with self._pool.connection() as conn:
+            self._local.conn = conn
+            try:
+                yield conn
+            finally:
+                self._local.conn = None
+                if conn.info.transaction_status != self._idle:
+                    conn.rollback()
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        # immediate is a SQLite notion; here the statements that read and
+        # then write take row locks instead
+        with self.connection() as conn:
+            if getattr(self._local, 'in_transaction', False):
+                yield conn
+                return
+            self._local.in_transaction = True
+            start = time.perf_counter()
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self._local.in_transaction = False
+                metrics.transaction_seconds.observe(time.perf_counter() - start, 'postgresql')
+
+    @contextmanager
+    def snapshot(self):
+        with self.connection() as conn:
+            if conn.info.transaction_status != self._idle:
+                yield conn
+                return
+            conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            try:
+                yield conn
+            finally:
+                conn.rollback()
+
+    def close(self):
+        self._pool.close()
+
+    def cache_stats(self):
+        return {'users': self.user_cache.stats(), 'containers': self.container_cache.stats()}
+
+    def _lookup_user(self, conn, badgeID):
+        user = self.user_cache.get(badgeID)
+        if user is None:
+            user = conn.execute(PG_USER_BY_BADGE, (badgeID,)).fetchone()
+            if user is not None:
+                self.user_cache.put(badgeID, user)
+        return user
+
+    def _lookup_container(self, conn, serial_number):
+        container_id = self.container_cache.get(serial_number)
+        if container_id is None:
+            row = conn.execute(PG_CONTAINER_ID_BY_SERIAL, (serial_number,)).fetchone()
+            if row is not None:
+                container_id = row[0]
+                self.container_cache.put(serial_number, container_id)
+        return container_id
+
+    def create_database(self):
+        with self.transaction() as conn:
+            for statement in PG_SCHEMA:
+                conn.execute(statement)
+            for table in ('users', 'containers'):
+                if not conn.execute("SELECT 1 FROM pg_trigger WHERE tgname = %s",
+                                    (f"{table}_version",)).fetchone():
+                    conn.execute(PG_VERSION_TRIGGER.format(table=table))
+
+    def add_container(self, serial_number):
+        with self.transaction() as conn:
+            row = conn.execute(PG_INSERT_CONTAINER, (serial_number,)).fetchone()
+        self.container_cache.invalidate(serial_number)
+        return row[0] if row else None
+
+    def add_user(self, name, badgeID):
+        with self.transaction() as conn:
+            row = conn.execute(PG_INSERT_USER, (name, badgeID)).fetchone()
+        self.user_cache.invalidate(badgeID)
+        return row[0] if row else None
+
+    def delete_user(self, user_id):
+        with self.transaction() as conn:
+            serials = [row[0] for row in conn.execute(PG_USER_CONTAINERS, (user_id,))]
+            row = conn.execute(PG_DELETE_USER, (user_id,)).fetchone()
+        if row:
+            self.user_cache.invalidate(row[0])
+            return row[0], serials
+        return None
+
+    def delete_container(self, container_id):
+        with self.transaction() as conn:
+            row = conn.execute(PG_DELETE_CONTAINER, (container_id,)).fetchone()
+        if row:
+            self.container_cache.invalidate(row[0])
+        return row
+
+    def checkout_container(self, container_serial, user_badgeID, source=None):
+        with self.transaction() as conn:
+            return self._checkout(conn, container_serial, user_badgeID, source)
+
+    def checkout_containers(self, container_serials, user_badgeID, source=None):
+        with self.transaction() as conn:
+            return [self._checkout(conn, container_serial, user_badgeID, source)
+                    for container_serial in container_serials]
+
+    def _checkout(self, conn, container_serial, user_badgeID, source):
+        # Same checks as database._checkout: a cached id must still belong
+        # to its serial and badge, else both are looked up again
+        for attempt in range(2):
+            container_id = self._lookup_container(conn, container_serial)
+            if container_id is None:
+                return 'no_container', None
+            user = self._lookup_user(conn, user_badgeID)
+            if user is None:
+                return 'no_user', None
+
+            if conn.execute(PG_CHECKOUT, (user[0], container_id, container_serial, user[0], user_badgeID)).fetchone():
+                if database.HISTORY:
+                    conn.execute(PG_EVENT_CHECKOUT, (container_id, user[0], source, time.time()))
+                return 'ok', user[1]
+
+            row = conn.execute(PG_CHECKOUT_CONFLICT, (user[0], user_badgeID, container_id, container_serial)).fetchone()
+            if row is not None and row[2] is not None:
+                return 'conflict', row[1]
+            self.container_cache.invalidate(container_serial)
+            self.user_cache.invalidate(user_badgeID)
+        raise RuntimeError(f"checkout of {container_serial} by {user_badgeID} did not settle")
+
+    def return_container(self, container_serial, source=None):
+        with self.transaction() as conn:
+            for attempt in range(2):
+                container_id = self._lookup_container(conn, container_serial)
+                if container_id is None:
+                    return 'no_container', None
+                holder = conn.execute(PG_HOLDER, (container_id, container_serial)).fetchone()
+                if holder is not None:
+                    break
+                self.container_cache.invalidate(container_serial)
+            else:
+                return 'no_container', None
+            if holder[0] is None:
+                return 'ok', None
+
+            conn.execute(PG_RETURN, (container_id,))
+            if database.HISTORY:
+                conn.execute(PG_EVENT_RETURN, (container_id, holder[0], source, time.time()))
+            return 'ok', holder[1]
+
+    def _iter_pages(self, sql, batch_size=500):
+        """Yield lists of rows, batch_size at a time, keyed on the id in the
+        first column. The connection goes back to the pool between pages."""
+        after_id = 0
+        while True:
+            with self.connection() as conn:
+                rows = conn.execute(sql, (after_id, batch_size)).fetchall()
+            if not rows:
+                break
+            after_id = rows[-1][0]
+            yield rows
+            if len(rows) < batch_size:
+                break
+
+    def iter_users(self):
+        for rows in self._iter_pages(PG_USERS_PAGE):
+            yield from rows
+
+    def iter_users_json(self, batch_size=500):
+        for rows in self._iter_pages(PG_USERS_JSON, batch_size):
+            for row in rows:
+                yield row[1]
+
+    def iter_containers_with_holder(self):
+        for rows in self._iter_pages(PG_CONTAINERS_WITH_HOLDER_PAGE):
+            yield from rows
+
+    def data_version(self):
+        with self.connection() as conn:
+            return conn.execute(database.SQL_DATA_VERSION).fetchone()[0]
+
+    def container_counts(self):
+        with self.connection() as conn:
+            return conn.execute(database.SQL_CONTAINER_COUNTS).fetchone()
+
+    def users_page(self, after_id=0, limit=50, search=None):
+        sql, params = database.users_page_query(after_id, limit, search)
+        with self.connection() as conn:
+            return conn.execute(_pg(sql), params).fetchall()
+
+    def containers_page(self, after_id=0, limit=50, search=None):
+        sql, params = database.containers_page_query(after_id, limit, search)
+        with self.connection() as conn:
+            return conn.execute(_pg(sql), params).fetchall()
+
+    def user_containers(self, user_id):
+        with self.connection() as conn:
+            return [row[0] for row in conn.execute(PG_USER_CONTAINERS, (user_id,))]
+
+    def history(self, container_serial=None, user_badgeID=None, since=None, until=None, before_id=None, limit=100):
+        with self.connection() as conn:
+            container_id = user_id = None
+            if container_serial is not None:
+                container_id = self._lookup_container(conn, container_serial)
+                if container_id is None:
+                    return []
+            if user_badgeID is not None:
+                user = self._lookup_user(conn, user_badgeID)
+                if user is None:
+                    return []
+                user_id = user[0]
+
+            sql, params = database.history_query(container_id, user_id, since, until, before_id, limit)
+            return database.history_rows(conn.execute(_pg(sql), params))
+
+    def existing_keys(self, table, rows):
+        with self.connection() as conn:
+            if table == 'users':
+                found = set()
+                names = [values[0] for values in rows]
+                badges = [values[1] for values in rows]
+                for name, badge in conn.execute(PG_EXISTING['users'], (names, badges)):
+                    found.add(('name', name))
+                    found.add(('badgeID', badge))
+                return found
+
+            serials = [values[0] for values in rows]
+            return {('serial_number', row[0]) for row in conn.execute(PG_EXISTING['containers'], (serials,))}
+
+    def insert_rows(self, table, rows):
+        if not rows:
+            return 0
+        with self.transaction() as conn:
+            with conn.cursor() as cursor:
+                cursor.executemany(PG_IMPORT[table], rows)
+                return cursor.rowcount
+
+    def iter_export(self, table, batch_size=500):
+        for rows in self._iter_pages(PG_EXPORT_PAGE[table], batch_size):
+            yield [row[1:] for row in rows]
+
+
+def open_store(url=DB_URL):
+    """Build the store a database setting refers to."""
+    if url.startswith(POSTGRES_SCHEMES):
+        store = PostgresStore(url)
+    else:
+        store = SqliteStore(url)
+    return metrics.instrument(store, INSTRUMENTED)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def configure(url=DB_URL):
+    """Switch the shared store to url, closing the previous one."""
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+        _store = open_store(url)
+    return _store
+
+
+def get_store():
+    """Return the shared store, opening the configured one on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = open_store()
+    return _store
+
+
+def _cache_sizes():
+    store = _store
+    if store is None:
+        return {}
+    return {(cache, field): stats[field]
+            for cache, stats in store.cache_stats().items()
+            for field in ('hits', 'misses', 'evictions', 'size')}
+
+
+metrics.registry.gauge('container_tracking_lookup_cache', "Badge and serial lookup cache counters.",
+                       _cache_sizes, ('cache', 'field'))
+
+
+def close():
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+            _store = None
+
+
+def check(store, report=print):
+    """Run the same scenario against a store and report any behaviour that
+    differs from what the app expects. Needs an empty database. Returns
+    the number of failed checks."""
+    failures = 0
+
+    def expect(name, got, want):
+        nonlocal failures
+        if got == want:
+            report(f"ok    {name}")
+        else:
+            failures += 1
+            report(f"FAIL  {name}: got {got!r}, expected {want!r}")
+
+    store.create_database()
+    if store.container_counts() != (0, 0) or next(iter(store.iter_users()), None) is not None:
+        raise RuntimeError("the conformance check needs an empty database")
+
+    version = store.data_version()
+    ada = store.add_user('Ada', 'B1')
+    expect("add_user returns an id", isinstance(ada, int), True)
+    expect("add_user rejects a taken name", store.add_user('Ada', 'B2'), None)
+    expect("add_user rejects a taken badge", store.add_user('Bob', 'B1'), None)
+    s1 = store.add_container('S1')
+    s2 = store.add_container('S2')
+    expect("add_container returns ids", isinstance(s1, int) and isinstance(s2, int), True)
+    expect("add_container rejects a taken serial", store.add_container('S1'), None)
+    expect("writes bump data_version", store.data_version() > version, True)
+
+    expect("checkout", store.checkout_container('S1', 'B1', 'check'), ('ok', 'Ada'))
+    expect("checkout of a held container", store.checkout_container('S1', 'B1', 'check'), ('conflict', 'Ada'))
+    expect("checkout by an unknown badge", store.checkout_container('S2', 'B9', 'check'), ('no_user', None))
+    expect("checkout of an unknown serial", store.checkout_container('S9', 'B1', 'check'), ('no_container', None))
+    expect("container_counts", tuple(store.container_counts()), (1, 1))
+    expect("user_containers", store.user_containers(ada), ['S1'])
+    expect("iter_users", [tuple(row) for row in store.iter_users()], [(ada, 'Ada', 'B1')])
+    expect("iter_users_json", [json.loads(user) for user in store.iter_users_json()],
+           [{'id': ada, 'name': 'Ada', 'badgeID': 'B1', 'containers': ['S1']}])
+    expect("iter_containers_with_holder", [tuple(row) for row in store.iter_containers_with_holder()],
+           [(s1, 'S1', 'Ada'), (s2, 'S2', None)])
+    expect("users_page search", [tuple(row) for row in store.users_page(search='Ad')], [(ada, 'Ada', 'B1', 1)])
+    expect("containers_page after_id", [tuple(row) for row in store.containers_page(after_id=s1)], [(s2, 'S2', None)])
+
+    expect("return", store.return_container('S1', 'check'), ('ok', 'Ada'))
+    expect("return of a free container", store.return_container('S1', 'check'), ('ok', None))
+    expect("return of an unknown serial", store.return_container('S9', 'check'), ('no_container', None))
+    if database.HISTORY:
+        events = store.history(container_serial='S1')
+        expect("history, newest first", [(e['action'], e['user'], e['source']) for e in events],
+               [('return', 'Ada', 'check'), ('checkout', 'Ada', 'check')])
+        expect("history paging", [e['action'] for e in store.history(before_id=events[0]['id'], limit=1)],
+               ['checkout'])
+
+    try:
+        with store.transaction():
+            store.add_container('S3')
+            raise RuntimeError("roll back")
+    except RuntimeError:
+        pass
+    expect("nested writes roll back with their transaction",
+           [row[1] for row in store.containers_page(search='S3')], [])
+
+    expect("existing_keys", store.existing_keys('users', [('Ada', 'B7'), ('Cy', 'B8')]), {('name', 'Ada'), ('badgeID', 'B1')})
+    expect("insert_rows skips conflicts", store.insert_rows('containers', [('S1',), ('S4',), ('S5',)]), 2)
+    expect("iter_export", [tuple(row) for rows in store.iter_export('containers') for row in rows],
+           [('S1', None), ('S2', None), ('S4', None), ('S5', None)])
+
+    expect("checkout_containers by an unknown badge", store.checkout_containers(['S1', 'S9'], 'B9', 'check'),
+           [('no_user', None), ('no_container', None)])
+    expect("checkout_containers, per item", store.checkout_containers(['S2', 'S1', 'S9', 'S2'], 'B1', 'check'),
+           [('ok', 'Ada'), ('ok', 'Ada'), ('no_container', None), ('conflict', 'Ada')])
+    expect("delete_container", tuple(store.delete_container(s2)), ('S2', ada))
+    expect("delete_user releases their containers", store.delete_user(ada), ('B1', ['S1']))
+    expect("delete_user of a missing user", store.delete_user(ada), None)
+    expect("deleted users cannot check out", store.checkout_container('S1', 'B1', 'check'), ('no_user', None))
+
+    bob = store.add_user('Bob', 'B2')
+    s6 = store.add_container('S6')
+    expect("ids of deleted rows are not reused", (bob == ada, s6 == s2), (False, False))
+    if database.HISTORY:
+        expect("new rows inherit no history",
+               (store.history(user_badgeID='B2'), store.history(container_serial='S6')), ([], []))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    conformance = commands.add_parser('check', help="run the conformance checks against an empty database")
+    conformance.add_argument('url', help="SQLite file or postgresql:// URL")
+    args = parser.parse_args()
+
+    store = open_store(args.url)
+    try:
+        failures = check(store)
+    except RuntimeError as e:
+        parser.exit(2, f"{e}\n")
+    finally:
+        store.close()
+    print(f"{failures} failed." if failures else "All checks passed.")
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
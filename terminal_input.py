@@ -1,5 +1,4 @@
-import queue
-import time
+import scanner
 
 # Simple code-to-name mapping
 CODES = {
@@ -17,17 +16,22 @@ def check_user(code):
         return f"Code {code} is not recognized."
 
 def run_terminal_input(input_queue):
-    """Handle terminal input and put it in the queue."""
+    """Handle terminal input and put it in the queue.
+
+    Codes typed or scanned into the terminal are queued as soon as their
+    line ends; nothing sleeps between them.
+    """
     print("Container Tracker")
     print("Enter your code")
+    print("(or type 'exit' to quit)")
 
-    while True:
-        code = input("Enter your code (or type 'exit' to quit): ").strip()
-        
+    def on_code(code, source):
         if code.lower() == 'exit':
             print("Exiting the program...")
-            break
-        
+            reader.stop()
+            return
         # Put the entered code in the input queue for the Kivy app to process
         input_queue.put(code)
-        time.sleep(0.1)  # Small sleep to reduce CPU usage in CLI loop
+
+    reader = scanner.ScannerReader([scanner.open_source('-')], on_code)
+    reader.run()
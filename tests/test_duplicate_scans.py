@@ -0,0 +1,142 @@
+import collections
+import json
+import types
+
+import pytest
+
+import main
+import metrics
+import protocol
+import storage
+from cache import LRUCache, TTLCache
+
+
+class FakeClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+        return types.SimpleNamespace(mid=len(self.published))
+
+    def results(self, kiosk):
+        """Result payloads sent to a kiosk, in order."""
+        return [json.loads(payload) for topic, payload in self.published if topic == protocol.result_topic(kiosk)]
+
+    def instructions(self):
+        return [payload for topic, payload in self.published if topic == main.TOPIC]
+
+
+class FakePipeline:
+    """Holds submitted commands until the test applies them, so it can
+    send repeats while a scan is still being applied."""
+
+    def __init__(self):
+        self.queued = []
+
+    def submit(self, command):
+        self.queued.append(command)
+
+    def run(self):
+        queued, self.queued = self.queued, []
+        for command in queued:
+            main.report_command(command, main.apply_command(command))
+        return len(queued)
+
+
+@pytest.fixture
+def ingest(tmp_path, monkeypatch):
+    store = storage.configure(str(tmp_path / 'scans.db'))
+    store.create_database()
+    store.add_user('Ada', 'b1')
+    store.add_container('c1')
+    store.add_container('c2')
+    client = FakeClient()
+    pipeline = FakePipeline()
+    monkeypatch.setattr(main, 'mqtt_client', client)
+    monkeypatch.setattr(main, 'pipeline', pipeline)
+    monkeypatch.setattr(main, 'recent_scans', TTLCache(main.DEDUPE_SIZE, main.DEDUPE_WINDOW))
+    monkeypatch.setattr(main, 'recent_requests', LRUCache(main.REQUEST_CACHE_SIZE))
+    monkeypatch.setattr(main, '_waiting', {})
+    yield client, pipeline
+    storage.close()
+
+
+def command(kiosk, request_id, op='checkout', serial='c1', badge='b1'):
+    fields = {'serial': serial} if op == 'return' else {'serial': serial, 'badge': badge}
+    return types.SimpleNamespace(topic=protocol.command_topic(kiosk),
+                                 payload=protocol.encode_command(op, request_id, **fields))
+
+
+def legacy(text):
+    return types.SimpleNamespace(topic=main.TOPIC, payload=text.encode())
+
+
+def duplicates(path, state):
+    return metrics.duplicate_scans.value(path, state)
+
+
+def per_id(results):
+    return collections.Counter(result['id'] for result in results)
+
+
+def test_redelivery_while_running_is_answered_once(ingest):
+    client, pipeline = ingest
+    before = metrics.mqtt_messages.value('received', 'duplicate')
+    main.on_command(None, None, command('k1', 'r1'))
+    main.on_command(None, None, command('k1', 'r1'))
+    assert pipeline.run() == 1
+    assert per_id(client.results('k1')) == {'r1': 1}
+    assert client.results('k1')[0]['status'] == 'ok'
+    assert metrics.mqtt_messages.value('received', 'duplicate') == before + 1
+
+
+def test_new_id_for_same_scan_waits_for_the_first(ingest):
+    client, pipeline = ingest
+    before = duplicates('structured', 'in_progress')
+    main.on_command(None, None, command('k1', 'r1'))
+    main.on_command(None, None, command('k1', 'r2'))
+    assert client.results('k1') == []
+    assert pipeline.run() == 1
+    assert per_id(client.results('k1')) == {'r1': 1, 'r2': 1}
+    assert {result['status'] for result in client.results('k1')} == {'ok'}
+    assert duplicates('structured', 'in_progress') == before + 1
+
+
+def test_repeat_after_answer_is_not_applied_again(ingest):
+    client, pipeline = ingest
+    before = duplicates('structured', 'answered')
+    main.on_command(None, None, command('k1', 'r1'))
+    pipeline.run()
+    main.on_command(None, None, command('k1', 'r3'))
+    assert pipeline.queued == []
+    assert per_id(client.results('k1')) == {'r1': 1, 'r3': 1}
+    # The repeat gets the first scan's answer, not a conflict with itself
+    assert client.results('k1')[1]['status'] == 'ok'
+    assert duplicates('structured', 'answered') == before + 1
+
+
+def test_other_command_for_serial_ends_the_window(ingest):
+    client, pipeline = ingest
+    main.on_command(None, None, command('k1', 'r1'))
+    main.on_command(None, None, command('k1', 'r2', op='return'))
+    assert pipeline.run() == 2
+    main.on_command(None, None, command('k1', 'r3'))
+    assert pipeline.run() == 1
+    assert [result['status'] for result in client.results('k1')] == ['ok', 'ok', 'ok']
+
+
+def test_legacy_duplicates(ingest):
+    client, pipeline = ingest
+    in_progress = duplicates('legacy', 'in_progress')
+    answered = duplicates('legacy', 'answered')
+    main.on_message(None, None, legacy('control:checkout:c2:b1'))
+    main.on_message(None, None, legacy('control:checkout:c2:b1'))
+    assert pipeline.run() == 1
+    # One broadcast answers both scans
+    assert client.instructions() == ['Success Ada ']
+    main.on_message(None, None, legacy('control:checkout:c2:b1'))
+    assert pipeline.queued == []
+    assert client.instructions() == ['Success Ada ', 'Success Ada ']
+    assert duplicates('legacy', 'in_progress') == in_progress + 1
+    assert duplicates('legacy', 'answered') == answered + 1
@@ -0,0 +1,50 @@
+import sqlite3
+
+import migrations
+
+
+def test_hot_queries_use_indexes(tmp_path):
+    path = str(tmp_path / 'plans.db')
+    migrations.migrate(path)
+    conn = sqlite3.connect(path)
+    try:
+        assert migrations.check_plans(conn) == []
+    finally:
+        conn.close()
+
+
+def test_migrates_version_0_file_in_place(tmp_path):
+    path = str(tmp_path / 'old.db')
+    # The schema the app created before migrations existed
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE containers (
+                        id INTEGER PRIMARY KEY,
+                        serial_number TEXT UNIQUE,
+                        user_id INTEGER,
+                        FOREIGN KEY (user_id) REFERENCES users(id))''')
+    conn.execute('''CREATE TABLE users (
+                        id INTEGER PRIMARY KEY,
+                        name TEXT UNIQUE,
+                        badgeID TEXT UNIQUE)''')
+    conn.execute("INSERT INTO users (id, name, badgeID) VALUES (1, 'Ada', 'B1')")
+    conn.executemany("INSERT INTO containers (serial_number, user_id) VALUES (?, ?)",
+                     [('C1', 1), ('C2', 2), ('C3', None)])
+    conn.commit()
+    conn.close()
+
+    assert migrations.migrate(path) == 0
+
+    conn = sqlite3.connect(path)
+    try:
+        assert migrations.version(conn) == migrations.LATEST
+        # C2 was held by a user who no longer exists
+        assert conn.execute("SELECT serial_number, user_id FROM containers ORDER BY id").fetchall() == \
+            [('C1', 1), ('C2', None), ('C3', None)]
+        assert migrations.check_plans(conn) == []
+
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("DELETE FROM users WHERE id = 1")
+        assert conn.execute("SELECT COUNT(*) FROM containers WHERE user_id IS NOT NULL").fetchone()[0] == 0
+    finally:
+        conn.close()
+    assert migrations.migrate(path) == migrations.LATEST
@@ -0,0 +1,48 @@
+import types
+
+import outbox
+
+
+class FakeClient:
+    """Hands out packet ids like paho, and lets the test deliver PUBACKs."""
+
+    def __init__(self):
+        self.on_publish = None
+        self.mid = 0
+
+    def publish(self, topic, payload, qos=0):
+        self.mid += 1
+        return types.SimpleNamespace(mid=self.mid)
+
+
+def test_stale_early_acks_are_forgotten(tmp_path, monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(outbox.time, 'monotonic', lambda: clock[0])
+    client = FakeClient()
+    store = outbox.Outbox(str(tmp_path / 'outbox.db'))
+    publisher = outbox.OutboxPublisher(client, store)
+
+    # A message sent on the same client without the outbox
+    client.on_publish(client, None, 1)
+    clock[0] += outbox.EARLY_ACK_WINDOW + 1
+    client.on_publish(client, None, 99)
+    assert 1 not in publisher._early
+
+    # Its packet id comes round again for a scan, which must stay stored
+    # until its own PUBACK
+    client.mid = 0
+    publisher.publish('cmd', b'scan')
+    assert len(store) == 1
+    client.on_publish(client, None, 1)
+    assert len(store) == 0
+    store.close()
+
+
+def test_ack_before_publish_returns(tmp_path):
+    client = FakeClient()
+    store = outbox.Outbox(str(tmp_path / 'outbox.db'))
+    publisher = outbox.OutboxPublisher(client, store)
+    client.on_publish(client, None, 1)
+    publisher.publish('cmd', b'scan')
+    assert len(store) == 0 and publisher.inflight() == 0
+    store.close()
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+import storage
+
+
+# A scratch PostgreSQL database for the conformance check. Its tables are
+# dropped first, so never point this at real data.
+POSTGRES_URL = os.environ.get('CONTAINER_TRACKING_TEST_POSTGRES')
+
+
+def run_check(url):
+    lines = []
+    store = storage.open_store(url)
+    try:
+        failures = storage.check(store, report=lines.append)
+    finally:
+        store.close()
+    assert failures == 0, '\n'.join(line for line in lines if line.startswith('FAIL'))
+
+
+def test_sqlite_store_conforms(tmp_path):
+    run_check(str(tmp_path / 'check.db'))
+
+
+@pytest.mark.skipif(not POSTGRES_URL, reason="CONTAINER_TRACKING_TEST_POSTGRES is not set")
+def test_postgres_store_conforms():
+    psycopg = pytest.importorskip('psycopg')
+    pytest.importorskip('psycopg_pool')
+    with psycopg.connect(POSTGRES_URL, autocommit=True) as conn:
+        conn.execute("DROP TABLE IF EXISTS events, containers, users, meta CASCADE")
+    run_check(POSTGRES_URL)